@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+import os
+import sys
+import json
+import time
+import traceback
+
+LEDGER_LABEL = "podondemand-activity"
+SNAPSHOT_PATH = os.environ.get("PODONDEMAND_ACTIVITY_SNAPSHOT", default = "/home/login/logs/activity.json")
+# Set on a pod (to a timestamp) when a login is handed that existing pod, which counts as activity on it. The reaper
+# leader sees it through its pod informer, so no ledger write is needed.
+ATTACH_ANNOTATION = "podondemand/attached"
+
+# The ledger key for activity on the pod at `ip`. Any connection counts for "<ip>"; "<ip>/<min bytes>/<window>" is
+# only recorded when the connections also carried at least that much traffic within that window (see
+# garbagecollectd.traffic_threshold), so replicas that don't know the pod's type can still judge it.
+def activity_key(ip, min_bytes = None, window = None):
+  return ip if min_bytes is None else f"{ip}/{min_bytes}/{window}"
+
+# Cluster-wide record of when each user pod last had a connection through ANY frontend replica.
+# Each replica only sees the ssh sessions relayed through itself, so on its own the reaper would consider pods used
+# through other replicas idle. Every replica publishes its own last-seen timestamps (keyed by activity_key(), so it
+# needs no view of the pods) into one ConfigMap, podondemand-activity-<replica>, at most once per sync_interval.
+# Only the reaper leader reads them back, with a single label-selected LIST, and applies them to its pods. An entry
+# is kept for keep_secs after its last activity, long enough for a leader (or the next one, from its checkpoint) to
+# have taken it over. Each ConfigMap is owned by its replica's pod, so Kubernetes garbage collects it when the
+# replica goes away.
+class ActivityLedger:
+  def __init__(self, v1, namespace, replica_name = None, sync_interval = 15, keep_secs = 120):
+    self.v1 = v1
+    self.namespace = namespace
+    self.replica_name = replica_name or os.getenv("HOSTNAME", default = "unknown")
+    self.sync_interval = sync_interval
+    self.keep_secs = keep_secs
+    self.configmap_name = f"{LEDGER_LABEL}-{self.replica_name}"
+    self.local = {} # activity key -> last activity seen by this replica
+    self.last_sync = 0
+    self.dirty = False
+    self.owner_references = self._owner_references()
+
+  def _owner_references(self):
+    try:
+      me = self.v1.read_namespaced_pod(name = self.replica_name, namespace = self.namespace)
+      return [client.V1OwnerReference(api_version = "v1", kind = "Pod", name = me.metadata.name, uid = me.metadata.uid)]
+    except Exception as e:
+      print(f"ActivityLedger: could not look up own pod {self.replica_name}, ledger will not be garbage collected: {str(e)}", file = sys.stderr)
+      return None
+
+  # Records activity seen by this replica. Only kept in memory until the next sync.
+  def record(self, key, timestamp):
+    if self.local.get(key, 0) < timestamp:
+      self.local[key] = timestamp
+      self.dirty = True
+
+  # Drops entries with no activity for keep_secs, so the published ledger doesn't grow without bound
+  def expire(self, now):
+    for key, timestamp in list(self.local.items()):
+      if timestamp < now - self.keep_secs:
+        self.local.pop(key)
+        self.dirty = True
+
+  # Publishes this replica's entries and, with `merge`, returns everyone's (activity key -> latest timestamp). Does
+  # nothing (and returns None) until sync_interval has passed, unless `force`, so the rate is one ConfigMap write per
+  # replica, and one LIST by the leader, per interval regardless of connections.
+  def sync(self, now = None, merge = False, force = False):
+    now = time.time() if now is None else now
+    if now - self.last_sync < self.sync_interval and not force:
+      return None
+    self.last_sync = now
+    try:
+      if self.dirty:
+        self._publish()
+        self.dirty = False
+      return self._merge() if merge else None
+    except Exception as e:
+      traceback.print_tb(e.__traceback__)
+      print(f"ActivityLedger sync failed: {repr(e)}", file = sys.stderr)
+      return None
+
+  def _publish(self):
+    body = client.V1ConfigMap(
+      metadata = client.V1ObjectMeta(name = self.configmap_name, labels = {"app": LEDGER_LABEL}, owner_references = self.owner_references),
+      data = {"lastSeen": json.dumps(self.local, separators = (',', ':'))})
+    try:
+      self.v1.replace_namespaced_config_map(name = self.configmap_name, namespace = self.namespace, body = body)
+    except ApiException as e:
+      if e.status != 404:
+        raise e
+      self.v1.create_namespaced_config_map(namespace = self.namespace, body = body)
+
+  def _merge(self):
+    cluster = {}
+    for cm in self.v1.list_namespaced_config_map(self.namespace, label_selector = f"app={LEDGER_LABEL}").items:
+      try:
+        entries = json.loads((cm.data or {}).get("lastSeen", "{}"))
+      except ValueError:
+        print(f"ActivityLedger: ignoring malformed ledger {cm.metadata.name}", file = sys.stderr)
+        continue
+      for key, timestamp in entries.items():
+        if cluster.get(key, 0) < timestamp:
+          cluster[key] = timestamp
+    return cluster
+
+# Writes the reaper's current view of when each pod was last active (pod name -> timestamp) to a local file, so the
+# frontend's --list can show it without any API call. Replaced atomically; readers never see a partial file.
+# With `uids` (pod name -> uid), it also serves as the reaper's checkpoint, restored by read_checkpoint() after a
+# restart. The file is on the shared logs volume, so only one replica (the reaper leader) should write it.
+def write_snapshot(last_active, path = SNAPSHOT_PATH, uids = None):
+  tmp = f"{path}.tmp"
+  try:
+    with open(tmp, 'w') as out:
+      json.dump({"updated": time.time(), "lastActive": last_active, "uids": uids or {}}, out, separators = (',', ':'))
+    os.chmod(tmp, 0o644) # Read by the frontend as the login user
+    os.replace(tmp, path)
+  except OSError as e:
+    print(f"ActivityLedger: could not write snapshot {path}: {str(e)}", file = sys.stderr)
+
+# Returns the last snapshot written by write_snapshot(), or an empty dict if there is none (eg. outside a replica)
+def read_snapshot(path = SNAPSHOT_PATH):
+  try:
+    with open(path, 'r') as f:
+      return json.load(f).get("lastActive", {})
+  except (OSError, ValueError):
+    return {}
+
+# Returns (updated, {pod name: (uid, last active)}) from the last snapshot, or (None, {}) if there is none or it is
+# unreadable. Entries without a uid (written before uids were recorded) are left out, since they can't be matched
+# to a pod safely.
+def read_checkpoint(path = SNAPSHOT_PATH):
+  try:
+    with open(path, 'r') as f:
+      snapshot = json.load(f)
+    uids = snapshot.get("uids") or {}
+    entries = {name: (uids[name], float(timestamp)) for name, timestamp in snapshot.get("lastActive", {}).items() if uids.get(name)}
+    return (float(snapshot["updated"]), entries)
+  except FileNotFoundError:
+    return (None, {})
+  except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+    print(f"ActivityLedger: ignoring unreadable checkpoint {path}: {repr(e)}", file = sys.stderr)
+    return (None, {})
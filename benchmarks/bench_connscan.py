@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+### Micro-benchmark of connscan.established_remote_ips() against the psutil.net_connections() scan it replaced.
+# Opens N loopback TCP connections (so 2N established sockets), then times both scans.
+# Example: ./bench_connscan.py -n 1000 10000
+
+import os
+import sys
+import time
+import socket
+import resource
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import connscan
+
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+def psutil_scan():
+  return {conn.raddr.ip for conn in psutil.net_connections(kind='inet') if conn.status == 'ESTABLISHED' and not (conn.raddr == "" or conn.raddr == ())}
+
+def open_connections(n):
+  server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  server.bind(('127.0.0.1', 0))
+  server.listen(1024)
+  socks = [server]
+  for i in range(n):
+    c = socket.create_connection(server.getsockname())
+    s, _ = server.accept()
+    socks += [c, s]
+  return socks
+
+def best_of(fn, repeat):
+  times = []
+  for i in range(repeat):
+    t1 = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - t1)
+  return min(times)
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="", prog="bench_connscan")
+  parser.add_argument('-n', '--connections', type = int, nargs = '+', default = [1000, 10000], help = "Numbers of loopback connections to benchmark with")
+  parser.add_argument('-r', '--repeat', type = int, default = 5, help = "Runs per measurement (best is reported)")
+  args = parser.parse_args(argv[1:])
+
+  # Each connection costs two fds
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  wanted = 2 * max(args.connections) + 64
+  if soft < wanted:
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+  if psutil is None:
+    print("psutil is not installed; only timing connscan")
+  limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+  for n in args.connections:
+    if 2 * n + 64 > limit:
+      print(f"{n:>6} connections: skipped, needs {2 * n + 64} fds but RLIMIT_NOFILE is {limit}")
+      continue
+    socks = open_connections(n)
+    try:
+      t_scan = best_of(connscan.established_remote_ips, args.repeat)
+      line = f"{n:>6} connections: connscan {t_scan * 1000:8.2f} ms"
+      if psutil is not None:
+        assert psutil_scan() <= connscan.established_remote_ips() | {'::1'}
+        t_psutil = best_of(psutil_scan, args.repeat)
+        line += f"   psutil {t_psutil * 1000:8.2f} ms   speedup {t_psutil / t_scan:6.1f}x"
+      print(line)
+    finally:
+      for s in socks:
+        s.close()
+
+if __name__ == "__main__":
+  main(sys.argv)
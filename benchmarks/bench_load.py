@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+### Load benchmarks against an in-process fake Kubernetes API (fakekube.py), so no cluster or ssh is needed.
+#   spawn:     N concurrent logins through run_pod.main(), from create to sshd answering; logins/s and API calls
+#   list:      --list latency as the namespace grows (other users' pods included)
+#   reaper:    garbagecollectd's informer-fed reaper: time and API calls per sweep, against one LIST per sweep
+#   keyimport: keyimportd.reconcile() time against the number of users in authorized_keys
+# Every call to the fake API sleeps --latency seconds, and scheduling/starting a pod takes --schedule-delay and
+# --start-delay. Nothing outside a temporary directory is touched; user accounts are simulated by home directories.
+# Written against the kubernetes client pinned in the Dockerfile (31.0.0); the fake relies on its model classes.
+# Example: ./bench_load.py spawn list -n 10 100 --sizes 100 1000 5000 --latency 0.005
+
+import os
+import io
+import sys
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+import concurrent.futures
+
+WORKDIR = tempfile.mkdtemp(prefix = "podondemand-bench-")
+# Read by the modules below when they are imported
+os.environ.setdefault("PODONDEMAND_TIMELINE_DIR", os.path.join(WORKDIR, "timeline"))
+os.environ.setdefault("PODONDEMAND_ACTIVITY_SNAPSHOT", os.path.join(WORKDIR, "activity.json"))
+os.environ.setdefault("CONFIG_NAMESPACE", "consolepod")
+os.makedirs(os.environ["PODONDEMAND_TIMELINE_DIR"], exist_ok = True)
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO)
+import fakekube
+
+NAMESPACE = os.environ["CONFIG_NAMESPACE"]
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def new_cluster(args):
+  cluster = fakekube.FakeCluster(latency = args.latency, per_item_latency = args.per_item_latency,
+                                 schedule_delay = args.schedule_delay, start_delay = args.start_delay)
+  for i in range(args.nodes):
+    cluster.add_node(f"node-{i}", {"cpu": "64", "memory": "256Gi", "pods": "250"})
+  cluster.add_object("configmaps", NAMESPACE, fakekube.load_config_map(os.path.join(REPO, "podondemand.yaml")))
+  fakekube.install(cluster)
+  return cluster
+
+def load_pod_config(cluster):
+  from podconfig import PodOnDemandConfig
+  return PodOnDemandConfig(fakekube.FakeCoreV1Api(cluster).read_namespaced_config_map("podondemand-config", NAMESPACE))
+
+# Running user pods spread over `users` users, as the frontend would have created them. Every expire_every'th pod
+# gets a 1 second inactivity timeout, so the reaper has something to delete.
+def seed_pods(cluster, pod_config, args, count, expire_every = None):
+  import run_pod
+  podtype = next(iter(pod_config.pod_choices))
+  users = max(1, count // args.pods_per_user)
+  for i in range(count):
+    username = f"user{i % users}"
+    timeout = 1 if expire_every and i % expire_every == 0 else 3600
+    pod = run_pod.define_pod(None, pod_config.templates[podtype], f"userpod-{username}-{podtype}-{i:06d}", username, "x", "key", username, timeout, podtype)
+    cluster.add_running_pod(NAMESPACE, pod, node_name = f"node-{i % args.nodes}")
+
+def bench_spawn(args):
+  import run_pod
+  cluster = new_cluster(args)
+  pod_config = load_pod_config(cluster)
+  v1 = fakekube.FakeCoreV1Api(cluster)
+  keyfile = os.path.join(WORKDIR, "authorized_keys")
+  with open(keyfile, 'w') as f:
+    f.write("ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIBench bench@bench\n")
+  run_pod.AUTHORIZED_KEYS_PATH = keyfile
+  # No sshd behind the fake pods: assume it answers --sshd-delay seconds after the pod is Running
+  run_pod.probe_ssh = lambda ip, port, deadline, stop = None, **kwargs: time.sleep(args.sshd_delay) or True
+  run_pod.get_encrypted_password(pod_config.data.get("podPasswordHash")) # Done once per frontendd, not per login
+
+  podtype = next(iter(pod_config.pod_choices))
+  for n in args.logins:
+    calls_before = sum(cluster.calls.values())
+    errors = []
+    def login(i):
+      start = time.perf_counter()
+      try:
+        run_pod.main(["run_pod.py"], v1 = v1, pod_config = pod_config, username = f"bench{n}-{i}", argdata = f"--type {podtype}")
+      except SystemExit as e:
+        if e.code:
+          return None
+      except Exception as e:
+        errors.append(e)
+        return None
+      return time.perf_counter() - start
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+      with concurrent.futures.ThreadPoolExecutor(max_workers = n) as pool:
+        times = list(pool.map(login, range(n)))
+    wall = time.perf_counter() - start
+    ok = [t for t in times if t is not None]
+    calls = sum(cluster.calls.values()) - calls_before
+    print(f"spawn: {n:>5} concurrent logins: {len(ok)} ok in {wall:7.2f} s ({len(ok) / wall:6.1f}/s), per login p50 " +
+          (f"{percentile(ok, 50):.2f} s p95 {percentile(ok, 95):.2f} s" if ok else "-") + f", {calls / n:.1f} API calls per login")
+    if errors:
+      print(f"  {len(errors)} logins failed, eg. {repr(errors[0])}")
+
+def bench_list(args):
+  import run_pod
+  for size in args.sizes:
+    cluster = new_cluster(args)
+    pod_config = load_pod_config(cluster)
+    v1 = fakekube.FakeCoreV1Api(cluster)
+    seed_pods(cluster, pod_config, args, size)
+    times = []
+    calls_before = sum(cluster.calls.values())
+    for i in range(args.repeat):
+      start = time.perf_counter()
+      with contextlib.redirect_stdout(io.StringIO()):
+        try:
+          run_pod.main(["run_pod.py"], v1 = v1, pod_config = pod_config, username = "user0", argdata = "--list --output json")
+        except SystemExit:
+          pass
+      times.append(time.perf_counter() - start)
+    calls = (sum(cluster.calls.values()) - calls_before) / args.repeat
+    print(f"list: {size:>6} pods in the namespace ({args.pods_per_user} per user): p50 {percentile(times, 50) * 1000:8.2f} ms" +
+          f"  max {max(times) * 1000:8.2f} ms, {calls:.1f} API calls per --list")
+
+def bench_reaper(args):
+  from podcache import PodInformer
+  from reaper import Reaper
+  import garbagecollectd
+  for size in args.sizes:
+    cluster = new_cluster(args)
+    pod_config = load_pod_config(cluster)
+    v1 = fakekube.FakeCoreV1Api(cluster)
+    seed_pods(cluster, pod_config, args, size, expire_every = 100)
+    informer = PodInformer(v1, NAMESPACE)
+    reaper = Reaper()
+    lock = threading.Lock()
+    def on_event(event_type, pod):
+      with lock:
+        garbagecollectd.apply_pod_event(reaper, event_type, pod, time.time())
+    informer.add_listener(on_event)
+    informer.start()
+    informer.wait_for_sync()
+    ips = [pod.status.pod_ip for pod in informer.pods()]
+    time.sleep(1.1) # Let the short timeouts expire
+
+    calls_before = sum(cluster.calls.values())
+    times = []
+    deleted = 0
+    for sweep in range(args.repeat):
+      active = random.sample(ips, min(len(ips), args.active))
+      start = time.perf_counter()
+      now = time.time()
+      with lock:
+        for ip in active:
+          pod = informer.get_by_ip(ip)
+          if pod is not None:
+            reaper.activity(pod.metadata.name, now)
+        for name, deadline in reaper.due(now):
+          pod = informer.get(name)
+          with contextlib.redirect_stderr(io.StringIO()):
+            if garbagecollectd.delete_namespaced_pod(v1, name, NAMESPACE, uid = pod.metadata.uid if pod else None):
+              reaper.forget(name)
+              deleted += 1
+      times.append(time.perf_counter() - start)
+    calls = (sum(cluster.calls.values()) - calls_before) / args.repeat
+    informer.stop()
+
+    # What each sweep cost before the informer: a LIST of every user pod
+    list_times = []
+    for sweep in range(min(args.repeat, 5)):
+      start = time.perf_counter()
+      v1.list_namespaced_pod(NAMESPACE, label_selector = "podtype")
+      list_times.append(time.perf_counter() - start)
+    print(f"reaper: {size:>6} pods, {args.active} active: sweep p50 {percentile(times, 50) * 1000:8.3f} ms, {calls:.2f} API calls per sweep" +
+          f" ({deleted} deleted); one LIST per sweep instead: {percentile(list_times, 50) * 1000:8.2f} ms")
+
+def bench_keyimport(args):
+  import keyimportd
+  # Accounts are only simulated: a user exists if it has a home directory
+  def add_users(users):
+    for user in users:
+      os.makedirs(os.path.join(home_root, user), exist_ok = True)
+  keyimportd.add_users = add_users
+  keyimportd.delete_user = lambda user: shutil.rmtree(os.path.join(home_root, user), ignore_errors = True)
+  keyimportd.shutil.chown = lambda *args, **kwargs: None
+
+  for count in args.users:
+    home_root = tempfile.mkdtemp(dir = WORKDIR)
+    keys = os.path.join(WORKDIR, f"authorized_keys.{count}")
+    lines = [f"ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI{i:08d} user{i}@host\n" for i in range(count)]
+    with open(keys, 'w') as f:
+      f.writelines(lines)
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+      start = time.perf_counter()
+      snapshot = keyimportd.reconcile(keys, None, home_root)
+      results["initial"] = time.perf_counter() - start
+      start = time.perf_counter()
+      snapshot = keyimportd.reconcile(keys, snapshot, home_root)
+      results["unchanged"] = time.perf_counter() - start
+      start = time.perf_counter()
+      keyimportd.reconcile(keys, None, home_root)
+      results["resync"] = time.perf_counter() - start
+      lines[0] = lines[0].replace("AAAAI", "AAAAJ")
+      with open(keys, 'w') as f:
+        f.writelines(lines)
+      start = time.perf_counter()
+      keyimportd.reconcile(keys, snapshot, home_root)
+      results["one changed"] = time.perf_counter() - start
+    print(f"keyimport: {count:>6} users: " + ', '.join(f"{name} {secs * 1000:8.1f} ms" for name, secs in results.items()))
+
+BENCHMARKS = {"spawn": bench_spawn, "list": bench_list, "reaper": bench_reaper, "keyimport": bench_keyimport}
+
+def main(argv):
+  parser = argparse.ArgumentParser(description = "", prog = "bench_load")
+  parser.add_argument('benchmarks', nargs = '*', help = f"Benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+  parser.add_argument('-n', '--logins', type = int, nargs = '+', default = [1, 10, 50], help = "Concurrent logins, for spawn")
+  parser.add_argument('--sizes', type = int, nargs = '+', default = [100, 1000, 5000], help = "Pods in the namespace, for list and reaper")
+  parser.add_argument('--users', type = int, nargs = '+', default = [100, 1000, 2000], help = "Users in authorized_keys, for keyimport")
+  parser.add_argument('--pods-per-user', type = int, default = 2, help = "Pods per user when filling the namespace")
+  parser.add_argument('-a', '--active', type = int, default = 100, help = "Pods with a connection per reaper sweep")
+  parser.add_argument('-r', '--repeat', type = int, default = 20, help = "Runs per measurement")
+  parser.add_argument('--nodes', type = int, default = 8, help = "Nodes in the fake cluster")
+  parser.add_argument('--latency', type = float, default = 0.002, help = "Seconds each API call takes")
+  parser.add_argument('--per-item-latency', type = float, default = 0.0, help = "Additional seconds per object a call returns")
+  parser.add_argument('--schedule-delay', type = float, default = 0.5, help = "Seconds before a new pod is bound to a node")
+  parser.add_argument('--start-delay', type = float, default = 1.0, help = "Seconds from binding until the pod is Running")
+  parser.add_argument('--sshd-delay', type = float, default = 0.2, help = "Seconds from Running until sshd answers")
+  args = parser.parse_args(argv[1:])
+  unknown = [name for name in args.benchmarks if not name in BENCHMARKS]
+  if unknown:
+    parser.error(f"unknown benchmark {unknown[0]}")
+
+  try:
+    for name in args.benchmarks or BENCHMARKS:
+      BENCHMARKS[name](args)
+  finally:
+    shutil.rmtree(WORKDIR, ignore_errors = True)
+
+if __name__ == "__main__":
+  main(sys.argv)
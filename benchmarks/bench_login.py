@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+### End-to-end latency of the frontend's command paths, as a login would run them.
+# Run inside a PodOnDemand replica, as a login user (so that the in-cluster config and ~/.ssh/authorized_keys are
+# available). Each command is run as a fresh process with SSH_ORIGINAL_COMMAND set, like login.sh does.
+# Pass --baseline with the path of an older run_pod.py to compare before/after, and --client to also time the
+# frontendd broker path. Spawning is only measured with --spawn, and every spawned pod is deleted afterwards.
+# Example: ./bench_login.py --baseline /tmp/run_pod_old.py --client -n 10 --spawn
+
+import os
+import re
+import sys
+import time
+import argparse
+import subprocess
+import statistics
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def run(frontend, command):
+  env = dict(os.environ, SSH_ORIGINAL_COMMAND = command)
+  t1 = time.perf_counter()
+  completed = subprocess.run([sys.executable, frontend], env = env, capture_output = True, text = True)
+  return time.perf_counter() - t1, completed.stdout + completed.stderr
+
+def measure(frontend, command, runs, cleanup = None):
+  times = []
+  for i in range(runs):
+    secs, output = run(frontend, command)
+    times.append(secs)
+    if cleanup is not None:
+      cleanup(output)
+  return times
+
+# Deletes the pod a spawn created, found from the ssh command it printed
+def delete_spawned(frontend):
+  def cleanup(output):
+    for name in set(re.findall(r'userpod-[a-z0-9-]+', output)):
+      run(frontend, f"--delete {name}")
+  return cleanup
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="", prog="bench_login")
+  parser.add_argument('-n', '--runs', type = int, default = 10, help = "Runs per command")
+  parser.add_argument('--baseline', type = str, default = None, help = "Path of a previous run_pod.py to compare against")
+  parser.add_argument('--client', action = 'store_true', help = "Also measure through frontend_client.py (requires frontendd to be running)")
+  parser.add_argument('--spawn', action = 'store_true', help = "Also measure spawning a pod with the default settings")
+  args = parser.parse_args(argv[1:])
+
+  frontends = [("current", os.path.join(REPO, "run_pod.py"))]
+  if args.baseline:
+    frontends.insert(0, ("baseline", args.baseline))
+  if args.client:
+    frontends.append(("broker", os.path.join(REPO, "frontend_client.py")))
+
+  commands = ["--list", "--type", "--storage"] + ([""] if args.spawn else [])
+  print(f"{'frontend':<10}{'command':<12}{'median':>10}{'min':>10}{'max':>10}")
+  for label, frontend in frontends:
+    for command in commands:
+      cleanup = delete_spawned(frontend) if command == "" else None
+      times = measure(frontend, command, args.runs, cleanup)
+      print(f"{label:<10}{command or '(spawn)':<12}{statistics.median(times):>9.3f}s{min(times):>9.3f}s{max(times):>9.3f}s")
+
+if __name__ == "__main__":
+  main(sys.argv)
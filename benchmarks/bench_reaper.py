@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+### Benchmark of garbagecollectd's deadline-heap reaper (reaper.py) against the full sweep it replaced.
+# Per scan, the old loop looked at every tracked pod; the reaper only touches pods with connections and pods whose
+# deadline has come due. Also runs a short real-time simulation of the garbagecollectd loop to show how late pods
+# are reaped after their deadline, and how much CPU the loop uses while waiting.
+# Example: ./bench_reaper.py -n 1000 10000 -a 100
+
+import os
+import sys
+import time
+import random
+import argparse
+import types
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from reaper import Reaper
+
+# Stands in for ActivityLedger: activity seen by other replicas (none, here)
+class Ledger:
+  def __init__(self):
+    self.local = {}
+  def record(self, name, timestamp):
+    self.local[name] = timestamp
+  def last_seen(self, name):
+    return None
+
+def make_pods(n):
+  return [types.SimpleNamespace(metadata = types.SimpleNamespace(name = f"userpod-u{i}", labels = {"timeout": str(random.randint(60, 14400))}),
+                                status = types.SimpleNamespace(pod_ip = f"10.{i // 65536}.{i // 256 % 256}.{i % 256}")) for i in range(n)]
+
+# The loop garbagecollectd ran every inactivityPollFreq before the reaper, minus the API calls
+def full_sweep(pods, active, timeout_dict, ledger, now):
+  expired = []
+  for pod in pods:
+    name = pod.metadata.name
+    if pod.status.pod_ip in active:
+      ledger.record(name, now)
+    pod_timeout = int(pod.metadata.labels['timeout'])
+    if pod.status.pod_ip in active or not name in timeout_dict.keys():
+      timeout_dict[name] = now
+    last_active = max(timeout_dict[name], ledger.last_seen(name) or 0)
+    if now - last_active > pod_timeout:
+      expired.append(name)
+  return expired
+
+def heap_scan(reaper, by_ip, active, ledger, now):
+  for ip in active:
+    pod = by_ip.get(ip)
+    if pod is not None:
+      reaper.activity(pod.metadata.name, now)
+      ledger.record(pod.metadata.name, now)
+  return reaper.due(now)
+
+def best_of(fn, repeat):
+  times = []
+  for i in range(repeat):
+    t1 = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - t1)
+  return min(times)
+
+def simulate(pods, seconds, poll_freq):
+  reaper = Reaper()
+  start = time.time()
+  for i in range(pods):
+    reaper.track(f"p{i}", random.uniform(0.1, seconds - 0.5), start)
+  lateness = []
+  next_scan = 0
+  cpu_start = time.process_time()
+  while len(reaper) and time.time() - start < seconds:
+    now = time.time()
+    if now >= next_scan:
+      next_scan = now + poll_freq
+    for name, deadline in reaper.due(time.time()):
+      lateness.append(time.time() - deadline)
+      reaper.forget(name)
+    if not len(reaper):
+      break
+    wake = min(next_scan, reaper.next_deadline() or next_scan)
+    time.sleep(max(0, wake - time.time()))
+  cpu = time.process_time() - cpu_start
+  lateness.sort()
+  return lateness, cpu, time.time() - start
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="", prog="bench_reaper")
+  parser.add_argument('-n', '--pods', type = int, nargs = '+', default = [1000, 10000], help = "Numbers of tracked pods to benchmark with")
+  parser.add_argument('-a', '--active', type = int, default = 100, help = "Pods with an active connection per scan")
+  parser.add_argument('-r', '--repeat', type = int, default = 5, help = "Runs per measurement (best is reported)")
+  parser.add_argument('-s', '--simulate', type = float, default = 5, help = "Seconds of real-time simulation (0 to skip)")
+  args = parser.parse_args(argv[1:])
+
+  for n in args.pods:
+    pods = make_pods(n)
+    active = {pod.status.pod_ip for pod in random.sample(pods, min(args.active, n))}
+    now = time.time()
+
+    timeout_dict = {}
+    ledger = Ledger()
+    full_sweep(pods, active, timeout_dict, ledger, now)
+    t_sweep = best_of(lambda: full_sweep(pods, active, timeout_dict, ledger, now), args.repeat)
+
+    reaper = Reaper(Ledger())
+    for pod in pods:
+      reaper.track(pod.metadata.name, int(pod.metadata.labels['timeout']), now)
+    by_ip = {pod.status.pod_ip: pod for pod in pods}
+    tick = itertools.count(1)
+    t_heap = best_of(lambda: heap_scan(reaper, by_ip, active, ledger, now + next(tick) * 0.001), args.repeat) # Every scan moves deadlines
+    t_idle = best_of(lambda: reaper.due(now), args.repeat)
+    print(f"{n:>6} pods, {len(active)} active: full sweep {t_sweep * 1000:8.3f} ms   heap scan {t_heap * 1000:8.3f} ms" +
+          f"   speedup {t_sweep / t_heap:6.1f}x   reap check with nothing due {t_idle * 1e6:6.1f} us")
+
+  if args.simulate > 0:
+    lateness, cpu, wall = simulate(200, args.simulate, poll_freq = 5)
+    if lateness:
+      print(f"simulation: {len(lateness)} pods reaped, lateness p50 {lateness[len(lateness) // 2] * 1000:.2f} ms, " +
+            f"max {lateness[-1] * 1000:.2f} ms; CPU {cpu * 1000:.1f} ms over {wall:.1f} s")
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+
+### In-process stand-in for the parts of the Kubernetes API that PodOnDemand uses, for load benchmarks without a
+# cluster (see bench_load.py). FakeCluster keeps pods, nodes, services, configmaps and leases as the API server
+# would (plain JSON-style dicts with resourceVersions), and every call returns freshly deserialized client models,
+# so the client-side cost of big LISTs is paid just as with a real cluster. It supports label and field selectors,
+# resumable watches (an ERROR 410 event when the resourceVersion is too old), uid and resourceVersion
+# preconditions, and a scheduler that binds each new pod to a node after schedule_delay and marks it Running
+# start_delay later. Each call sleeps for `latency` seconds, plus `per_item_latency` per object returned, and is
+# counted per method in cluster.calls.
+#
+# install(cluster) makes config.load_incluster_config() a no-op and client.CoreV1Api(), client.CoordinationV1Api()
+# and watch.Watch() return fakes bound to the cluster, so code that builds its own clients runs unmodified.
+
+import copy
+import json
+import time
+import heapq
+import queue
+import types
+import uuid
+import datetime
+import itertools
+import threading
+import collections
+
+import yaml
+from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
+
+def _now_str():
+  return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# Parses "a=b,c!=d,e,!f" into [(key, op, value)]
+def _parse_selector(selector):
+  requirements = []
+  for part in (selector or "").split(","):
+    part = part.strip()
+    if not part:
+      continue
+    if "!=" in part:
+      key, value = part.split("!=", 1)
+      requirements.append((key.strip(), "!=", value.strip()))
+    elif "=" in part:
+      key, value = part.split("=", 1)
+      requirements.append((key.strip(), "=", value.strip().lstrip("=")))
+    elif part.startswith("!"):
+      requirements.append((part[1:], "!", None))
+    else:
+      requirements.append((part, "exists", None))
+  return requirements
+
+def _matches(obj, namespace, label_selector, field_selector):
+  meta = obj["metadata"]
+  if namespace is not None and meta.get("namespace") != namespace:
+    return False
+  labels = meta.get("labels") or {}
+  for key, op, value in _parse_selector(label_selector):
+    if (op == "=" and labels.get(key) != value) or (op == "!=" and labels.get(key) == value) or \
+       (op == "exists" and not key in labels) or (op == "!" and key in labels):
+      return False
+  fields = {"metadata.name": meta.get("name"), "metadata.namespace": meta.get("namespace")}
+  for key, op, value in _parse_selector(field_selector):
+    if (fields.get(key) == value) != (op == "="):
+      return False
+  return True
+
+# Merges a patch (a dict, as for a JSON merge patch) into obj
+def _merge(obj, patch):
+  for key, value in patch.items():
+    if value is None:
+      obj.pop(key, None)
+    elif isinstance(value, dict) and isinstance(obj.get(key), dict):
+      _merge(obj[key], value)
+    else:
+      obj[key] = copy.deepcopy(value)
+
+# Model class names, per kind, of an object and of a list of them
+MODELS = {"pods": ("V1Pod", "V1PodList"), "nodes": ("V1Node", "V1NodeList"), "services": ("V1Service", "V1ServiceList"),
+          "configmaps": ("V1ConfigMap", "V1ConfigMapList"), "leases": ("V1Lease", "V1LeaseList")}
+
+class FakeCluster:
+  def __init__(self, latency = 0.0, per_item_latency = 0.0, schedule_delay = 0.5, start_delay = 1.0, log_size = 10000):
+    self.latency = latency
+    self.per_item_latency = per_item_latency
+    self.schedule_delay = schedule_delay
+    self.start_delay = start_delay
+    self.calls = collections.Counter() # method name -> number of calls
+    self._codec = client.ApiClient() # Only used to (de)serialize models
+    self._lock = threading.Lock()
+    self._objects = {kind: {} for kind in MODELS} # kind -> (namespace, name) -> dict
+    self._rv = 0
+    self._log = collections.deque(maxlen = log_size) # (resourceVersion, kind, event type, object) for resuming watches
+    self._watchers = [] # (kind, namespace, label selector, field selector, queue)
+    self._schedule = [] # Heap of (time, seq, action, key) for the scheduler thread
+    self._schedule_seq = itertools.count()
+    self._schedule_cv = threading.Condition(self._lock)
+    self._scheduler = None
+    self._node_cycle = None
+    self._ips = itertools.count(1)
+
+  # Sleeps for the configured latency and counts the call
+  def call(self, method, items = 0):
+    self.calls[method] += 1
+    delay = self.latency + items * self.per_item_latency
+    if delay > 0:
+      time.sleep(delay)
+
+  def to_dict(self, obj):
+    return obj if isinstance(obj, dict) else self._codec.sanitize_for_serialization(obj)
+
+  # What the client does with a response body: parse the JSON, then build models (the public deserialize()'s
+  # signature differs between client versions, the private method it calls doesn't)
+  def to_model(self, data, model):
+    return self._codec._ApiClient__deserialize(json.loads(json.dumps(data)), model)
+
+  # Stores obj and tells the watchers. Must be called with self._lock held.
+  def _commit(self, kind, event_type, obj):
+    self._rv += 1
+    obj["metadata"]["resourceVersion"] = str(self._rv)
+    key = (obj["metadata"].get("namespace"), obj["metadata"]["name"])
+    if event_type == "DELETED":
+      self._objects[kind].pop(key, None)
+    else:
+      self._objects[kind][key] = obj
+    snapshot = copy.deepcopy(obj)
+    self._log.append((self._rv, kind, event_type, snapshot))
+    for w_kind, namespace, label_selector, field_selector, events in self._watchers:
+      if w_kind == kind and _matches(snapshot, namespace, label_selector, field_selector):
+        events.put((event_type, snapshot))
+
+  def get(self, kind, namespace, name):
+    with self._lock:
+      obj = self._objects[kind].get((namespace, name))
+      return copy.deepcopy(obj) if obj is not None else None
+
+  def list(self, kind, namespace = None, label_selector = None, field_selector = None):
+    with self._lock:
+      items = [copy.deepcopy(obj) for obj in self._objects[kind].values() if _matches(obj, namespace, label_selector, field_selector)]
+      return (str(self._rv), items)
+
+  def create(self, kind, namespace, body):
+    obj = copy.deepcopy(self.to_dict(body))
+    meta = obj.setdefault("metadata", {})
+    if namespace is not None:
+      meta["namespace"] = namespace
+    meta["uid"] = str(uuid.uuid4())
+    meta["creationTimestamp"] = _now_str()
+    with self._lock:
+      if (meta.get("namespace"), meta["name"]) in self._objects[kind]:
+        raise ApiException(status = 409, reason = "AlreadyExists")
+      if kind == "pods":
+        obj["status"] = {"phase": "Pending", "conditions": [{"type": "PodScheduled", "status": "False"}]}
+        self._enqueue(time.time() + self.schedule_delay, "bind", (meta.get("namespace"), meta["name"]))
+      self._commit(kind, "ADDED", obj)
+      return copy.deepcopy(obj)
+
+  # Replaces an object; fails with 409 if body carries a resourceVersion that is no longer current
+  def replace(self, kind, namespace, name, body):
+    obj = copy.deepcopy(self.to_dict(body))
+    with self._lock:
+      old = self._objects[kind].get((namespace, name))
+      if old is None:
+        raise ApiException(status = 404, reason = "NotFound")
+      rv = (obj.get("metadata") or {}).get("resourceVersion")
+      if rv and rv != old["metadata"]["resourceVersion"]:
+        raise ApiException(status = 409, reason = "Conflict")
+      obj.setdefault("metadata", {}).update(namespace = namespace, name = name, uid = old["metadata"]["uid"],
+                                             creationTimestamp = old["metadata"]["creationTimestamp"])
+      self._commit(kind, "MODIFIED", obj)
+      return copy.deepcopy(obj)
+
+  def patch(self, kind, namespace, name, patch):
+    patch = copy.deepcopy(self.to_dict(patch))
+    with self._lock:
+      old = self._objects[kind].get((namespace, name))
+      if old is None:
+        raise ApiException(status = 404, reason = "NotFound")
+      rv = (patch.get("metadata") or {}).pop("resourceVersion", None)
+      if rv and rv != old["metadata"]["resourceVersion"]:
+        raise ApiException(status = 409, reason = "Conflict")
+      obj = copy.deepcopy(old)
+      _merge(obj, patch)
+      self._commit(kind, "MODIFIED", obj)
+      return copy.deepcopy(obj)
+
+  def delete(self, kind, namespace, name, body = None):
+    preconditions = ((self.to_dict(body) or {}).get("preconditions") or {}) if body is not None else {}
+    with self._lock:
+      old = self._objects[kind].get((namespace, name))
+      if old is None:
+        raise ApiException(status = 404, reason = "NotFound")
+      if preconditions.get("uid") and preconditions["uid"] != old["metadata"]["uid"]:
+        raise ApiException(status = 409, reason = "Conflict")
+      self._commit(kind, "DELETED", copy.deepcopy(old))
+      return old
+
+  # Yields {"type", "object"} events like watch.Watch().stream(), until timeout_seconds or stop is set
+  def watch(self, kind, model, namespace = None, label_selector = None, field_selector = None, resource_version = None,
+            timeout_seconds = None, stop = None):
+    events = queue.Queue()
+    with self._lock:
+      expired = resource_version and self._log and self._log[0][0] > int(resource_version) + 1 and int(resource_version) < self._rv
+      if expired:
+        backlog = []
+      elif resource_version:
+        rv = int(resource_version)
+        backlog = [(event_type, obj) for event_rv, event_kind, event_type, obj in self._log
+                   if event_rv > rv and event_kind == kind and _matches(obj, namespace, label_selector, field_selector)]
+      else:
+        backlog = [("ADDED", copy.deepcopy(obj)) for obj in self._objects[kind].values() if _matches(obj, namespace, label_selector, field_selector)]
+      for event in backlog:
+        events.put(event)
+      watcher = (kind, namespace, label_selector, field_selector, events)
+      if not expired:
+        self._watchers.append(watcher)
+    if expired:
+      yield {"type": "ERROR", "object": {"kind": "Status", "code": 410, "reason": "Expired", "message": "too old resource version"}}
+      return
+    deadline = time.time() + timeout_seconds if timeout_seconds else None
+    try:
+      while not (stop is not None and stop.is_set()):
+        wait = 0.1 if deadline is None else min(0.1, deadline - time.time())
+        if wait <= 0:
+          return
+        try:
+          event_type, obj = events.get(timeout = wait)
+        except queue.Empty:
+          continue
+        yield {"type": event_type, "object": self.to_model(obj, model)}
+    finally:
+      with self._lock:
+        self._watchers.remove(watcher)
+
+  ### Scheduler: binds pods to nodes round robin, then starts them
+
+  # Must be called with self._lock held
+  def _enqueue(self, when, action, key):
+    heapq.heappush(self._schedule, (when, next(self._schedule_seq), action, key))
+    if self._scheduler is None:
+      self._scheduler = threading.Thread(target = self._run_scheduler, name = "fake-scheduler", daemon = True)
+      self._scheduler.start()
+    self._schedule_cv.notify()
+
+  def _run_scheduler(self):
+    with self._lock:
+      while True:
+        while not self._schedule or self._schedule[0][0] > time.time():
+          self._schedule_cv.wait(timeout = (self._schedule[0][0] - time.time()) if self._schedule else None)
+        when, seq, action, key = heapq.heappop(self._schedule)
+        pod = self._objects["pods"].get(key)
+        if pod is None:
+          continue
+        pod = copy.deepcopy(pod)
+        if action == "bind":
+          nodes = sorted(name for namespace, name in self._objects["nodes"].keys())
+          if self._node_cycle is None or self._node_cycle[0] != nodes:
+            self._node_cycle = (nodes, itertools.cycle(nodes or [None]))
+          pod["spec"]["nodeName"] = next(self._node_cycle[1]) or "fake-node"
+          pod["status"]["conditions"] = [{"type": "PodScheduled", "status": "True"}]
+          self._commit("pods", "MODIFIED", pod)
+          heapq.heappush(self._schedule, (time.time() + self.start_delay, next(self._schedule_seq), "start", key))
+        elif action == "start":
+          self._start(pod)
+          self._commit("pods", "MODIFIED", pod)
+
+  # Must be called with self._lock held
+  def _start(self, pod):
+    n = next(self._ips)
+    pod["status"].update(phase = "Running", podIP = f"10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}", startTime = _now_str(),
+                         conditions = [{"type": condition, "status": "True"} for condition in ("PodScheduled", "Initialized", "ContainersReady", "Ready")])
+
+  ### Seeding, without latency or events to anyone but watchers
+
+  def add_node(self, name, allocatable, labels = None, taints = None):
+    node = {"metadata": {"name": name, "labels": labels or {}, "uid": str(uuid.uuid4()), "creationTimestamp": _now_str()},
+            "spec": {"taints": taints} if taints else {},
+            "status": {"allocatable": allocatable, "conditions": [{"type": "Ready", "status": "True"}]}}
+    with self._lock:
+      self._commit("nodes", "ADDED", node)
+
+  # Adds an already Running pod (a dict or a V1Pod)
+  def add_running_pod(self, namespace, body, node_name = None):
+    pod = copy.deepcopy(self.to_dict(body))
+    pod["metadata"].update(namespace = namespace, uid = str(uuid.uuid4()), creationTimestamp = _now_str())
+    pod.setdefault("spec", {})["nodeName"] = node_name or "fake-node"
+    pod["status"] = {}
+    with self._lock:
+      self._start(pod)
+      self._commit("pods", "ADDED", pod)
+
+  def add_object(self, kind, namespace, body):
+    obj = copy.deepcopy(self.to_dict(body))
+    obj["metadata"].update(namespace = namespace, uid = str(uuid.uuid4()), creationTimestamp = _now_str())
+    with self._lock:
+      self._commit(kind, "ADDED", obj)
+
+# Loads the podondemand-config ConfigMap (as a dict) out of a deployment file such as podondemand.yaml
+def load_config_map(path, name = "podondemand-config"):
+  with open(path, 'r') as f:
+    for doc in yaml.safe_load_all(f):
+      if doc and doc.get("kind") == "ConfigMap" and doc["metadata"]["name"] == name:
+        return doc
+  raise ValueError(f"No ConfigMap {name} in {path}")
+
+# Base for the fake API classes: turns each method call into a call on the cluster, with latency and counting
+class _FakeApi:
+  def __init__(self, cluster):
+    self.cluster = cluster
+    # frontendd clears the connection pool in forked children; run_pod builds a CoordinationV1Api from this
+    self.api_client = types.SimpleNamespace(fake_cluster = cluster, rest_client = types.SimpleNamespace(pool_manager = types.SimpleNamespace(clear = lambda: None)))
+
+  def _list(self, method, kind, namespace = None, label_selector = None, field_selector = None, **kwargs):
+    rv, items = self.cluster.list(kind, namespace, label_selector, field_selector)
+    self.cluster.call(method, len(items))
+    return self.cluster.to_model({"metadata": {"resourceVersion": rv}, "items": items}, MODELS[kind][1])
+
+  def _read(self, method, kind, name, namespace):
+    self.cluster.call(method)
+    obj = self.cluster.get(kind, namespace, name)
+    if obj is None:
+      raise ApiException(status = 404, reason = "NotFound")
+    return self.cluster.to_model(obj, MODELS[kind][0])
+
+  def _write(self, method, kind, operation, *args):
+    self.cluster.call(method)
+    return self.cluster.to_model(operation(kind, *args), MODELS[kind][0])
+
+class FakeCoreV1Api(_FakeApi):
+  WATCHABLE = {"list_namespaced_pod": "pods", "list_node": "nodes", "list_namespaced_config_map": "configmaps"}
+
+  def list_namespaced_pod(self, namespace, label_selector = None, field_selector = None, **kwargs):
+    return self._list("list_namespaced_pod", "pods", namespace, label_selector, field_selector)
+
+  def read_namespaced_pod(self, name, namespace, **kwargs):
+    return self._read("read_namespaced_pod", "pods", name, namespace)
+
+  def create_namespaced_pod(self, namespace, body, **kwargs):
+    return self._write("create_namespaced_pod", "pods", self.cluster.create, namespace, body)
+
+  def patch_namespaced_pod(self, name, namespace, body, **kwargs):
+    return self._write("patch_namespaced_pod", "pods", self.cluster.patch, namespace, name, body)
+
+  def delete_namespaced_pod(self, name, namespace, body = None, **kwargs):
+    return self._write("delete_namespaced_pod", "pods", self.cluster.delete, namespace, name, body)
+
+  def list_node(self, label_selector = None, field_selector = None, **kwargs):
+    return self._list("list_node", "nodes", None, label_selector, field_selector)
+
+  def read_namespaced_service(self, name, namespace, **kwargs):
+    return self._read("read_namespaced_service", "services", name, namespace)
+
+  def list_namespaced_config_map(self, namespace, label_selector = None, field_selector = None, **kwargs):
+    return self._list("list_namespaced_config_map", "configmaps", namespace, label_selector, field_selector)
+
+  def read_namespaced_config_map(self, name, namespace, **kwargs):
+    return self._read("read_namespaced_config_map", "configmaps", name, namespace)
+
+  def create_namespaced_config_map(self, namespace, body, **kwargs):
+    return self._write("create_namespaced_config_map", "configmaps", self.cluster.create, namespace, body)
+
+  def replace_namespaced_config_map(self, name, namespace, body, **kwargs):
+    return self._write("replace_namespaced_config_map", "configmaps", self.cluster.replace, namespace, name, body)
+
+class FakeCoordinationV1Api(_FakeApi):
+  WATCHABLE = {"list_namespaced_lease": "leases"}
+
+  def list_namespaced_lease(self, namespace, label_selector = None, field_selector = None, **kwargs):
+    return self._list("list_namespaced_lease", "leases", namespace, label_selector, field_selector)
+
+  def read_namespaced_lease(self, name, namespace, **kwargs):
+    return self._read("read_namespaced_lease", "leases", name, namespace)
+
+  def create_namespaced_lease(self, namespace, body, **kwargs):
+    return self._write("create_namespaced_lease", "leases", self.cluster.create, namespace, body)
+
+  def replace_namespaced_lease(self, name, namespace, body, **kwargs):
+    return self._write("replace_namespaced_lease", "leases", self.cluster.replace, namespace, name, body)
+
+  def patch_namespaced_lease(self, name, namespace, body, **kwargs):
+    return self._write("patch_namespaced_lease", "leases", self.cluster.patch, namespace, name, body)
+
+  def delete_namespaced_lease(self, name, namespace, **kwargs):
+    return self._write("delete_namespaced_lease", "leases", self.cluster.delete, namespace, name)
+
+# Replaces watch.Watch for list methods of the fake APIs (including through metrics.InstrumentedApi)
+class FakeWatch:
+  def __init__(self, *args, **kwargs):
+    self._stop = threading.Event()
+
+  def stop(self):
+    self._stop.set()
+
+  def stream(self, func, *args, **kwargs):
+    target = getattr(func, '__wrapped__', func)
+    api = target.__self__
+    kind = api.WATCHABLE[target.__name__]
+    api.cluster.call(target.__name__ + "(watch)")
+    namespace = kwargs.get("namespace", args[0] if args else None)
+    return api.cluster.watch(kind, MODELS[kind][0], namespace, kwargs.get("label_selector"), kwargs.get("field_selector"),
+                             kwargs.get("resource_version"), kwargs.get("timeout_seconds"), self._stop)
+
+# Points the kubernetes client at `cluster` for the rest of the process
+def install(cluster):
+  config.load_incluster_config = lambda *args, **kwargs: None
+  client.CoreV1Api = lambda api_client = None: FakeCoreV1Api(cluster)
+  client.CoordinationV1Api = lambda api_client = None: FakeCoordinationV1Api(cluster)
+  watch.Watch = FakeWatch
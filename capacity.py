@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+from kubernetes import utils
+
+from podcache import PodInformer, NodeInformer
+
+# Admission check for new user pods: can a pod of a given type be scheduled anywhere right now? Without it, a pod
+# that doesn't fit (eg. every GPU is taken) sits Pending until run_pod's spawn deadline, tying up the user's session.
+# Nodes and user pods are kept in watch-fed caches (podcache) by a long-lived process (frontendd), which hands each
+# login a CapacitySnapshot taken just before forking. Per node, free resources are its allocatable resources minus
+# the requests of the user pods on it; a pod type fits on a node that is Ready, schedulable, matches its nodeSelector
+# and required node affinity, tolerates the node's NoSchedule/NoExecute taints and has room for its requests.
+# Other workloads on the nodes aren't counted, so a "fits" answer is optimistic (the spawn deadline still applies),
+# but a "doesn't fit" answer is certain.
+
+# Returns {resource: Decimal} that a pod with these containers requests, as the scheduler counts it: per container,
+# requests (or limits, which requests default to); the sum over containers or the largest init container, whichever
+# is larger; plus one "pods" slot. `resources` is a function returning (requests, limits) dicts for a container.
+def _sum_requests(containers, init_containers, resources):
+  def container_requests(container):
+    requests, limits = resources(container)
+    merged = dict(limits or {})
+    merged.update(requests or {})
+    return {name: utils.parse_quantity(quantity) for name, quantity in merged.items()}
+  total = {"pods": 1}
+  for container in containers or []:
+    for name, amount in container_requests(container).items():
+      total[name] = total.get(name, 0) + amount
+  for container in init_containers or []:
+    for name, amount in container_requests(container).items():
+      total[name] = max(total.get(name, 0), amount)
+  return total
+
+# Requests of a pod manifest (a dict, as in podManifests)
+def manifest_requests(spec):
+  return _sum_requests(spec.get("containers"), spec.get("initContainers"),
+                       lambda c: ((c.get("resources") or {}).get("requests"), (c.get("resources") or {}).get("limits")))
+
+# Requests of a V1Pod
+def pod_requests(pod):
+  return _sum_requests(pod.spec.containers, pod.spec.init_containers,
+                       lambda c: (c.resources.requests, c.resources.limits) if c.resources else (None, None))
+
+def _node_ready(node):
+  if node.spec and node.spec.unschedulable:
+    return False
+  return any(c.type == "Ready" and c.status == "True" for c in (node.status.conditions or []))
+
+def _tolerates(tolerations, taint):
+  for toleration in tolerations or []:
+    if toleration.get("effect") and toleration["effect"] != taint.effect:
+      continue
+    if toleration.get("operator", "Equal") == "Exists":
+      if not toleration.get("key") or toleration["key"] == taint.key:
+        return True
+    elif toleration.get("key") == taint.key and str(toleration.get("value") or "") == (taint.value or ""):
+      return True
+  return False
+
+def _matches_expression(labels, expression):
+  key, operator, values = expression.get("key"), expression.get("operator"), [str(v) for v in expression.get("values") or []]
+  if operator == "In":
+    return labels.get(key) in values
+  if operator == "NotIn":
+    return labels.get(key) not in values
+  if operator == "Exists":
+    return key in labels
+  if operator == "DoesNotExist":
+    return key not in labels
+  if operator in ("Gt", "Lt") and key in labels and values:
+    try:
+      value, bound = int(labels[key]), int(values[0])
+    except ValueError:
+      return False
+    return value > bound if operator == "Gt" else value < bound
+  return False
+
+# Whether the node passes the manifest's nodeSelector, required node affinity and tolerations (not resources)
+def node_matches(spec, node):
+  labels = node.metadata.labels or {}
+  if any(labels.get(key) != str(value) for key, value in (spec.get("nodeSelector") or {}).items()):
+    return False
+  required = (((spec.get("affinity") or {}).get("nodeAffinity") or {}).get("requiredDuringSchedulingIgnoredDuringExecution") or {})
+  terms = required.get("nodeSelectorTerms")
+  if terms and not any(all(_matches_expression(labels, e) for e in term.get("matchExpressions") or []) for term in terms):
+    return False
+  taints = (node.spec.taints if node.spec else None) or []
+  return all(_tolerates(spec.get("tolerations"), taint) for taint in taints if taint.effect in ("NoSchedule", "NoExecute"))
+
+# An immutable view of the cluster's capacity at one point in time, safe to use after fork(). Taking one only copies
+# the cached lists; free resources are worked out on first use, so only logins that create a pod pay for it.
+class CapacitySnapshot:
+  def __init__(self, nodes, pods):
+    self._nodes = nodes
+    self._pods = pods
+    self.nodes = None
+    self.free = None # node name -> {resource: Decimal}
+
+  def _compute(self):
+    nodes, pods = self._nodes, self._pods
+    self.nodes = [node for node in nodes if _node_ready(node)]
+    self.free = {}
+    for node in self.nodes:
+      self.free[node.metadata.name] = {name: utils.parse_quantity(q) for name, q in (node.status.allocatable or {}).items()}
+    for pod in pods:
+      # Pods that aren't bound to a node yet, or have finished, don't hold any node's resources
+      free = self.free.get(pod.spec.node_name) if pod.spec else None
+      if free is None or (pod.status and pod.status.phase in ("Succeeded", "Failed")):
+        continue
+      for name, amount in pod_requests(pod).items():
+        if name in free:
+          free[name] -= amount
+
+  # Returns (how many more pods of this manifest fit right now, how many nodes it could run on at all)
+  def availability(self, spec):
+    if self.free is None:
+      self._compute()
+    requests = manifest_requests(spec)
+    count = 0
+    matching = 0
+    for node in self.nodes:
+      if not node_matches(spec, node):
+        continue
+      free = self.free[node.metadata.name]
+      if any(name not in free for name, amount in requests.items() if amount > 0):
+        continue # The node doesn't offer this resource at all (eg. no GPUs)
+      matching += 1
+      count += int(min((free[name] // amount for name, amount in requests.items() if amount > 0), default = 0))
+    return (max(0, count), matching)
+
+  # Returns {podtype: number of pods of that type that fit right now}, from the compiled podconfig templates
+  def availability_by_type(self, templates):
+    return {podtype: self.availability(template.manifest["spec"])[0] for podtype, template in templates.items()}
+
+# The watch-fed node and user pod caches behind CapacitySnapshot
+class CapacityCache:
+  def __init__(self, v1, namespace):
+    self.node_informer = NodeInformer(v1)
+    self.pod_informer = PodInformer(v1, namespace)
+
+  def start(self):
+    self.node_informer.start()
+    self.pod_informer.start()
+    return self
+
+  def stop(self):
+    self.node_informer.stop()
+    self.pod_informer.stop()
+
+  # Returns a CapacitySnapshot, or None if the caches haven't loaded yet (admission is then skipped). Waits up to
+  # `timeout` seconds for them to load.
+  def snapshot(self, timeout = 0):
+    if not (self.node_informer.wait_for_sync(timeout) and self.pod_informer.wait_for_sync(timeout)):
+      return None
+    return CapacitySnapshot(self.node_informer.pods(), self.pod_informer.pods())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+import sys
+import time
+import struct
+import socket
+import ipaddress
+import collections
+
+# Fast scanner for established TCP connections, used to detect activity on user pods.
+# psutil.net_connections() walks every fd of every process to attribute sockets to pids and builds an object per
+# socket; we only need the set of remote addresses, which the kernel already lists per network namespace in
+# /proc/net/tcp and /proc/net/tcp6. Those are read in bulk and only ESTABLISHED rows are decoded.
+
+PROC_TCP_PATHS = ("/proc/net/tcp", "/proc/net/tcp6")
+TCP_ESTABLISHED = "01" # include/net/tcp_states.h
+
+# Cache of hex address -> printable ip, since many sockets share the same remote host
+_addr_cache = {}
+
+# Decodes the hex remote address of a /proc/net/tcp{,6} row (without the port) into a printable ip.
+# IPv4-mapped IPv6 addresses are returned as plain IPv4, so they compare equal to pod.status.pod_ip.
+def decode_address(hexaddr):
+  ip = _addr_cache.get(hexaddr)
+  if ip is not None:
+    return ip
+  raw = bytes.fromhex(hexaddr)
+  if len(raw) == 4:
+    ip = socket.inet_ntop(socket.AF_INET, raw[::-1]) # Stored as a host-endian (little-endian) 32-bit word
+  else:
+    # Four host-endian 32-bit words
+    raw = b''.join(raw[i:i + 4][::-1] for i in range(0, 16, 4))
+    if raw[:12] == b'\x00' * 10 + b'\xff\xff':
+      ip = socket.inet_ntop(socket.AF_INET, raw[12:])
+    else:
+      ip = socket.inet_ntop(socket.AF_INET6, raw)
+  if len(_addr_cache) > 65536:
+    _addr_cache.clear()
+  _addr_cache[hexaddr] = ip
+  return ip
+
+# Returns the set of remote ip addresses with an ESTABLISHED TCP connection in this network namespace.
+# If cidrs (a list of ipaddress networks or strings, eg. the pod CIDR) is given, only addresses inside them are returned.
+def established_remote_ips(cidrs = None, paths = PROC_TCP_PATHS):
+  hexaddrs = set()
+  for path in paths:
+    try:
+      with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    except FileNotFoundError: # eg. IPv6 disabled
+      continue
+    for line in lines[1:]: # Skip the header
+      fields = line.split(None, 4)
+      if len(fields) >= 4 and fields[3] == TCP_ESTABLISHED:
+        hexaddrs.add(fields[2].split(':', 1)[0])
+
+  ips = {decode_address(h) for h in hexaddrs}
+  if cidrs:
+    networks = [ipaddress.ip_network(c) if isinstance(c, str) else c for c in cidrs]
+    ips = {ip for ip in ips if any(ipaddress.ip_address(ip) in network for network in networks)}
+  return ips
+
+# Per-connection byte counters, from the kernel's sock_diag netlink interface (the same source as "ss -ti"): one
+# dump request returns tcp_info for every ESTABLISHED socket, without running a process or reading any files.
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+INET_DIAG_INFO = 2
+TCPI_BYTES_ACKED = 120 # Offsets in struct tcp_info (include/uapi/linux/tcp.h); both need Linux 4.2 or later
+TCPI_BYTES_RECEIVED = 128
+
+def _sock_diag_dump(family):
+  # struct inet_diag_req_v2: family, protocol, ext, pad, states, then an all-zero inet_diag_sockid (match any)
+  req = struct.pack('=BBBxI', family, socket.IPPROTO_TCP, 1 << (INET_DIAG_INFO - 1), 1 << int(TCP_ESTABLISHED)) + b'\x00' * 48
+  msg = struct.pack('=IHHII', 16 + len(req), SOCK_DIAG_BY_FAMILY, NLM_F_REQUEST | NLM_F_DUMP, 1, 0) + req
+  with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_SOCK_DIAG) as nl:
+    nl.sendall(msg)
+    while True:
+      data = nl.recv(1 << 20)
+      offset = 0
+      while offset + 16 <= len(data):
+        length, msg_type = struct.unpack_from('=IH', data, offset)
+        if msg_type == NLMSG_DONE:
+          return
+        if msg_type == NLMSG_ERROR:
+          raise OSError(-struct.unpack_from('=i', data, offset + 16)[0], "sock_diag request failed")
+        yield data[offset + 16:offset + length]
+        offset += (length + 3) & ~3
+
+# Returns {socket cookie: (remote ip, bytes sent and acknowledged + bytes received)} for every ESTABLISHED TCP
+# connection in this network namespace. Raises OSError if sock_diag is unavailable.
+def connection_bytes(cidrs = None):
+  conns = {}
+  networks = [ipaddress.ip_network(c) if isinstance(c, str) else c for c in cidrs] if cidrs else None
+  for family in (socket.AF_INET, socket.AF_INET6):
+    for payload in _sock_diag_dump(family):
+      # struct inet_diag_msg: family, state, timer, retrans, then inet_diag_sockid (ports, src[16], dst[16], if, cookie[2])
+      dst = payload[24:40]
+      cookie = payload[44:52]
+      if family == socket.AF_INET or dst[:12] == b'\x00' * 10 + b'\xff\xff':
+        ip = socket.inet_ntop(socket.AF_INET, dst[12:16] if family == socket.AF_INET6 else dst[:4])
+      else:
+        ip = socket.inet_ntop(socket.AF_INET6, dst)
+      if networks is not None and not any(ipaddress.ip_address(ip) in network for network in networks):
+        continue
+      # Attributes (struct nlattr) follow the 72-byte inet_diag_msg
+      offset = 72
+      while offset + 4 <= len(payload):
+        attr_len, attr_type = struct.unpack_from('=HH', payload, offset)
+        if attr_len < 4:
+          break
+        if attr_type == INET_DIAG_INFO and attr_len - 4 >= TCPI_BYTES_RECEIVED + 8:
+          acked, received = struct.unpack_from('=QQ', payload, offset + 4 + TCPI_BYTES_ACKED)
+          conns[cookie] = (ip, acked + received)
+        offset += (attr_len + 3) & ~3
+  return conns
+
+# Measures how many bytes each remote ip exchanged over a sliding window, from successive connection_bytes()
+# samples. Connections that close between samples only lose the traffic since the last sample.
+class TrafficMeter:
+  def __init__(self):
+    self._last = None # socket cookie -> byte count at the last sample
+    self._history = collections.defaultdict(collections.deque) # ip -> deque of (time, bytes)
+
+  # Takes a sample. Returns the set of remote ips that currently have an ESTABLISHED connection.
+  def sample(self, cidrs = None, now = None):
+    now = time.time() if now is None else now
+    conns = connection_bytes(cidrs)
+    deltas = collections.defaultdict(int)
+    for cookie, (ip, count) in conns.items():
+      # A connection opened since the last sample counts from zero; the first sample is only a baseline
+      deltas[ip] += count - (self._last.get(cookie, 0) if self._last is not None else count)
+    self._last = {cookie: count for cookie, (ip, count) in conns.items()}
+    for ip, delta in deltas.items():
+      if delta > 0:
+        self._history[ip].append((now, delta))
+    return set(deltas.keys())
+
+  # Returns the bytes exchanged with ip over the last `window` seconds, and drops older samples
+  def bytes_in_window(self, ip, window, now = None):
+    now = time.time() if now is None else now
+    history = self._history.get(ip)
+    if not history:
+      return 0
+    while history and history[0][0] < now - window:
+      history.popleft()
+    if not history:
+      del self._history[ip]
+      return 0
+    return sum(delta for t, delta in history)
+
+  # Drops ips that have no connections anymore and no traffic within `window`
+  def prune(self, window, now = None):
+    now = time.time() if now is None else now
+    for ip in list(self._history.keys()):
+      self.bytes_in_window(ip, window, now)
+
+# Parses a comma-separated list of CIDRs (eg. the "podCIDR" config value) into networks. Returns None if empty.
+def parse_cidrs(cidr_str):
+  if not cidr_str:
+    return None
+  return [ipaddress.ip_network(c.strip()) for c in cidr_str.split(',') if c.strip()]
+
+if __name__ == "__main__":
+  for ip in sorted(established_remote_ips(parse_cidrs(sys.argv[1]) if len(sys.argv) > 1 else None)):
+    print(ip)
@@ -2,83 +2,145 @@
 
 ### Reads and uses the PodOnDemand frontend as would a normal user, to test that all available options work correctly.
 # Note: this does NOT test cases where:
-# • A user specifies the name of another user's pod to delete
+# • A user specifies the name of another user's pod to delete
+#
+# Test cases are independent, so they run concurrently, each under its own test user (--users; every one of them
+# must be able to "ssh <user>@<host>" to the frontend). Each user only ever has the one pod of the case it is
+# running, so cases never see each other's pods. Waits follow the user's pods through "--list --watch" rather than
+# polling --list.
+#
+# Timeouts are tested by actually waiting for them. On a test cluster whose podondemand-config sets reaperTimeScale,
+# pass the same value as --time-scale. The timeouts and network activity durations of the cases (--timeouts,
+# --network-durations) are as the reaper sees them; the test only waits for them that many times less. Pod startup
+# can't be sped up, though, so with a scale the durations must be longer: eg. with --time-scale 60,
+# "--timeouts=-5,0,1800 --network-durations 0,600,2400" checks a 30 minute timeout in about 30 seconds.
+# Before the cases run, one pod is spawned to measure how long startup takes, and a run whose scaled timeouts or
+# network activity would be over before a pod could even be Running is rejected.
 
 import yaml
 import argparse
 import sys
 import subprocess
 from covertable import make, sorters, criteria
-import re
 import time
 import io
 import shlex
+import json
+import threading
+import queue
+import concurrent.futures
+
+print_lock = threading.Lock()
+
+
+# One test user's connection to the frontend
+class Session:
+  def __init__(self, user, host):
+    self.user = user
+    self.host = host
+    self.watch = None
+
+  def log(self, msg):
+    with print_lock:
+      print(f"[{self.user or self.host}] {msg}", flush = True)
+
+  def ssh_args(self):
+    return ['ssh'] + (['-l', self.user] if self.user else []) + [self.host, '--']
+
+  # Accepts arguments as a list (eg ['--type', 'cpu'])
+  def run_podondemand_cmd(self, args: list, show = True):
+    if show:
+      self.log("  Running PodOnDemand command: " + str(args))
+    proc = subprocess.Popen(self.ssh_args() + [str(s) for s in args], stdout = subprocess.PIPE, stderr = subprocess.PIPE, text = True)
+    out, err = proc.communicate(timeout = 120)
+    if proc.returncode != 0:
+      self.log("Error in run_podondemand_cmd: " + str(args))
+      self.log("  Stdout: " + out)
+      self.log("  Stderr: " + err)
+      raise subprocess.CalledProcessError(returncode = proc.returncode, cmd = " ".join(self.ssh_args()) + " " + str(args))
+    return out
+
+  def run_on_remote_pod(self, connection_cmd: str, argstr: str):
+    self.log("  Running command on remote pod: " + argstr)
+    basecmd = shlex.split(connection_cmd + ' -o "StrictHostKeyChecking no"' + " --") # Returns a list of arguments
+    completed = subprocess.run(basecmd + [argstr], capture_output = True, timeout = 120, text = True)
+    if completed.returncode != 0:
+      self.log("Error in run_on_remote_pod: " + str(argstr))
+      self.log("  Stdout: " + completed.stdout)
+      self.log("  Stderr: " + completed.stderr)
+      raise subprocess.CalledProcessError(returncode = completed.returncode, cmd = argstr)
+    return completed.stdout
+
+  # Starts following this user's pods, after deleting any left over from an earlier run
+  def open(self):
+    self.run_podondemand_cmd(['--delete-all', '--wait'])
+    self.watch = PodWatch(self)
+    self.watch.wait_for(lambda pods: len(pods) == 0, timeout = 60, what = "no pods")
+
+  # Deletes whatever pods the user still has, if any (eg. one the reaper may be deleting already), and waits until
+  # they are gone. Unlike --delete <name>, this doesn't fail if the pod is already gone.
+  def clear(self):
+    self.run_podondemand_cmd(['--delete-all', '--wait'])
+    self.watch.wait_for(lambda pods: len(pods) == 0, timeout = 60, what = "no pods")
+
+  def close(self):
+    if self.watch is not None:
+      self.watch.close()
+
+
+# Follows a user's pods through "--list --watch" (one JSON event per line), so tests can wait for a pod to appear,
+# start or disappear as soon as it happens.
+class PodWatch:
+  def __init__(self, session):
+    self.session = session
+    self.pods = {} # name -> the pod's --list summary
+    self.synced = False
+    self.changed = threading.Condition()
+    self.proc = subprocess.Popen(session.ssh_args() + ['--list', '--watch'], stdin = subprocess.PIPE, stdout = subprocess.PIPE, text = True)
+    self.thread = threading.Thread(target = self._read, daemon = True)
+    self.thread.start()
+
+  def _read(self):
+    for line in self.proc.stdout:
+      try:
+        event = json.loads(line)
+      except ValueError:
+        continue # Not an event (eg. a login banner)
+      with self.changed:
+        if event['type'] == "SYNCED":
+          self.synced = True
+        elif event['type'] == "DELETED":
+          self.pods.pop(event['pod']['name'], None)
+        else:
+          self.pods[event['pod']['name']] = event['pod']
+        self.changed.notify_all()
+    self.proc.wait()
+    with self.changed: # The stream ended; wake up any waiters so they fail rather than hang
+      self.changed.notify_all()
+
+  # Waits until predicate(pods) is true, and returns a copy of the pods. Fails if it isn't within `timeout` seconds.
+  def wait_for(self, predicate, timeout, what = "condition"):
+    deadline = time.time() + timeout
+    with self.changed:
+      while not (self.synced and predicate(self.pods)):
+        remaining = deadline - time.time()
+        assert self.proc.poll() is None, "pod watch ended unexpectedly"
+        assert remaining > 0, f"timed out after {timeout}s waiting for {what}; pods: {json.dumps(self.pods)}"
+        self.changed.wait(remaining)
+      return dict(self.pods)
+
+  def get_pod_list(self):
+    return self.wait_for(lambda pods: True, timeout = 60)
+
+  def close(self):
+    self.proc.terminate()
+    self.proc.wait()
 
 
-
-# Accepts arguments as a list (eg ['--type', 'cpu'])
-def run_podondemand_cmd(args: list, show = True):
-  if show:
-    print("  Running PodOnDemand command: " + str(args))
-  #output = io.StringIO('/tmp/pod_test')
-  proc = subprocess.Popen(['ssh', 'podondemand', '--'] + [str(s) for s in args], stdout = subprocess.PIPE, stderr = subprocess.PIPE, text = True)
-  out, err = proc.communicate(timeout = 120)
-  if proc.returncode != 0:
-    print("Error in run_podondemand_cmd: " + str(args))
-    print("  Stdout: " + out) #completed.stdout)
-    print("  Stderr: " + err) #completed.stderr)
-    raise subprocess.CalledProcessError(returncode = proc.returncode, cmd = "ssh podondemand -- " + str(args))
-  #print("  Stdout: " + out)
-  #print("  Stderr: " + err)
-  return out #completed.stdout
-
-def run_on_remote_pod(connection_cmd: str, argstr: str):
-  print("  Running command on remote pod: " + argstr)
-  basecmd = shlex.split(connection_cmd + ' -o "StrictHostKeyChecking no"' + " --") # Returns a list of arguments
-  completed = subprocess.run(basecmd + [argstr], capture_output = True, timeout = 120, text = True)
-  if completed.returncode != 0:
-    print("Error in run_podondemand_cmd: " + str(argstr))
-    print("  Stdout: " + completed.stdout)
-    print("  Stderr: " + completed.stderr)
-    raise subprocess.CalledProcessError()
-  return completed.stdout
-
-
-def get_pod_list(show = True):
-  # Check if it is running and healthy in the --list
-  output = run_podondemand_cmd(['--list'], show = show)
-  # Eliminate the "Your pods:" line
-  output = '\n'.join(output.split('\n')[1:])
-
-  # Find listed attributes
-  list_dict = {}
-  pod_entries = re.split(r'^=== ', output, flags = re.MULTILINE)
-  for entry in pod_entries:
-    if entry == '':
-      continue
-    pod_name = entry.split(' ')[0]
-    list_dict[pod_name] = {}
-    for param in re.findall(r'([A-Za-z0-9]+): (.*)', entry):
-      list_dict[pod_name][param[0]] = param[1]
-
-    # Find given commands
-    ssh_cmd = re.search('(ssh .*$)', entry, flags = re.MULTILINE)
-    assert len(ssh_cmd.groups()) > 0
-    ssh_cmd = ssh_cmd.group(1)
-
-    sftp_cmd = re.search('(sftp .*$)', entry, flags = re.MULTILINE)
-    assert len(sftp_cmd.groups()) > 0
-    sftp_cmd = sftp_cmd.group(1)
-
-    list_dict[pod_name]['ssh_cmd'] = ssh_cmd
-    list_dict[pod_name]['sftp_cmd'] = sftp_cmd
-
-  return list_dict
-
 # Note that spawn_pod does not have any particular timeout for when it takes too long to spawn,
 # although this is not really in the requirements either. A notably long time, however, could indicate a problem
-def spawn_pod(type, storage, timeout = None):
-  print(f"  Spawning pod with type={type}, storage={storage}, timeout={timeout}...")
+def spawn_pod(session, type, storage, timeout = None):
+  session.log(f"  Spawning pod with type={type}, storage={storage}, timeout={timeout}...")
   # Spawn the pod
   extra_args = []
   if timeout:
@@ -87,30 +149,32 @@ def spawn_pod(type, storage, timeout = None):
     extra_args += ['--type', type]
   if storage is not None:
     extra_args += ['--storage', storage]
-  output = run_podondemand_cmd(extra_args)
+  output = session.run_podondemand_cmd(extra_args)
   assert ' --- CONNECT' in output.upper()
 
+# Waits until the (only) pod of the session is listed as Running, and returns its name and --list summary
+def wait_for_running_pod(session):
+  res = session.watch.wait_for(lambda pods: len(pods) == 1 and list(pods.values())[0]['status'] == 'Running', timeout = 60, what = "a Running pod")
+  podname = list(res.keys())[0]
+  return podname, res[podname]
+
 # Deletes the pod, and waits for it to be fully deleted.
-def delete_pod(name):
-  print(f"  Deleting pod {name}...")
-  output = run_podondemand_cmd(['--delete', name])
-  assert "### DELETING POD " + name.upper() in output.upper()
-  print("  Waiting for pod to be deleted...")
-  t1 = time.time()
-  timediff = 0
-  while name in list(get_pod_list(show = False).keys()) and timediff < 45: # TODO: this currently assumes the default Kubernetes timeout of 30 seconds (with an extra 10 for it actually killing it, and then an extra 5 for some leeway)
-    time.sleep(2)
-    timediff = time.time() - t1
-  assert timediff < 45
-  
+def delete_pod(session, name):
+  session.log(f"  Deleting pod {name}...")
+  output = session.run_podondemand_cmd(['--delete', name])
+  assert f"### {name}: deleted" in output
+  session.log("  Waiting for pod to be deleted...")
+  # TODO: this currently assumes the default Kubernetes timeout of 30 seconds (with an extra 10 for it actually killing it, and then an extra 5 for some leeway)
+  session.watch.wait_for(lambda pods: not name in pods, timeout = 45, what = f"{name} to be deleted")
+
 #def test_pod_ https://github.com/walkframe/covertable/blob/master/python/README.rst
-  
+
 
 # An error could occur eg. if the value was negative
-def test_pod_timeout_expect_error(type, storage, timeout):
-  print(f"test_pod_timeout_expect_error: type: {type}, storage: {storage}, timeout: {timeout}")
+def test_pod_timeout_expect_error(session, type, storage, timeout):
+  session.log(f"test_pod_timeout_expect_error: type: {type}, storage: {storage}, timeout: {timeout}")
   try:
-    spawn_pod(type = type, storage = storage, timeout = timeout)
+    spawn_pod(session, type = type, storage = storage, timeout = timeout)
   except Exception as e:
     return
   assert False
@@ -118,81 +182,143 @@ def test_pod_timeout_expect_error(type, storage, timeout):
 # Tests that the pod's timeout resorts to the default when not specified or specified as 0.
 # If the default timeout is not specified on the command line for this script, this test will not be run.
 # Just tests for the actual value of the timeout as assigned to the pod, but does not measure it explicitly.
-def test_pod_timeout_default(type, storage, default_timeout):
-  print(f"test_pod_timeout_default: storage: {storage}, default_timeout: {default_timeout}")
-  spawn_pod(type = type, storage = storage)
-  res = get_pod_list()
-  assert len(res) == 1 # For now...
-  podname = list(res.keys())[0]
-  podinfo = res[podname]
-  assert podinfo['timeout'] == str(default_timeout) + " seconds"
-  delete_pod(podname)
+def test_pod_timeout_default(session, type, storage, default_timeout):
+  session.log(f"test_pod_timeout_default: storage: {storage}, default_timeout: {default_timeout}")
+  spawn_pod(session, type = type, storage = storage)
+  podname, podinfo = wait_for_running_pod(session)
+  assert podinfo['timeout_seconds'] == int(default_timeout)
+  delete_pod(session, podname)
 
 
 # Holds open a network connection to the pod for a specified number of seconds, then checks if the pod exists.
 # The pod should exist both if it waited until before and after its timeout
-def test_pod_exists_after_network_activity_duration(type, storage, timeout, network_activity_duration = 0):
-  print(f"test_pod_exists_after_network_activity_duration: type: {type}, storage: {storage}, timeout: {timeout}, network: {network_activity_duration}")
-  #assert network_activity_wait > timeout
+def test_pod_exists_after_network_activity_duration(session, type, storage, timeout, network_activity_duration = 0, time_scale = 1):
+  session.log(f"test_pod_exists_after_network_activity_duration: type: {type}, storage: {storage}, timeout: {timeout}, network: {network_activity_duration}")
   t1 = time.time()
-  res = spawn_pod(type = type, storage = storage, timeout = timeout)
-  res = get_pod_list()
-  podname = list(res.keys())[0]
-  podinfo = res[podname]
-  assert len(res) == 1
+  spawn_pod(session, type = type, storage = storage, timeout = timeout)
+  podname, podinfo = wait_for_running_pod(session)
   t2 = time.time()
   if network_activity_duration > 0:
-    waitTime = max(0,network_activity_duration - (t2-t1)) # Compensate for startup time
+    waitTime = max(0, network_activity_duration / time_scale - (t2-t1)) # Compensate for startup time
     if waitTime == 0:
-      print("Error: test_pod_exists_under_timeout sampled after the timeout interval ended (startup took too long). Please increase the timeout value")
+      session.log("Error: test_pod_exists_under_timeout sampled after the timeout interval ended (startup took too long). Please increase the timeout value")
       assert False
-    print(f"  Waiting {waitTime} seconds in simulated network activity before checking if pod still exists...")
-    run_on_remote_pod(connection_cmd = podinfo['ssh_cmd'], argstr = f"sleep {waitTime}") # Opens a network connection on the pod for n seconds
-  #time.sleep(waitTime)
-  res = get_pod_list()
-  podname = list(res.keys())[0]
-  podinfo = res[podname]
-  assert len(res) == 1 # For now...
-  #print(res)
-  assert podinfo['status'] == 'Running'
-  delete_pod(podname) # Cleanup
+    session.log(f"  Waiting {waitTime:.1f} seconds in simulated network activity before checking if pod still exists...")
+    session.run_on_remote_pod(connection_cmd = podinfo['ssh_command'], argstr = f"sleep {waitTime:.2f}") # Opens a network connection on the pod for n seconds
+  res = session.watch.get_pod_list()
+  assert len(res) == 1
+  assert res[podname]['status'] == 'Running'
+  delete_pod(session, podname) # Cleanup
 
 
 
-# Tests that a pod is deleted after its timeout. sample_time is the absolute time, in seconds, it should wait after the initial SPAWN
-# of the pod to check if it exists
+# Tests that a pod is deleted after its timeout. sample_time is the time, in seconds, it should wait after the pod was last
+# active (its SPAWN, or the end of the network activity) to check if it exists
 # Failure to delete the pod or put it in a Terminating state can indicate a problem with the garbage collector daemon
 # NOTE: Automatically compensates for network_activity_duration
-def test_pod_deleted_after_timeout(type, storage, timeout, sample_time, network_activity_duration):
-  print(f"test_pod_deleted_after_timeout: type: {type}, storage: {storage}, timeout: {timeout}, sample_time: {sample_time}, network: {network_activity_duration}")
+# With a time_scale, all of these are as the reaper sees them: the test waits that many times less.
+def test_pod_deleted_after_timeout(session, type, storage, timeout, sample_time, network_activity_duration, time_scale = 1):
+  session.log(f"test_pod_deleted_after_timeout: type: {type}, storage: {storage}, timeout: {timeout}, sample_time: {sample_time}, network: {network_activity_duration}")
   assert sample_time > timeout
   t1 = time.time()
-  spawn_pod(type = type, storage = storage, timeout = timeout)
-  res = get_pod_list()
-  podname = list(res.keys())[0]
-  podinfo = res[podname]
-  assert len(get_pod_list()) == 1
+  spawn_pod(session, type = type, storage = storage, timeout = timeout)
+  podname, podinfo = wait_for_running_pod(session)
   t2 = time.time()
-  waitTime = max(0,sample_time - (t2-t1)) # Compensate for startup time
+  waitTime = max(0, sample_time / time_scale - (t2-t1)) # Compensate for startup time
   if waitTime == 0:
-    print("  Error: test_pod_deleted_after_timeout: startup took longer than sample_time. Please increase the timeout value")
+    session.log("  Error: test_pod_deleted_after_timeout: startup took longer than sample_time. Please increase the timeout value")
     assert False
+  # The pod was created after t1, so its inactivity can't have started any earlier; with network activity, not before
+  # the connection was opened, and it may have lasted until the connection was closed
+  earliest_idle = t1
+  latest_idle = t1
   if network_activity_duration > 0:
-    print(f"  Waiting {network_activity_duration} seconds in simulated network activity...")
-    run_on_remote_pod(connection_cmd = podinfo['ssh_cmd'], argstr = f"sleep {network_activity_duration}") # Opens a network connection on the pod for n seconds
-  print(f"  Waiting {waitTime} seconds before checking if pod is deleted...")
-  time.sleep(waitTime)
-  res = get_pod_list()
-  assert len(res) <= 1 # For now...
-  if len(res) == 0: # If there are no pods running anymore, it is good
-    return
-  podinfo = res[list(res.keys())[0]]
+    session.log(f"  Waiting {network_activity_duration / time_scale:.1f} seconds in simulated network activity...")
+    earliest_idle = time.time()
+    session.run_on_remote_pod(connection_cmd = podinfo['ssh_command'], argstr = f"sleep {network_activity_duration / time_scale:.2f}") # Opens a network connection on the pod for n seconds
+    latest_idle = time.time()
+  deadline = latest_idle + sample_time / time_scale
+  session.log(f"  Waiting up to {max(0, deadline - time.time()):.1f} seconds for the pod to be deleted...")
+  # We just want to know if deletion was triggered (either deleted or Terminating)
+  session.watch.wait_for(lambda pods: not podname in pods or pods[podname]['status'].split(' ')[0] == 'Terminating',
+                         timeout = max(0, deadline - time.time()), what = f"{podname} to be deleted after its timeout")
+  # ...and not before its timeout
+  assert time.time() - earliest_idle >= timeout / time_scale, f"{podname} was deleted {time.time() - earliest_idle:.1f}s after it was last active, before its timeout"
+
+  session.clear() # The pod may already be gone, or still terminating
+# a problem with the network connection detector, or a reminicent network connection of sorts
 
-  # If there is one pod that is currently terminating, it is also good.
-  assert len(res) == 0 or podinfo['status'].split(' ')[0] == 'Terminating' # We just want to know if deletion was triggered (either deleted or Terminating)
 
-  delete_pod(list(res.keys())[0]) # This will wait until the pod is fully deleted even if it is already being deleted
-# a problem with the network connection detector, or a reminicent network connection of sorts
+# How long after a pod was last active test_pod_deleted_after_timeout checks that it was deleted, as the reaper sees
+# it: the timeout, plus 20 real seconds for the reaper to notice and the deletion to show up
+def sample_time(timeout, time_scale):
+  return timeout + 20 * time_scale
+
+# Spawns a pod and returns how long it took to be Running, in seconds
+def measure_startup(session, type, storage):
+  session.log("Measuring pod startup time...")
+  t1 = time.time()
+  spawn_pod(session, type = type, storage = storage)
+  podname, podinfo = wait_for_running_pod(session)
+  startup = time.time() - t1
+  delete_pod(session, podname)
+  session.log(f"  Pod startup took {startup:.1f} seconds")
+  return startup
+
+# Runs the tests for one combination of factors. Returns the names of the tests it ran.
+def run_case(session, test, default_timeout, time_scale):
+  type, storage, network, timeout = (test['type'], test['storage'], test['network'], test['timeout'])
+  ran = []
+  if timeout < 0:
+    test_pod_timeout_expect_error(session, type = type, storage = storage, timeout = timeout)
+    ran.append("test_pod_timeout_expect_error")
+
+  if timeout == 0:
+    test_pod_timeout_default(session, type = type, storage = storage, default_timeout = default_timeout)
+    ran.append("test_pod_timeout_default")
+
+  if timeout > 0:
+    # Note: network_activity_duration is automatically compensated for
+    test_pod_deleted_after_timeout(session, type = type, storage = storage, timeout = timeout, sample_time = sample_time(timeout, time_scale),
+                                   network_activity_duration = network, time_scale = time_scale)
+    ran.append("test_pod_deleted_after_timeout")
+
+  if timeout >= 0 and network > 0:
+    test_pod_exists_after_network_activity_duration(session, type = type, storage = storage, timeout = timeout,
+                                                    network_activity_duration = network, time_scale = time_scale)
+    ran.append("test_pod_exists_after_network_activity_duration")
+  return ran
+
+# Runs every case on the first free session. Returns (case, wall time, error or None) for each, in order.
+def run_cases(tests, sessions, default_timeout, time_scale):
+  free = queue.Queue()
+  for session in sessions:
+    free.put(session)
+
+  def run(test):
+    session = free.get()
+    t1 = time.time()
+    try:
+      ran = run_case(session, test, default_timeout, time_scale)
+      session.log(f"{', '.join(ran)} Succeeded! ({test})\n")
+      return (test, time.time() - t1, None)
+    except Exception as e:
+      session.log(f"FAILED: {test}: {type(e).__name__}: {str(e)}\n")
+      return (test, time.time() - t1, e)
+    finally:
+      free.put(session)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers = len(sessions)) as executor:
+    return list(executor.map(run, tests))
+
+def print_report(results, wall_time, jobs):
+  print("\n=== Results ===")
+  for test, secs, error in results:
+    print(f"  {'ok  ' if error is None else 'FAIL'} {secs:7.1f}s  type={test['type']} storage={test['storage']} timeout={test['timeout']} network={test['network']}")
+  serial = sum(secs for _, secs, _ in results)
+  failed = sum(1 for _, _, error in results if error is not None)
+  print(f"{len(results) - failed} passed, {failed} failed in {wall_time:.1f}s with {jobs} concurrent user(s)")
+  print(f"Total time of all cases: {serial:.1f}s; speedup from running them concurrently: {serial / max(wall_time, 1e-9):.2f}x")
 
 def main(argv):
   parser = argparse.ArgumentParser(description="", prog="test_podondemand_frontend_functionality")
@@ -200,8 +326,19 @@ def main(argv):
     help = 'Specify the path to the pod choices yaml. This should contain a root key called "podChoices", containing the yaml as a string.')
   parser.add_argument('-s', '--storage-choices', type = str,
     help = 'Specify the path to the storage choices yaml. This should contain a root key called "storageChoices", containing the yaml as a string.')
+  parser.add_argument('--host', type = str, default = 'podondemand', help = 'The ssh host (or ~/.ssh/config alias) of the frontend')
+  parser.add_argument('-u', '--users', type = str, default = None,
+    help = 'Comma-separated test users to log in as, one per concurrent case (default: only the ssh default user)')
+  parser.add_argument('-j', '--jobs', type = int, default = None, help = 'How many cases to run at once (default and at most: the number of --users)')
+  parser.add_argument('--time-scale', type = float, default = 1,
+    help = "The cluster's reaperTimeScale: waits for timeouts and network activity are shortened by this factor")
+  parser.add_argument('--timeouts', type = str, default = "-5,0,20",
+    help = "Comma-separated --timeout values to test, in seconds as the reaper sees them (negative: expect an error, 0: the default)")
+  parser.add_argument('--network-durations', type = str, default = "0,10,30",
+    help = "Comma-separated durations of simulated network activity to test, in seconds as the reaper sees them")
   args = parser.parse_args(argv[1:])
-  
+  if args.time_scale <= 0:
+    parser.error("--time-scale must be positive")
 
   # Retrieve possible pod choices
   pod_factors = None
@@ -220,42 +357,40 @@ def main(argv):
     storage_factors = choices
 
   default_timeout = 3600 # NOTE: This will be hard-coded here for now...
-  
+
   # NOTE: Ensure your poll frequency is set to a small value, such as 5 seconds
-  timeout_factors = [-5, 0, 20]
-  network_factors = [0, 10, 30] # Will test both before and after the timeout
-  
+  timeout_factors = [int(t) for t in args.timeouts.split(',')]
+  network_factors = [int(t) for t in args.network_durations.split(',')] # Will test both before and after the timeout
+
   tests = make(
      {'type': list(pod_factors.keys()), 'storage': list(storage_factors.keys()), 'network': network_factors, 'timeout': timeout_factors},  # dict factors
      length=2,  # default: 2
      tolerance=3,  # default: 0
      post_filter=lambda row: not(row['timeout'] < 0 and row['network'] > 0)
   )
-  
-  for test in tests:
-    type, storage, network, timeout = (test['type'], test['storage'], test['network'], test['timeout'])
-    if timeout < 0:
-      test_pod_timeout_expect_error(type = type, storage = storage, timeout = timeout)
-      print("test_pod_timeout_expect_error Succeeded!\n")
-
-    if timeout == 0:
-      test_pod_timeout_default(type = type, storage = storage, default_timeout = default_timeout)
-      print("test_pod_timeout_default Succeeded!\n")
-
-    if timeout > 0:
-      # Note: network_activity_duration is automatically com
-      test_pod_deleted_after_timeout(type = type, storage = storage, timeout = timeout, sample_time = timeout + 20, network_activity_duration = network)
-      print("test_pod_deleted_after_timeout Succeeded!\n")
-
-    if timeout >= 0 and network > 0:
-      test_pod_exists_after_network_activity_duration(type = type, storage = storage, timeout = timeout, network_activity_duration = network)
-      print("test_pod_exists_after_network_activity_duration Succeeded!\n")
-    
-
-
-
 
+  users = args.users.split(',') if args.users else [None]
+  jobs = min(args.jobs or len(users), len(users))
+  sessions = [Session(user, args.host) for user in users[:jobs]]
+  t1 = time.time()
+  try:
+    for session in sessions:
+      session.open()
+    # Every timed case must leave the pod time to start: the reaper counts a pod's inactivity from its creation, and
+    # the network activity tests only start once it is Running
+    startup = measure_startup(sessions[0], type = list(pod_factors.keys())[0], storage = None)
+    durations = [t for t in timeout_factors + network_factors if t > 0]
+    if durations and min(durations) / args.time_scale <= startup:
+      print(f"Error: pod startup took {startup:.1f}s, but at --time-scale {args.time_scale:g} the shortest timeout or network activity " +
+            f"({min(durations)}s) lasts {min(durations) / args.time_scale:.1f}s. Use longer --timeouts and --network-durations.", file = sys.stderr)
+      sys.exit(2)
+    results = run_cases(tests, sessions, default_timeout, args.time_scale)
+  finally:
+    for session in sessions:
+      session.close()
+  print_report(results, time.time() - t1, jobs)
+  sys.exit(int(any(error is not None for _, _, error in results)))
 
 
 if __name__ == "__main__":
-  main(sys.argv)
\ No newline at end of file
+  main(sys.argv)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+
+# Blocks until a file changes, using Linux inotify (through libc, so no extra dependency) with zero idle CPU.
+# The containing directory is watched rather than the file itself, so that editors and tools that replace the
+# file with an atomic rename, and Kubernetes volume updates (which swap a "..data" symlink inside the directory),
+# are noticed as well as in-place writes. Falls back to slow mtime polling if inotify is not available.
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len; followed by len bytes of name
+
+class FileWatcher:
+  def __init__(self, path, poll_interval = 5):
+    self.path = os.path.abspath(path)
+    self.directory = os.path.dirname(self.path)
+    self.poll_interval = poll_interval
+    self.fd = None
+    self.wd = None
+    self._libc = None
+    self._last_signature = self._signature()
+    try:
+      self._libc = ctypes.CDLL(None, use_errno = True)
+      self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+      if self.fd < 0:
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+      self._add_watch()
+    except (OSError, AttributeError) as e:
+      print(f"FileWatcher: could not set up inotify on {self.directory}: {str(e)}", file = sys.stderr)
+      if self.fd is not None and self.fd >= 0:
+        os.close(self.fd)
+      self.fd = None
+
+  @property
+  def uses_inotify(self):
+    return self.fd is not None
+
+  def _add_watch(self):
+    self.wd = self._libc.inotify_add_watch(self.fd, self.directory.encode(), WATCH_MASK)
+    if self.wd < 0:
+      raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+  # Identifies the current contents of the file, following symlinks (eg. ..data swaps)
+  def _signature(self):
+    try:
+      st = os.stat(self.path)
+      return (st.st_ino, st.st_dev, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+      return None
+
+  # Reads and discards queued events. Returns True if any were read. Re-arms the watch if the directory went away.
+  def _drain(self):
+    got = False
+    while True:
+      try:
+        data = os.read(self.fd, 65536)
+      except BlockingIOError:
+        return got
+      except OSError as e:
+        if e.errno == errno.EINTR:
+          continue
+        raise e
+      got = True
+      offset = 0
+      while offset < len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size + length
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+          self._rearm()
+
+  def _rearm(self):
+    # The watched directory was removed or replaced (eg. the volume was remounted); wait for it to reappear
+    while True:
+      try:
+        self._add_watch()
+        return
+      except OSError:
+        time.sleep(1)
+
+  # Blocks until the file has (probably) changed, then waits for events to stop arriving for `debounce` seconds
+  # (but no longer than `max_delay` in total) so that a burst of writes results in a single return. Also returns
+  # every `resync` seconds regardless, as a safety net for missed events.
+  # Returns True if a change was seen, False on a periodic resync.
+  def wait_for_change(self, debounce = 0.25, resync = 600, max_delay = 1.0):
+    deadline = time.monotonic() + resync
+    if not self.uses_inotify:
+      while time.monotonic() < deadline:
+        time.sleep(self.poll_interval)
+        if self._signature() != self._last_signature:
+          self._last_signature = self._signature()
+          return True
+      return False
+
+    poller = select.poll()
+    poller.register(self.fd, select.POLLIN)
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        self._last_signature = self._signature()
+        return False
+      if not poller.poll(remaining * 1000):
+        continue
+      self._drain()
+      # Debounce: keep draining until the directory has been quiet for `debounce` seconds
+      settle_by = time.monotonic() + max_delay
+      while time.monotonic() < settle_by and poller.poll(debounce * 1000):
+        self._drain()
+      signature = self._signature()
+      if signature != self._last_signature:
+        self._last_signature = signature
+        return True
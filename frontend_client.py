@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import signal
+import socket
+
+# Thin login-side client for frontendd.py. Hands this session's stdin/stdout/stderr and SSH_ORIGINAL_COMMAND to the
+# warm broker over its unix socket, waits for the exit code, and exits with it. Deliberately imports nothing heavy.
+# If the broker is not reachable, falls back to running run_pod.py directly.
+
+SOCKET_PATH = os.environ.get("PODONDEMAND_FRONTEND_SOCKET", default = "/run/podondemand/frontend.sock")
+RUN_POD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_pod.py")
+
+def fallback(argv):
+  os.execv(RUN_POD, [RUN_POD] + argv[1:])
+
+def main(argv):
+  conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    conn.connect(SOCKET_PATH)
+    request = json.dumps({'SSH_ORIGINAL_COMMAND': os.getenv('SSH_ORIGINAL_COMMAND')}).encode('UTF-8')
+    socket.send_fds(conn, [request], [0, 1, 2])
+  except OSError:
+    conn.close()
+    fallback(argv)
+
+  # Forward interruptions of the ssh session to the broker, which raises KeyboardInterrupt in the frontend
+  def forward_signal(signum, frame):
+    try:
+      conn.sendall(f"SIGNAL {signum}\n".encode('UTF-8'))
+    except OSError:
+      pass
+  for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+    signal.signal(sig, forward_signal)
+
+  buf = b''
+  while True:
+    try:
+      data = conn.recv(4096)
+    except InterruptedError:
+      continue
+    if not data:
+      sys.exit(1) # Broker went away without reporting a result
+    buf += data
+    while b'\n' in buf:
+      line, buf = buf.split(b'\n', 1)
+      parts = line.decode('UTF-8', errors = 'replace').split(' ')
+      if parts[0] == 'EXIT' and len(parts) == 2:
+        sys.exit(int(parts[1]))
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+from kubernetes import config, client
+import os
+import sys
+import socket
+import struct
+import signal
+import pwd
+import json
+import threading
+import traceback
+import datetime
+
+import run_pod
+from podconfig import ConfigWatcher
+from capacity import CapacityCache
+
+# Long-lived frontend broker. Holds a warm Kubernetes API client and the parsed podondemand-config (kept current by
+# a podconfig.ConfigWatcher) so that each SSH login (see login.sh and frontend_client.py) doesn't have to pay for the
+# interpreter, the kubernetes import, load_incluster_config() and the ConfigMap read and parse before doing anything
+# useful. Each request is served by a forked child running run_pod.main() with the caller's stdin/stdout/stderr.
+
+SOCKET_PATH = os.environ.get("PODONDEMAND_FRONTEND_SOCKET", default = "/run/podondemand/frontend.sock")
+MAX_REQUEST_BYTES = 65536
+
+
+# Returns the (uid, gid) of the process on the other end of a unix socket. The username is resolved from this
+# rather than trusted from the client, so a user cannot act on another user's pods.
+def get_peer_credentials(conn):
+  creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+  pid, uid, gid = struct.unpack('3i', creds)
+  return (uid, gid)
+
+def send_line(conn, msg):
+  try:
+    conn.sendall((msg + '\n').encode('UTF-8'))
+  except OSError:
+    pass # The client has gone away
+
+# Forwards signals sent by the client (eg. the ssh session was interrupted) to this process, so run_pod.main()
+# sees a KeyboardInterrupt and cleans up exactly as it would if it were run directly.
+def relay_client_signals(conn):
+  buf = b''
+  while True:
+    try:
+      data = conn.recv(4096)
+    except OSError:
+      return
+    if not data: # Client disconnected
+      os.kill(os.getpid(), signal.SIGINT)
+      return
+    buf += data
+    while b'\n' in buf:
+      line, buf = buf.split(b'\n', 1)
+      parts = line.decode('UTF-8', errors = 'replace').split(' ')
+      if parts[0] == 'SIGNAL' and len(parts) == 2:
+        os.kill(os.getpid(), signal.SIGINT)
+
+# Runs in the forked child: becomes the calling user, attaches to their terminal streams, runs the frontend and
+# reports the exit code back to the client.
+def serve_request(conn, fds, request, username, v1, pod_config, capacity):
+  exit_code = 0
+  try:
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # Pooled connections were opened by the parent; never share them with it
+    v1.api_client.rest_client.pool_manager.clear()
+
+    os.dup2(fds[0], 0)
+    os.dup2(fds[1], 1)
+    os.dup2(fds[2], 2)
+    for fd in fds:
+      os.close(fd)
+
+    pw = pwd.getpwnam(username)
+    os.initgroups(username, pw.pw_gid)
+    os.setgid(pw.pw_gid)
+    os.setuid(pw.pw_uid)
+    os.chdir(pw.pw_dir)
+    os.environ['USER'] = username
+    os.environ['HOME'] = pw.pw_dir
+    if request.get('SSH_ORIGINAL_COMMAND') is None:
+      os.environ.pop('SSH_ORIGINAL_COMMAND', None)
+    else:
+      os.environ['SSH_ORIGINAL_COMMAND'] = request['SSH_ORIGINAL_COMMAND']
+
+    threading.Thread(target = relay_client_signals, args = (conn,), daemon = True).start()
+    run_pod.main([sys.argv[0]], v1 = v1, pod_config = pod_config, capacity = capacity)
+  except SystemExit as e:
+    if e.code is None:
+      exit_code = 0
+    elif isinstance(e.code, int):
+      exit_code = e.code
+    else:
+      print(e.code, file = sys.stderr)
+      exit_code = 1
+  except BaseException:
+    traceback.print_exc()
+    exit_code = 1
+  finally:
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # The client may hang up as soon as it has the exit code
+    try:
+      sys.stdout.flush()
+      sys.stderr.flush()
+    except Exception:
+      pass
+    send_line(conn, f"EXIT {exit_code}")
+    os._exit(exit_code)
+
+def handle_connection(conn, v1, pod_config, capacity):
+  msg, fds, flags, addr = socket.recv_fds(conn, MAX_REQUEST_BYTES, 3)
+  if len(fds) != 3:
+    for fd in fds:
+      os.close(fd)
+    send_line(conn, "EXIT 1")
+    return
+  try:
+    uid, gid = get_peer_credentials(conn)
+    username = pwd.getpwuid(uid).pw_name
+    request = json.loads(msg.decode('UTF-8'))
+  except (KeyError, ValueError) as e:
+    print(f"Rejected frontend request: {str(e)}", file = sys.stderr)
+    for fd in fds:
+      os.close(fd)
+    send_line(conn, "EXIT 1")
+    return
+
+  pid = os.fork()
+  if pid == 0:
+    try:
+      serve_request(conn, fds, request, username, v1, pod_config, capacity)
+    finally:
+      os._exit(1) # The child must never fall back into the accept loop
+  for fd in fds:
+    os.close(fd)
+
+# Does the per-config work that logins would otherwise repeat, so forked children inherit the results
+def prewarm(pod_config):
+  run_pod.get_encrypted_password(pod_config.data.get("podPasswordHash"))
+
+def create_socket(path):
+  os.makedirs(os.path.dirname(path), mode = 0o755, exist_ok = True)
+  if os.path.exists(path):
+    os.remove(path)
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(path)
+  os.chmod(path, 0o666) # Any login user may connect; their identity is taken from SO_PEERCRED
+  server.listen(128)
+  return server
+
+def main(argv):
+  config.load_incluster_config()
+  v1 = client.CoreV1Api()
+
+  # Read config. The watcher gets an API client of its own: its watch connection must never be shared with the
+  # forked children, which reset the pool of `v1`.
+  namespace = os.environ.get("CONFIG_NAMESPACE", default = "kube-system")
+  config_watcher = ConfigWatcher(client.CoreV1Api(client.ApiClient()), namespace) # Fails here if the config is invalid
+  prewarm(config_watcher.current)
+  config_watcher.add_listener(prewarm)
+  # Nodes and user pods, so logins can be told at once when their pod type can't be scheduled (see capacity.py)
+  capacity_cache = CapacityCache(client.CoreV1Api(client.ApiClient()), namespace)
+
+  print("Starting frontend broker daemon...", file = sys.stderr)
+  daemonize_out = os.getenv("HOME") + "/logs/frontendd_out.log"
+  daemonize_err = os.getenv("HOME") + "/logs/frontendd_err.log"
+  run_pod.daemonize(stdout = daemonize_out, stderr = daemonize_err)
+
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN) # Children are never waited on; let the kernel reap them
+  config_watcher.start() # After daemonize, so the watch threads live in the daemon process
+  capacity_cache.start()
+  server = create_socket(SOCKET_PATH)
+  print("Started frontend broker on " + str(datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y")))
+
+  while True:
+    try:
+      conn, _ = server.accept()
+      try:
+        # Each login sees one consistent configuration. The capacity snapshot is taken here, not in the child: the
+        # informer threads don't survive fork(), and one of them could hold a cache lock at that moment.
+        handle_connection(conn, v1, config_watcher.current, capacity_cache.snapshot())
+      finally:
+        conn.close()
+    except (KeyboardInterrupt, Exception) as e:
+      if isinstance(e, KeyboardInterrupt):
+        raise e
+      traceback.print_tb(e.__traceback__)
+      print(repr(e))
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -7,9 +7,36 @@ import yaml
 import string
 import time
 import threading
-import psutil
-import traceback
+import queue
+import signal
+import logging
 
+from podcache import PodInformer
+from activityledger import ActivityLedger, activity_key, write_snapshot, read_checkpoint, ATTACH_ANNOTATION
+import connscan
+from podconfig import ConfigWatcher
+from reaper import Reaper
+from leaderelect import LeaderElector
+from imageprepull import ImagePrePuller
+import metrics
+import podlog
+
+log = logging.getLogger("garbagecollectd")
+
+registry = metrics.Registry()
+SWEEP_SECONDS = registry.histogram("podondemand_gc_sweep_duration_seconds", "Time taken by one garbage collector sweep")
+API_SECONDS = registry.histogram("podondemand_k8s_api_request_duration_seconds", "Kubernetes API call latency", ["verb"])
+API_ERRORS = registry.counter("podondemand_k8s_api_errors_total", "Failed Kubernetes API calls", ["verb"])
+TRACKED_PODS = registry.gauge("podondemand_gc_tracked_pods", "Number of userpod-* pods being tracked")
+ACTIVE_CONNECTIONS = registry.gauge("podondemand_gc_active_connections", "Established connections seen on this replica")
+IDLE_CONNECTED_PODS = registry.gauge("podondemand_gc_idle_connected_pods", "Pods with a connection but less traffic than their activityMinBytes (reaper leader only)")
+IS_LEADER = registry.gauge("podondemand_gc_is_leader", "1 if this replica currently holds the reaper lease")
+DELETIONS = registry.counter("podondemand_gc_deletions_total", "Pods deleted by the garbage collector", ["reason"])
+REAP_LATENESS_SECONDS = registry.histogram("podondemand_gc_reap_lateness_seconds", "How long after its inactivity deadline each pod was reaped",
+                                           buckets = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+PREPULL_NODES = registry.gauge("podondemand_prepull_nodes", "Nodes by image pre-pull state (cached, pulling or failed)", ["podtype", "image", "state"])
+UNTIL_REAP_SECONDS = registry.histogram("podondemand_gc_seconds_until_reap", "Seconds until each tracked pod would be reaped, sampled every sweep",
+                                        buckets = (0, 10, 60, 300, 900, 1800, 3600, 7200, 14400, 43200, 86400))
 
 # Adapted from https://gist.github.com/Jd007/5573672
 # Forks the process and detaches ownership from the shell process to continue in background
@@ -84,30 +111,103 @@ def daemonize(stdout: str, stderr: str, stdin: str = None):
 #    return False
 #  return True
 
-def delete_namespaced_pod(v1, name, namespace):
-  pod_list = v1.list_namespaced_pod(namespace)
-  notFound = True
-  for pod in pod_list.items:
-    if pod.metadata.name == name:
-      print("### Deleting pod " + name + "...", file = sys.stderr)
-      resp = v1.delete_namespaced_pod(name = name, namespace=namespace)
-      notFound = False
-      continue
-  if notFound: # The element was not found in the namespace, so it is assumed it has already been deleted
-    return True
-  pod_list = v1.list_namespaced_pod(namespace)
-  if name in [pod.metadata.name for pod in pod_list.items]: # Return true if element is gone
-    print("### Deletion failed!", file = sys.stderr)
+# Deletes the pod, but only if it is still the same pod (by uid), not a new one that has since been given the same
+# name. Returns True if it is deleted or already gone.
+def delete_namespaced_pod(v1, name, namespace, uid = None):
+  body = client.V1DeleteOptions(preconditions = client.V1Preconditions(uid = uid)) if uid else None
+  try:
+    v1.delete_namespaced_pod(name = name, namespace = namespace, body = body)
+  except client.rest.ApiException as e:
+    if e.status in (404, 409): # Gone, or replaced by a new pod (uid precondition failed)
+      return True
+    log.warning(f"Deleting {name} failed: {str(e.status)} {str(e.reason)}", extra = {"event": "delete_failed", "pod": name})
     return False
   return True
 
+# Starts, updates or stops tracking a pod in the reaper, from a PodInformer event. time_scale (reaperTimeScale) makes
+# every timeout that many times shorter, so tests can check timeout behaviour in seconds.
+def apply_pod_event(reaper, event_type, pod, now, time_scale = 1):
+  name = pod.metadata.name
+  timeout = (pod.metadata.labels or {}).get('timeout')
+  # Pods already being deleted need nothing more
+  if event_type == "DELETED" or pod.metadata.deletion_timestamp:
+    reaper.forget(name)
+  elif not str(timeout).isdigit():
+    if name in reaper.names() or event_type == "ADDED":
+      log.warning(f"Not tracking {name}: invalid timeout label {repr(timeout)}", extra = {"event": "invalid_timeout", "pod": name})
+    reaper.forget(name)
+  else:
+    reaper.track(name, int(timeout) / time_scale, now, uid = pod.metadata.uid)
+    attached = (pod.metadata.annotations or {}).get(ATTACH_ANNOTATION)
+    try:
+      if attached is not None:
+        reaper.activity(name, min(float(attached), now)) # A login reattached to it (see run_pod.attach_pod)
+    except ValueError:
+      pass
+
+DEFAULT_ACTIVITY_WINDOW_SECS = 300
+
+# Returns (activityMinBytes, activityWindowSecs) for a pod type, or (None, None) if any connection counts as activity
+def traffic_threshold(pod_choices, podtype):
+  choice = pod_choices.get(podtype) or {}
+  if not choice.get('activityMinBytes'):
+    return (None, None)
+  return (int(choice['activityMinBytes']), int(choice.get('activityWindowSecs', DEFAULT_ACTIVITY_WINDOW_SECS)))
+
+# Returns the ledger keys (see activityledger.activity_key) of the activity seen on this replica: for each pod IP with
+# a connection, its plain key, plus one per traffic threshold in use that the connections met. Without a traffic
+# meter, any connection meets them all.
+def activity_keys(active_connections, thresholds, traffic_meter, now):
+  keys = []
+  for ip in active_connections:
+    keys.append(activity_key(ip))
+    for min_bytes, window in thresholds:
+      if traffic_meter is None or traffic_meter.bytes_in_window(ip, window, now) >= min_bytes:
+        keys.append(activity_key(ip, min_bytes, window))
+  return keys
+
+# Applies ledger entries (activity key -> timestamp) to the reaper. An entry only counts for the pod that has its IP
+# now, if it is the key for that pod's traffic threshold, and not from before the pod was created (the IP may have
+# belonged to an earlier pod). Returns the names of the pods it was applied to.
+def apply_activity(reaper, informer, pod_choices, entries):
+  applied = set()
+  for key, timestamp in entries.items():
+    ip = key.split("/")[0]
+    pod = informer.get_by_ip(ip)
+    if pod is None or not pod.metadata.name in reaper.names():
+      continue
+    if key != activity_key(ip, *traffic_threshold(pod_choices, (pod.metadata.labels or {}).get('podtype'))):
+      continue
+    created = pod.metadata.creation_timestamp
+    if created is not None and timestamp < created.timestamp():
+      continue
+    reaper.activity(pod.metadata.name, timestamp)
+    applied.add(pod.metadata.name)
+  return applied
+
+# Starts tracking pods for the reaper, once this replica holds the lease. Picks up where the previous leader left
+# off, from its checkpoint, rather than giving every pod a fresh timeout. The informer's events go to `pod_events`,
+# along with the informer itself so events from one that has since been stopped can be told apart.
+def start_reaping(v1, namespace, name_prefix, pod_events):
+  reaper = Reaper()
+  checkpoint_time, checkpoint = read_checkpoint()
+  if checkpoint_time is not None:
+    restored = reaper.restore(checkpoint, checkpoint_time, time.time())
+    log.info(f"Restored last activity of {restored} pods from a checkpoint {int(time.time() - checkpoint_time)}s old", extra = {"event": "restore"})
+  informer = PodInformer(v1, namespace, name_prefix = name_prefix)
+  informer.add_listener(lambda event_type, pod: pod_events.put((informer, event_type, pod)))
+  informer.start()
+  informer.wait_for_sync()
+  return (informer, reaper)
+
 def main(argv):
   config.load_incluster_config()
-  v1 = client.CoreV1Api()
+  v1 = metrics.InstrumentedApi(client.CoreV1Api(), API_SECONDS, API_ERRORS)
 
   # Read config
   namespace = os.environ.get("CONFIG_NAMESPACE", default = "kube-system")
-  config_map = v1.read_namespaced_config_map("podondemand-config", namespace)
+  config_watcher = ConfigWatcher(v1, namespace) # Fails here, before daemonizing, if the config is invalid
+  config_map = config_watcher.current
   #pod_manifest = config_map.data["pod-manifest"]
   #pod_manifest_dict = yaml.safe_load(pod_manifest)
 
@@ -118,46 +218,165 @@ def main(argv):
   print("Starting garbage collector daemon...", file = sys.stderr)
 
 
-  daemonize(stdout = os.getenv("HOME") + "/logs/garbagecollectd_out.log", stderr = os.getenv("HOME") + "/logs/garbagecollectd_err.log")
+  # Only output from below Python (eg. the interpreter crashing) still goes to the _err file; everything else is logged
+  daemonize(stdout = os.devnull, stderr = os.getenv("HOME") + "/logs/garbagecollectd_err.log")
   #daemonize(stdout = sys.stdout, stderr = sys.stderr, stdin = sys.stdin)
+  podlog.capture_stdio(podlog.setup("garbagecollectd"))
+  log.info("Started garbage collector daemon", extra = {"event": "start"})
+
+  # Optional Prometheus endpoint, served from its own thread
+  if config_map.data.get("metricsPort"):
+    metrics.serve(registry, int(config_map.data["metricsPort"]))
+
+  traffic_meter = connscan.TrafficMeter() # Only used for pod types with an activityMinBytes threshold
+
+  # Every replica scans its own connections and reports them through the ledger, which needs no view of the pods.
+  # Only the holder of the lease watches the pods, reads the ledger back and deletes pods; a replica that wins the
+  # lease starts from the last checkpoint, and one that loses it stops again.
+  elector = LeaderElector(metrics.InstrumentedApi(client.CoordinationV1Api(), API_SECONDS, API_ERRORS), namespace, "podondemand-reaper").start()
+  # Shares connection activity with the leader, since each replica only sees its own relayed sessions. Entries are
+  # kept until the leader (or, after a handover, the next one) has surely read them and checkpointed the result.
+  sync_interval = int(config_map.data.get("activitySyncFreq", "15"))
+  ledger = ActivityLedger(v1, namespace, sync_interval = sync_interval, keep_secs = 4 * sync_interval + elector.lease_duration)
+  # While leading: the pod informer, and the pods in a min-heap by inactivity deadline, kept up to date from pod
+  # events and activity
+  informer = None
+  reaper = None
+  def handle_sigterm(signum, frame):
+    elector.release() # Hand over at once rather than after the lease expires
+    sys.exit(0)
+  signal.signal(signal.SIGTERM, handle_sigterm)
+  pod_events = queue.Queue() # Filled by the informer thread; applied to the reaper only from this one
+  # Also run by the leader only: keeps images of "prePull" pod types pulled on their nodes (see imageprepull.py)
+  prepuller = ImagePrePuller(metrics.InstrumentedApi(client.AppsV1Api(), API_SECONDS, API_ERRORS), v1, namespace,
+                             refresh_secs = int(config_map.data.get("imagePrePullRefreshSecs", 21600)))
+
+  # Started after daemonize so the watch threads live in the daemon process
+  config_watcher.start()
 
   while True:
     try:
-      # Poll to check for network inactivity for specified timeout
-      oldTime = time.time()
-      curTime = oldTime
-
-      #timeout = int(config_map.data["inactivityTimeoutSecs"])
-      poll_freq = int(config_map.data["inactivityPollFreq"])
-      
-      timeout_dict = {}
+      # Activity is scanned every inactivityPollFreq seconds; reaping happens when a deadline comes due, which
+      # may be in between. In between both, the loop just sleeps (waking early only for pod events).
+      next_scan = 0
+      snapshot_time = 0
       while True:
-        # Create a Set of active connection ip addresses
-        active_connections = {conn.raddr.ip for conn in psutil.net_connections(kind='inet') if conn.status == 'ESTABLISHED' and not (conn.raddr == "" or conn.raddr == ())}
+        # Already parsed and validated; picks up ConfigMap edits without a restart
+        pod_config = config_watcher.current
+        #timeout = int(pod_config.data["inactivityTimeoutSecs"])
+        # On test clusters, the reaper's clock may run faster: timeouts and the activity scan interval are scaled alike
+        time_scale = float(pod_config.data.get("reaperTimeScale", 1))
+        poll_freq = int(pod_config.data["inactivityPollFreq"]) / time_scale
+
+        is_leader = elector.is_leader()
+        IS_LEADER.set(int(is_leader))
+        gained_lease = is_leader and informer is None
+        if gained_lease:
+          informer, reaper = start_reaping(v1, namespace, pod_base_name, pod_events)
+          log.info(f"Holding the reaper lease; tracking {len(informer.pods())} pods", extra = {"event": "leader"})
+          next_scan = 0 # Read the ledger back at once
+        elif not is_leader and informer is not None:
+          informer.stop()
+          informer, reaper = None, None
+          log.info("Lost the reaper lease; no longer tracking pods", extra = {"event": "follower"})
+
+        now = time.time()
+        while True:
+          try:
+            source, event_type, pod = pod_events.get_nowait()
+          except queue.Empty:
+            break
+          if source is informer:
+            apply_pod_event(reaper, event_type, pod, now, time_scale)
+        if reaper is not None and reaper.restored: # Every existing pod has been tracked by the first pass; the rest no longer exist
+          reaper.discard_restored()
 
-        pod_list = v1.list_namespaced_pod(namespace)
-        for pod in pod_list.items:
-          name = pod.metadata.name
-          if not name.startswith(pod_base_name):
+        if now >= next_scan:
+          next_scan = now + poll_freq
+          sweep_start = time.perf_counter()
+          # Create a Set of active connection ip addresses
+          pod_cidrs = connscan.parse_cidrs(pod_config.data.get("podCIDR"))
+          # Types with a threshold only count as active if enough traffic went through within the window, so an
+          # idle but still connected session doesn't keep eg. a GPU pod alive forever
+          thresholds = {traffic_threshold(pod_config.pod_choices, podtype) for podtype in pod_config.pod_choices} - {(None, None)}
+          windows = [window for min_bytes, window in thresholds]
+          if windows and traffic_meter is not None:
+            try:
+              active_connections = traffic_meter.sample(pod_cidrs, now) # Also measures bytes per connection
+              traffic_meter.prune(max(windows), now)
+            except OSError as e:
+              log.warning(f"Cannot read per-connection traffic (sock_diag), any connection counts as activity: {str(e)}")
+              traffic_meter = None
+          if not windows or traffic_meter is None:
+            active_connections = connscan.established_remote_ips(pod_cidrs)
+          ACTIVE_CONNECTIONS.set(len(active_connections))
+          seen = {key: now for key in activity_keys(active_connections, thresholds, traffic_meter, now)}
+          for key in seen:
+            ledger.record(key, now)
+          ledger.expire(now)
+          # At most one batched write per sync interval; the leader also reads back what every replica has seen
+          merged = ledger.sync(now, merge = reaper is not None, force = gained_lease)
+          if reaper is not None:
+            # Only pods with connections are touched, not every pod
+            active = apply_activity(reaper, informer, pod_config.pod_choices, seen)
+            connected = {pod.metadata.name for pod in map(informer.get_by_ip, active_connections) if pod is not None}
+            IDLE_CONNECTED_PODS.set(len([name for name in connected - active if name in reaper.names()]))
+            if merged:
+              apply_activity(reaper, informer, pod_config.pod_choices, merged)
+          if is_leader:
+            prepuller.refresh_secs = int(pod_config.data.get("imagePrePullRefreshSecs", 21600))
+            prepull_status = prepuller.sync(pod_config.pod_choices, pod_config.templates, now)
+            for podtype, images in (prepull_status or {}).get("podtypes", {}).items():
+              for image, entry in images.items():
+                states = [node["state"] for node in entry["nodes"].values()]
+                for state in ("cached", "pulling", "failed"):
+                  PREPULL_NODES.set(states.count(state), podtype = podtype, image = image, state = state)
+          TRACKED_PODS.set(len(reaper) if reaper is not None else 0)
+          if reaper is not None and now - snapshot_time >= ledger.sync_interval: # For --list; refreshed about as often as the ledger
+            snapshot_time = now
+            last_active_dict = {name: reaper.last_seen(name) for name in reaper.names()}
+            # Also the checkpoint; one writer, since the logs volume is shared
+            write_snapshot(last_active_dict, uids = reaper.uids)
+            for name, last_active in last_active_dict.items():
+              UNTIL_REAP_SECONDS.observe(max(0, reaper.timeouts[name] - (now - last_active)))
+          SWEEP_SECONDS.observe(time.perf_counter() - sweep_start)
+
+        for name, deadline in (reaper.due(time.time()) if reaper is not None else []):
+          if not elector.is_leader():
+            reaper.postpone(name, time.time() + poll_freq) # The lease has just lapsed; stopped at the next pass
             continue
-          pod_timeout = int(pod.metadata.labels['timeout'])
-          curtime = time.time()
-          if pod.status.pod_ip in active_connections or not name in timeout_dict.keys():
-            timeout_dict[name] = curtime
-          if curtime - timeout_dict[name] > pod_timeout: #and pod.status.phase == "Running":
-            timeout_dict.pop(name)
-            #pvDeleted = delete_namespaced(v1.list_namespaced_persistent_volume_claim, v1.delete_namespaced_persistent_volume_claim, namespace, name)
-            #pvcDeleted = delete_global(v1.list_persistent_volume, v1.delete_persistent_volume, namespace, name)
-            #if pvDeleted and pvcDeleted:
-            print("Attempting to delete " + name, end = '', file = sys.stderr)
-            result = delete_namespaced_pod(v1, name = name, namespace = namespace)
-            #result = delete_namespaced(v1.list_namespaced_pod, v1.delete_namespaced_pod, namespace, name)
-            print(" -> successful: " + str(result))
-        time.sleep(poll_freq)
+          #pvDeleted = delete_namespaced(v1.list_namespaced_persistent_volume_claim, v1.delete_namespaced_persistent_volume_claim, namespace, name)
+          #pvcDeleted = delete_global(v1.list_persistent_volume, v1.delete_persistent_volume, namespace, name)
+          #if pvDeleted and pvcDeleted:
+          REAP_LATENESS_SECONDS.observe(max(0, time.time() - deadline))
+          pod = informer.get(name)
+          user = (pod.metadata.labels or {}).get('user') if pod is not None else None
+          delete_start = time.perf_counter()
+          try:
+            result = delete_namespaced_pod(v1, name = name, namespace = namespace, uid = pod.metadata.uid if pod is not None else None)
+          except Exception as e:
+            log.warning(f"Deleting {name} failed: {repr(e)}", extra = {"event": "delete_failed", "pod": name, "user": user})
+            result = False
+          #result = delete_namespaced(v1.list_namespaced_pod, v1.delete_namespaced_pod, namespace, name)
+          if result:
+            log.info(f"Deleted {name} after {reaper.timeouts[name]:g}s of inactivity", extra = {"event": "reap", "pod": name, "user": user,
+                                                                                           "duration": time.perf_counter() - delete_start})
+            reaper.forget(name)
+            DELETIONS.inc(reason = "inactivity")
+          else:
+            reaper.postpone(name, time.time() + poll_freq) # Try again at the next scan
+
+        # Sleep until the next scan or the earliest deadline, whichever comes first, or until a pod event arrives
+        wake = min(next_scan, (reaper.next_deadline() if reaper is not None else None) or next_scan)
+        try:
+          source, event_type, pod = pod_events.get(timeout = max(0, wake - time.time()))
+          if source is informer:
+            apply_pod_event(reaper, event_type, pod, time.time(), time_scale)
+        except queue.Empty:
+          pass
 
     except (KeyboardInterrupt, Exception) as e:
-      traceback.print_tb(e.__traceback__)
-      print(str(e))
+      log.exception(f"Garbage collector loop failed: {str(e)}", extra = {"event": "error"})
 
 
 if __name__ == "__main__":
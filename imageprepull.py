@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+from kubernetes.client.rest import ApiException
+import os
+import sys
+import json
+import time
+import hashlib
+import traceback
+
+# Image pre-pulling, enabled per podChoices entry with "prePull: true", so a pod landing on a node doesn't have to
+# wait for its (possibly many gigabyte) image to be pulled first.
+#
+# For each image in such a type's manifest, the reaper leader keeps a DaemonSet, podondemand-prepull-<type>-<n>, that
+# runs on every node a pod of the type could be scheduled on: it has the manifest's nodeSelector, required node
+# affinity, tolerations and imagePullSecrets. Its pods pull the image (imagePullPolicy Always) in an init container
+# that only runs `sh -c true`, then idle in a pause container that requests next to nothing. Every refresh_secs the
+# pod template is touched, so the DaemonSet rolls and every node pulls the tag again, picking up a new digest.
+#
+# The leader also writes the per-node result to a local file on the shared logs volume (STATUS_PATH), the same way
+# the reaper publishes its activity snapshot, so logins can read it without any API call:
+#   {"updated": ..., "podtypes": {<type>: {<image>: {"digest": ..., "desired": ..., "nodes": {<node>: {"state": ..., "digest": ...}}}}}}
+# where state is "cached", "pulling" or "failed". "digest" is only set once every node has pulled the same digest;
+# define_pod then pins the image to it (repo@sha256:...) with imagePullPolicy IfNotPresent, so a pod never waits on
+# a pull, or even on the registry, on any of those nodes. The node a spawn landed on and whether it had the image
+# is recorded in its spawn timeline (see spawnreport.py), so slow spawns can be matched to cache misses.
+
+PREPULL_LABEL = "podondemand-prepull"
+SPEC_ANNOTATION = "podondemand/prepull-spec" # Hash of the generated DaemonSet, to tell when the manifest changed
+REFRESH_ANNOTATION = "podondemand/prepull-refresh"
+PAUSE_IMAGE = "registry.k8s.io/pause:3.9"
+STATUS_PATH = os.environ.get("PODONDEMAND_PREPULL_STATUS", default = "/home/login/logs/prepull.json")
+STATUS_MAX_AGE = 600 # A status not updated for this long (eg. no leader) is not trusted for pinning
+PULL_FAILURES = ("ErrImagePull", "ImagePullBackOff", "InvalidImageName", "ErrImageNeverPull")
+
+def prepull_types(pod_choices_dict):
+  return [name for name, data in pod_choices_dict.items() if data.get('prePull')]
+
+# The images of a pod type's manifest (init containers included), in order and without repeats
+def template_images(template):
+  spec = template.manifest["spec"]
+  images = [c.get("image") for c in (spec.get("initContainers") or []) + spec["containers"]]
+  return list(dict.fromkeys(image for image in images if image))
+
+def define_prepull_daemonset(name, podtype, image, template):
+  spec = template.manifest["spec"]
+  labels = {"app": PREPULL_LABEL, "prepull-podtype": podtype, "prepull-daemonset": name}
+  tiny = {"requests": {"cpu": "1m", "memory": "8Mi"}, "limits": {"memory": "32Mi"}}
+  pod_spec = {
+    "initContainers": [{"name": "pull", "image": image, "imagePullPolicy": "Always", "command": ["sh", "-c", "true"], "resources": tiny}],
+    "containers": [{"name": "pause", "image": PAUSE_IMAGE, "resources": tiny}],
+    "automountServiceAccountToken": False,
+    "terminationGracePeriodSeconds": 0,
+  }
+  for field in ("nodeSelector", "tolerations", "imagePullSecrets"):
+    if spec.get(field):
+      pod_spec[field] = spec[field]
+  node_affinity = (spec.get("affinity") or {}).get("nodeAffinity")
+  if node_affinity:
+    pod_spec["affinity"] = {"nodeAffinity": node_affinity}
+  body = {"apiVersion": "apps/v1", "kind": "DaemonSet",
+          "metadata": {"name": name, "labels": labels, "annotations": {"podondemand/image": image}},
+          "spec": {"selector": {"matchLabels": {"prepull-daemonset": name}},
+                   "updateStrategy": {"type": "RollingUpdate", "rollingUpdate": {"maxUnavailable": "25%"}},
+                   "template": {"metadata": {"labels": labels}, "spec": pod_spec}}}
+  body["metadata"]["annotations"][SPEC_ANNOTATION] = hashlib.sha1(json.dumps(body, sort_keys = True).encode('UTF-8')).hexdigest()[:16]
+  return body
+
+# "sha256:..." from a container status imageID (eg. "docker.io/library/x@sha256:..." or "docker-pullable://x@sha256:...")
+def image_digest(image_id):
+  return image_id.rsplit('@', 1)[1] if image_id and '@' in image_id else None
+
+# The image reference pinned to a digest: "registry/repo:tag" -> "registry/repo@sha256:..."
+def pin_image(image, digest):
+  repo = image.split('@', 1)[0]
+  if ':' in repo.rsplit('/', 1)[-1]: # A tag (a ':' before the last '/' would be a registry port)
+    repo = repo[:repo.rfind(':')]
+  return f"{repo}@{digest}"
+
+# ("cached" | "pulling" | "failed", digest or None) for one pre-pull pod
+def pull_state(pod):
+  statuses = (pod.status.init_container_statuses or []) if pod.status else []
+  if not statuses:
+    return ("pulling", None)
+  status = statuses[0]
+  if status.state and status.state.terminated and status.state.terminated.exit_code == 0:
+    return ("cached", image_digest(status.image_id))
+  if status.state and status.state.waiting and status.state.waiting.reason in PULL_FAILURES:
+    return ("failed", None)
+  return ("pulling", image_digest(status.image_id))
+
+# Keeps the pre-pull DaemonSets in line with the configuration and publishes their status. Only the reaper leader
+# should call sync(); it does nothing until sync_interval has passed, and then costs one LIST of DaemonSets and
+# one LIST of their pods (plus a write for anything that has to change).
+class ImagePrePuller:
+  def __init__(self, apps_api, v1, namespace, sync_interval = 60, refresh_secs = 21600, status_path = STATUS_PATH):
+    self.apps = apps_api
+    self.v1 = v1
+    self.namespace = namespace
+    self.sync_interval = sync_interval
+    self.refresh_secs = refresh_secs
+    self.status_path = status_path
+    self.last_sync = 0
+
+  # Returns the new status (see above), or None if it wasn't time to sync yet or the sync failed
+  def sync(self, pod_choices_dict, templates, now = None):
+    now = time.time() if now is None else now
+    if now - self.last_sync < self.sync_interval:
+      return None
+    self.last_sync = now
+    try:
+      daemonsets = self._reconcile(pod_choices_dict, templates, now)
+      status = self._status(daemonsets, now)
+      write_status(status, self.status_path)
+      return status
+    except Exception as e:
+      traceback.print_tb(e.__traceback__)
+      print(f"ImagePrePuller sync failed: {repr(e)}", file = sys.stderr)
+      return None
+
+  # Creates, updates, refreshes and deletes DaemonSets. Returns the current ones, by name.
+  def _reconcile(self, pod_choices_dict, templates, now):
+    existing = {ds.metadata.name: ds for ds in self.apps.list_namespaced_daemon_set(self.namespace, label_selector = f"app={PREPULL_LABEL}").items}
+    current = {}
+    for podtype in prepull_types(pod_choices_dict):
+      for index, image in enumerate(template_images(templates[podtype])):
+        name = f"{PREPULL_LABEL}-{podtype}-{index}"
+        body = define_prepull_daemonset(name, podtype, image, templates[podtype])
+        ds = existing.pop(name, None)
+        refreshed = float(((ds.spec.template.metadata.annotations or {}) if ds is not None else {}).get(REFRESH_ANNOTATION, 0))
+        if ds is None:
+          body["spec"]["template"]["metadata"]["annotations"] = {REFRESH_ANNOTATION: str(int(now))}
+          ds = self.apps.create_namespaced_daemon_set(self.namespace, body)
+          print(f"Created image pre-pull DaemonSet {name} for {image}", file = sys.stderr)
+        elif (ds.metadata.annotations or {}).get(SPEC_ANNOTATION) != body["metadata"]["annotations"][SPEC_ANNOTATION]:
+          body["spec"]["template"]["metadata"]["annotations"] = {REFRESH_ANNOTATION: str(int(now))}
+          ds = self.apps.replace_namespaced_daemon_set(name, self.namespace, body)
+          print(f"Updated image pre-pull DaemonSet {name} for {image}", file = sys.stderr)
+        elif now - refreshed >= self.refresh_secs:
+          # Rolls the DaemonSet, so every node pulls the tag again and picks up a new digest if there is one
+          ds = self.apps.patch_namespaced_daemon_set(name, self.namespace, {"spec": {"template": {"metadata": {"annotations": {REFRESH_ANNOTATION: str(int(now))}}}}})
+        current[name] = ds
+    for name in existing: # Types no longer pre-pulled, or images no longer used
+      try:
+        self.apps.delete_namespaced_daemon_set(name, self.namespace)
+        print(f"Deleted image pre-pull DaemonSet {name}", file = sys.stderr)
+      except ApiException as e:
+        if e.status != 404:
+          raise e
+    return current
+
+  def _status(self, daemonsets, now):
+    pods = self.v1.list_namespaced_pod(self.namespace, label_selector = f"app={PREPULL_LABEL}").items
+    podtypes = {}
+    for name, ds in daemonsets.items():
+      labels = ds.metadata.labels or {}
+      nodes = {}
+      for pod in pods:
+        if (pod.metadata.labels or {}).get("prepull-daemonset") != name or not pod.spec.node_name or pod.metadata.deletion_timestamp:
+          continue
+        state, digest = pull_state(pod)
+        previous = nodes.get(pod.spec.node_name)
+        if previous is None or previous["state"] != "cached": # During a roll, a node that has the image keeps counting as cached
+          nodes[pod.spec.node_name] = {"state": state, "digest": digest}
+      desired = (ds.status.desired_number_scheduled or 0) if ds.status else 0
+      digests = {entry["digest"] for entry in nodes.values() if entry["state"] == "cached"}
+      everywhere = desired > 0 and len(nodes) >= desired and all(entry["state"] == "cached" for entry in nodes.values())
+      image = (ds.metadata.annotations or {}).get("podondemand/image")
+      podtypes.setdefault(labels.get("prepull-podtype"), {})[image] = {
+        "digest": next(iter(digests)) if everywhere and len(digests) == 1 else None, # May still be None if the runtime reported no digest
+        "desired": desired,
+        "nodes": nodes,
+      }
+    return {"updated": now, "podtypes": podtypes}
+
+# Written atomically, like the reaper's activity snapshot; readers never see a partial file
+def write_status(status, path = STATUS_PATH):
+  tmp = f"{path}.tmp"
+  try:
+    with open(tmp, 'w') as out:
+      json.dump(status, out, separators = (',', ':'))
+    os.chmod(tmp, 0o644) # Read by the frontend as the login user
+    os.replace(tmp, path)
+  except OSError as e:
+    print(f"ImagePrePuller: could not write status {path}: {str(e)}", file = sys.stderr)
+
+# Returns the last status written by write_status(), or an empty dict if there is none or it is too old to trust
+def read_status(path = STATUS_PATH, now = None):
+  now = time.time() if now is None else now
+  try:
+    with open(path, 'r') as f:
+      status = json.load(f)
+    return status if now - float(status.get("updated", 0)) <= STATUS_MAX_AGE else {}
+  except (OSError, ValueError, TypeError):
+    return {}
+
+# Image -> digest-pinned reference, for every image of the type that every eligible node has pulled. For
+# define_pod(images = ...).
+def pinned_images(status, podtype):
+  entries = (status.get("podtypes") or {}).get(podtype) or {}
+  return {image: pin_image(image, entry["digest"]) for image, entry in entries.items() if entry.get("digest") and not '@' in image}
+
+# Whether every pre-pulled image of the type was cached on the node, or None if the type isn't pre-pulled
+def images_cached_on(status, podtype, node):
+  entries = (status.get("podtypes") or {}).get(podtype)
+  if not entries or node is None:
+    return None
+  return all((entry.get("nodes") or {}).get(node, {}).get("state") == "cached" for entry in entries.values())
@@ -2,12 +2,21 @@
 import sys
 import os
 import datetime
-import traceback
 import time
 import subprocess
 import regex as re
 import shutil
 import uuid
+import grp
+import logging
+
+from filewatch import FileWatcher
+import podlog
+
+log = logging.getLogger("keyimportd")
+
+DEBOUNCE_SECS = 0.25 # Wait for writes to settle for this long before reconciling
+RESYNC_SECS = 600 # Reconcile at least this often, even if no change was noticed
 
 # Adapted from https://gist.github.com/Jd007/5573672
 # Forks the process and detaches ownership from the shell process to continue in background
@@ -48,7 +57,162 @@ def daemonize(stdout: str, stderr: str, stdin: str = None):
     os.dup2(se.fileno(), sys.stderr.fileno())
 
 
+KEY_PATTERN = re.compile(r'ssh-.* AAAA.*$') # The key after any command= param
+USER_AT_HOST_PATTERN = re.compile(r'(?<= )[A-Za-z0-9-_]+(?=@)')
+USER_PATTERN = re.compile(r'(?<= )[A-Za-z0-9-_]+(?=$)')
+
+# Parses authorized_keys into a dict of username -> key line
+def parse_authorized_keys(authorized_keys):
+  user_to_key_line = {}
+  with open(authorized_keys, 'r') as keys:
+    for line in keys:
+      if not line or line == '\n' or line.startswith('#'):
+        continue
+      try:
+        line = KEY_PATTERN.search(line).group(0)
+        username = USER_AT_HOST_PATTERN.search(line)
+        if username is None:
+          username = USER_PATTERN.search(line)
+        username = username.group(0)
+        if username in user_to_key_line:
+          # I want to get your attention.
+          log.error(f"DUPLICATE USER \"{username}\" FOUND! PLEASE CONSIDER RENAMING THIS USER! No changes made.",
+                    extra = {"event": "duplicate_user", "user": username})
+        user_to_key_line[username] = line
+      except Exception as e:
+        if isinstance(e, KeyboardInterrupt):
+          raise e
+        log.exception(f"Exception on line \"{line}\" of key file: {str(e)}", extra = {"event": "invalid_key_line"})
+  return user_to_key_line
+
+# Returns the key currently installed for a user, or None
+def read_installed_key(user, home_root = "/home"):
+  try:
+    with open(f"{home_root}/{user}/.ssh/authorized_keys", 'r') as userkeyfile:
+      return userkeyfile.read().strip()
+  except OSError:
+    return None
+
+# Writes a user's authorized_keys so sshd never sees a partially written file. For a new user, the whole .ssh
+# directory is built under another name and renamed into place, so it "suddenly appears" and surprises sshd.
+def install_key(user, keyline, home_root = "/home"):
+  home = f"{home_root}/{user}"
+  if not os.path.isdir(f"{home}/.ssh"):
+    os.makedirs(f"{home}/ssh", exist_ok = True)
+    os.chmod(f"{home}/ssh", 0o755)
+    shutil.chown(f"{home}/ssh", user=user, group=user)
+    sshdir = f"{home}/ssh"
+  else:
+    sshdir = f"{home}/.ssh"
+  with open(f"{sshdir}/authorized_keys.tmp", 'w') as userkeyfile:
+    userkeyfile.write(keyline + '\n')
+  os.chmod(f"{sshdir}/authorized_keys.tmp", 0o600)
+  shutil.chown(f"{sshdir}/authorized_keys.tmp", user=user, group=user)
+  os.replace(f"{sshdir}/authorized_keys.tmp", f"{sshdir}/authorized_keys")
+  if sshdir != f"{home}/.ssh":
+    os.rename(sshdir, f"{home}/.ssh")
+
+# Creates all the given users at once: one newusers call for the accounts, one chpasswd call to disable their
+# passwords and one gpasswd call to let them through sshd's AllowGroups, instead of three commands per user.
+# Falls back to adding users one at a time if the batch tools are not installed.
+def add_users(users):
+  if not users:
+    return
+  if shutil.which('newusers') and shutil.which('chpasswd') and shutil.which('gpasswd'):
+    # name:password:uid:gid:gecos:home:shell; empty uid/gid are allocated automatically. The password is replaced below.
+    entries = ''.join(f"{user}:{uuid.uuid4()}::::/home/{user}:/bin/bash\n" for user in users)
+    subprocess.run(['newusers'], input = entries, text = True, check = True)
+    subprocess.run(['chpasswd', '-e'], input = ''.join(f"{user}:*\n" for user in users), text = True, check = True)
+    members = set(grp.getgrnam('loginjail').gr_mem) | set(users)
+    subprocess.run(['gpasswd', '-M', ','.join(sorted(members)), 'loginjail'], check = True)
+    return
+  for user in users:
+    try:
+      subprocess.run(['adduser', '--disabled-password', '--gecos', '', user], check=True) # https://askubuntu.com/questions/94060/run-adduser-non-interactively
+      subprocess.run(['usermod', '-aG', 'loginjail', user], check=True)
+      subprocess.run(['usermod', '-p', '*', user], check=True)
+    except subprocess.CalledProcessError as e:
+      log.error(f'Command {e.cmd} failed with error {e.returncode}', extra = {"event": "command_failed", "user": user})
+
+def delete_user(user):
+  try:
+    subprocess.run(['deluser', '--remove-home', user], check=True)
+  except subprocess.CalledProcessError as e:
+    log.error(f'Command {e.cmd} failed with error {e.returncode}', extra = {"event": "command_failed", "user": user})
+
+# Brings the system users in line with the authorized_keys file: adds users that are missing, deletes users that
+# are no longer listed, and rewrites the key of users whose key changed. Only the difference against `snapshot`
+# (the username -> key line dict returned by the previous run) is applied; with no snapshot, installed keys are
+# read back from the home directories. Returns the new snapshot.
+def reconcile(authorized_keys, snapshot = None, home_root = "/home"):
+  timings = {}
+  start = t = time.monotonic()
+  user_to_key_line = parse_authorized_keys(authorized_keys)
+  ku_set = set(user_to_key_line.keys()) # All users in authorized_keys file
+  timings['parse'] = time.monotonic() - t
+
+  #sys_users_proc = subprocess.run(['getent', 'passwd'], capture_output=True) # All users currently in PodOnDemand container
+  #system_users = list(re.findall(r'^[A-Za-z0-9-_]+(?=:)', sys_users_proc.stdout.decode('UTF-8'))
+  system_users = os.listdir(home_root)
+  if 'login' in system_users:
+    system_users.remove('login')
+  su_set = set(system_users)
+
+  added = sorted(ku_set - su_set)
+  removed = sorted(su_set - ku_set)
+  changed = []
+  for user in ku_set & su_set:
+    installed = snapshot.get(user) if snapshot is not None and user in snapshot else read_installed_key(user, home_root)
+    if installed != user_to_key_line[user].strip():
+      changed.append(user)
+
+  # Add all users in key file not currently present on system
+  t = time.monotonic()
+  if added:
+    for user in added:
+      log.info(f"Adding new system user {user}", extra = {"event": "user_added", "user": user})
+    try:
+      add_users(added)
+    except subprocess.CalledProcessError as e:
+      log.error(f'Command {e.cmd} failed with error {e.returncode}', extra = {"event": "command_failed"})
+  timings['add'] = time.monotonic() - t
+
+  # Install keys for new users, and for existing users whose key changed
+  t = time.monotonic()
+  failed = set()
+  for user in added + sorted(changed):
+    try:
+      if user in changed:
+        log.info(f"Updating key for system user {user}", extra = {"event": "key_updated", "user": user})
+      install_key(user, user_to_key_line[user], home_root)
+    except Exception as e:
+      if isinstance(e, KeyboardInterrupt):
+        raise e
+      failed.add(user) # Left out of the snapshot, so it is retried next time
+      log.exception(f"Installing the key of {user} failed: {str(e)}", extra = {"event": "key_failed", "user": user})
+  timings['keys'] = time.monotonic() - t
+
+  # Delete all users present on system but not in authorized_keys file
+  t = time.monotonic()
+  for user in removed:
+    log.info(f"Deleting system user {user} not present in authorized_keys", extra = {"event": "user_deleted", "user": user})
+    try:
+      delete_user(user)
+    except Exception as e:
+      if isinstance(e, KeyboardInterrupt):
+        raise e
+      log.exception(f"Deleting {user} failed: {str(e)}", extra = {"event": "user_delete_failed", "user": user})
+  timings['delete'] = time.monotonic() - t
+
+  if added or removed or changed:
+    log.info(f"Reconciled {len(ku_set)} users (+{len(added)} -{len(removed)} ~{len(changed)}) in " +
+             ', '.join(f"{phase} {secs:.3f}s" for phase, secs in timings.items()), extra = {"event": "reconcile", "duration": time.monotonic() - start})
+  return {user: keyline.strip() for user, keyline in user_to_key_line.items() if not user in failed}
+
+
 # Monitors ~/.ssh/authorized_keys, and adds users present in the file, or deletes users not present.
+# Changes are picked up through inotify (see filewatch.py); bursts of events are debounced into one reconcile,
+# and a slow periodic resync catches anything the watch may have missed.
 def main(argv):
   sshdir = os.path.expanduser("~/.ssh")
   authorized_keys = sshdir + "/authorized_keys"
@@ -61,108 +225,25 @@ def main(argv):
   
   print("Starting keyimportd on " + str(datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y")))
   #daemonize(sys.stdout, sys.stderr, sys.stdin)
-  daemonize(stdout = os.getenv("HOME") + "/logs/keyimportd_out.log", stderr = os.getenv("HOME") + "/logs/keyimportd_err.log")
-  oldmtime = None
+  # Only output from below Python (eg. the interpreter crashing) still goes to the _err file; everything else is logged
+  daemonize(stdout = os.devnull, stderr = os.getenv("HOME") + "/logs/keyimportd_err.log")
+  podlog.capture_stdio(podlog.setup("keyimportd"))
+  log.info("Started keyimportd", extra = {"event": "start"})
+  watcher = FileWatcher(authorized_keys)
+  if not watcher.uses_inotify:
+    log.warning(f"inotify is unavailable; polling {authorized_keys} every {watcher.poll_interval} seconds instead")
+  snapshot = None
   while True:
     try:
-      while True:
-        mtime = os.path.getmtime(authorized_keys)
-        if oldmtime != mtime:
-          oldmtime = mtime
-
-          # All users in authorized_keys file
-          ku_set = set()
-
-          # Parse and read authorized_keys into ku_set, and fill user_to_key_line
-          user_to_key_line = {}
-          with open(authorized_keys, 'r') as keys:
-            for line in keys:
-              if not line or line == '\n' or line.startswith('#'):
-                continue
-              line = re.search(r'ssh-.* AAAA.*$', line).group(0) # Get the key after any command= param
-              try:
-                username = re.search(r'(?<= )[A-Za-z0-9-_]+(?=@)', line)
-                if username is None:
-                  username = re.search(r'(?<= )[A-Za-z0-9-_]+(?=$)', line)
-                username = username.group(0)
-                if username in ku_set:
-                  # I want to get your attention.
-                  print(datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y"), file = sys.stdout)
-                  print(datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y"), file = sys.stderr)
-                  msg = f"WARNING: DUPLICATE USER \"{username}\" FOUND! PLEASE CONSIDER RENAMING THIS USER! No changes made."
-                  print(msg, file = sys.stdout)
-                  print(msg, file = sys.stderr)
-                ku_set.add(username)
-                user_to_key_line[username] = line
-              except Exception as e:
-                if isinstance(e, KeyboardInterrupt):
-                  raise e
-                print(datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y"))
-                traceback.print_tb(e.__traceback__)
-                print(f"Exception on line \"{line}\" of key file: {str(e)}")
-          
-          
-
-          #sys_users_proc = subprocess.run(['getent', 'passwd'], capture_output=True) # All users currently in PodOnDemand container
-          #system_users = list(re.findall(r'^[A-Za-z0-9-_]+(?=:)', sys_users_proc.stdout.decode('UTF-8'))
-          system_users = os.listdir('/home')
-          system_users.remove('login')
-          su_set = set(system_users)
-          
-          # Add all users in key file not currently present on system
-          for user in ku_set:
-            if not user in su_set:
-              try:
-                try:
-                  print(f"Adding new system user {user}...")
-                  subprocess.run(['adduser', '--disabled-password', '--gecos', '', user], check=True) # https://askubuntu.com/questions/94060/run-adduser-non-interactively
-                  subprocess.run(['usermod', '-aG', 'loginjail', user], check=True)
-                  #subprocess.run(['usermod', '-p', '*', user], check=True) # Disable password for this user
-                  #subprocess.run(['sh', '-c' 'echo "{user}:{str(uuid.uuid4())}" | chpasswd -e'], check=True)
-                  subprocess.run(['usermod', '-p', '*', user], check=True)
-                  os.mkdir(f"/home/{user}/ssh")
-                  os.chmod(f"/home/{user}/ssh", 0o755)
-                  shutil.chown(f"/home/{user}/ssh", user=user, group=user)
-                  with open(f"/home/{user}/ssh/authorized_keys", 'w') as userkeyfile:
-                    keyline = user_to_key_line[user]
-                    userkeyfile.write(keyline)
-                  os.chmod(f"/home/{user}/ssh/authorized_keys", 0o600)
-                  shutil.chown(f"/home/{user}/ssh/authorized_keys", user=user, group=user)
-                  os.rename(f"/home/{user}/ssh", f"/home/{user}/.ssh") # Make it so the .ssh directory "suddenly appears" and surprises sshd
-                except subprocess.CalledProcessError as e:
-                  print(f'Command {e.cmd} failed with error {e.returncode}')
-              except Exception as e:
-                if isinstance(e, KeyboardInterrupt):
-                  raise e
-                print(datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y"))
-                traceback.print_tb(e.__traceback__)
-                print(str(e), file = sys.stderr)
-          
-          # Delete all users present on system but not in authorized_keys file
-          for user in su_set:
-            if not user in ku_set:
-              # Delete user
-              try:
-                try:
-                  print(f"Deleting system user {user} not present in authorized_keys...")
-                  subprocess.run(['deluser', '--remove-home', user], check=True)
-                except subprocess.CalledProcessError as e:
-                  print(f'Command {e.cmd} failed with error {e.returncode}')
-              except Exception as e:
-                if isinstance(e, KeyboardInterrupt):
-                  raise e
-                print(datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y"))
-                traceback.print_tb(e.__traceback__)
-                print(str(e), file = sys.stderr)
-
-
-          time.sleep(5)
+      snapshot = reconcile(authorized_keys, snapshot)
+      if not watcher.wait_for_change(debounce = DEBOUNCE_SECS, resync = RESYNC_SECS): # Sleeps with zero CPU until the file changes
+        snapshot = None # Periodic resync: check installed keys against the home directories again
     except (KeyboardInterrupt, Exception) as e:
       if isinstance(e, KeyboardInterrupt):
         raise e
-      traceback.print_tb(e.__traceback__)
-      print(repr(e))
-
+      log.exception(f"Reconcile failed: {repr(e)}", extra = {"event": "error"})
+      snapshot = None
+      time.sleep(5)
 
 
 
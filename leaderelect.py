@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+import os
+import sys
+import time
+import datetime
+import threading
+import traceback
+
+# Leader election over a coordination.k8s.io Lease, so that only one replica acts on the cluster (eg. deletes pods)
+# while the others stand by. The holder renews the Lease every retry_period; another replica takes it over once it
+# has seen the same, unrenewed Lease for lease_duration seconds. Expiry is judged by the time at which this replica
+# observed the Lease last change, not by the timestamps in it, so clock skew between nodes doesn't matter.
+# Every write carries the resourceVersion that was read, so two replicas can never both win the same round.
+# A leader that cannot renew within renew_deadline steps down by itself, before anyone else can take over.
+class LeaderElector:
+  def __init__(self, coordination_api, namespace, name, identity = None, lease_duration = 15, renew_deadline = 10, retry_period = 2):
+    self.api = coordination_api
+    self.namespace = namespace
+    self.name = name
+    self.identity = identity or os.getenv("HOSTNAME", default = "unknown")
+    self.lease_duration = lease_duration
+    self.renew_deadline = renew_deadline
+    self.retry_period = retry_period
+    self._leader = False
+    self._last_renew = 0 # When we last renewed successfully (monotonic)
+    self._observed = None # (holder, renew_time) of the Lease as last read
+    self._observed_time = 0 # When it last changed (monotonic)
+    self._stopped = threading.Event()
+    self._thread = None
+
+  def is_leader(self):
+    # Also checked here, so a leader whose renewals are stuck stops acting even before the thread notices
+    return self._leader and time.monotonic() - self._last_renew < self.renew_deadline
+
+  def start(self):
+    self._thread = threading.Thread(target = self._run, name = "leader-election", daemon = True)
+    self._thread.start()
+    return self
+
+  # Gives up the Lease (if held) so another replica can take over at once, instead of after lease_duration
+  def release(self):
+    self._stopped.set()
+    if not self._leader:
+      return
+    self._leader = False
+    try:
+      lease = self.api.read_namespaced_lease(self.name, self.namespace)
+      if lease.spec.holder_identity == self.identity:
+        lease.spec.holder_identity = None
+        lease.spec.renew_time = None
+        self.api.replace_namespaced_lease(self.name, self.namespace, lease)
+    except Exception as e:
+      print(f"LeaderElector: could not release lease {self.name}: {repr(e)}", file = sys.stderr)
+
+  def _now(self):
+    return datetime.datetime.now(datetime.timezone.utc)
+
+  def _try_acquire_or_renew(self):
+    try:
+      lease = self.api.read_namespaced_lease(self.name, self.namespace)
+    except ApiException as e:
+      if e.status != 404:
+        raise e
+      body = client.V1Lease(metadata = client.V1ObjectMeta(name = self.name),
+                            spec = client.V1LeaseSpec(holder_identity = self.identity, lease_duration_seconds = self.lease_duration,
+                                                      acquire_time = self._now(), renew_time = self._now(), lease_transitions = 0))
+      try:
+        self.api.create_namespaced_lease(self.namespace, body)
+        return True
+      except ApiException as e:
+        if e.status == 409: # Someone else created it first
+          return False
+        raise e
+
+    spec = lease.spec
+    observed = (spec.holder_identity, spec.renew_time)
+    if observed != self._observed:
+      self._observed = observed
+      self._observed_time = time.monotonic()
+    held_by_other = spec.holder_identity and spec.holder_identity != self.identity
+    if held_by_other and self._leader:
+      print(f"LeaderElector: {spec.holder_identity} has taken over the lease {self.name}", file = sys.stderr)
+      self._leader = False
+    if held_by_other and time.monotonic() - self._observed_time < (spec.lease_duration_seconds or self.lease_duration):
+      return False # Still validly held by someone else
+
+    if spec.holder_identity != self.identity:
+      spec.acquire_time = self._now()
+      spec.lease_transitions = (spec.lease_transitions or 0) + 1
+    spec.holder_identity = self.identity
+    spec.lease_duration_seconds = self.lease_duration
+    spec.renew_time = self._now()
+    try:
+      self.api.replace_namespaced_lease(self.name, self.namespace, lease) # Carries the resourceVersion we read
+      return True
+    except ApiException as e:
+      if e.status == 409: # Changed since we read it
+        return False
+      raise e
+
+  def _run(self):
+    while not self._stopped.is_set():
+      try:
+        acquired = self._try_acquire_or_renew()
+      except Exception as e:
+        traceback.print_tb(e.__traceback__)
+        print(f"LeaderElector: lease {self.name} update failed: {repr(e)}", file = sys.stderr)
+        acquired = False
+      if self._stopped.is_set():
+        break
+      if acquired:
+        self._last_renew = time.monotonic()
+        if not self._leader:
+          print(f"LeaderElector: {self.identity} is now the leader for {self.name}", file = sys.stderr)
+        self._leader = True
+      elif self._leader and time.monotonic() - self._last_renew >= self.renew_deadline:
+        print(f"LeaderElector: {self.identity} lost the lease {self.name}", file = sys.stderr)
+        self._leader = False
+      self._stopped.wait(self.retry_period)
@@ -4,4 +4,4 @@ set -o allexport
 source /var/run/startup_environment
 set +o allexport
 
-/home/login/run_pod.py "$@"
\ No newline at end of file
+/home/login/frontend_client.py "$@" # Falls back to running run_pod.py directly if frontendd is not running
\ No newline at end of file
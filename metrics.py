@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import time
+import bisect
+import threading
+import functools
+import http.server
+
+# Minimal Prometheus-style metrics, on the standard library only. Metrics are updated in place under a short lock,
+# and an HTTP scrape only takes a snapshot under that lock before rendering, so it never holds up the caller.
+# Exposed in the Prometheus text format at /metrics by serve().
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(names, values, extra = None):
+  pairs = list(zip(names, values)) + (extra or [])
+  if not pairs:
+    return ''
+  return '{' + ','.join(f'{k}="{str(v)}"'.replace('\n', ' ') for k, v in pairs) + '}'
+
+class Metric:
+  type = None
+
+  def __init__(self, registry, name, help, labelnames = ()):
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self._lock = registry.lock
+    self._values = {}
+    registry.metrics.append(self)
+
+  def _key(self, labels):
+    return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+class Counter(Metric):
+  type = "counter"
+
+  def inc(self, amount = 1, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + amount
+
+  def _render(self, values):
+    return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in values.items()]
+
+class Gauge(Counter):
+  type = "gauge"
+
+  def set(self, value, **labels):
+    key = self._key(labels)
+    with self._lock:
+      self._values[key] = value
+
+class Histogram(Metric):
+  type = "histogram"
+
+  def __init__(self, registry, name, help, labelnames = (), buckets = DEFAULT_BUCKETS):
+    super().__init__(registry, name, help, labelnames)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value, **labels):
+    key = self._key(labels)
+    index = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+      counts = list(counts)
+      counts[index] += 1
+      self._values[key] = (counts, total + value)
+
+  # Times the enclosed block. Usage: with histogram.time(verb = "list"): ...
+  def time(self, **labels):
+    histogram = self
+    class _Timer:
+      def __enter__(self):
+        self.start = time.perf_counter()
+      def __exit__(self, *exc):
+        histogram.observe(time.perf_counter() - self.start, **labels)
+    return _Timer()
+
+  def _render(self, values):
+    lines = []
+    for key, (counts, total) in values.items():
+      cumulative = 0
+      for bound, count in zip(list(self.buckets) + ['+Inf'], counts):
+        cumulative += count
+        lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+      lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+      lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+    return lines
+
+class Registry:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.metrics = []
+
+  def counter(self, name, help, labelnames = ()):
+    return Counter(self, name, help, labelnames)
+
+  def gauge(self, name, help, labelnames = ()):
+    return Gauge(self, name, help, labelnames)
+
+  def histogram(self, name, help, labelnames = (), buckets = DEFAULT_BUCKETS):
+    return Histogram(self, name, help, labelnames, buckets)
+
+  def render(self):
+    with self.lock: # Only copy under the lock; formatting happens outside it
+      snapshot = [(metric, dict(metric._values)) for metric in self.metrics]
+    lines = []
+    for metric, values in snapshot:
+      lines.append(f"# HELP {metric.name} {metric.help}")
+      lines.append(f"# TYPE {metric.name} {metric.type}")
+      lines += metric._render(values)
+    return '\n'.join(lines) + '\n'
+
+# Serves the registry at http://<address>:<port>/metrics from a background thread
+def serve(registry, port, address = ''):
+  class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+      if self.path.split('?')[0] != '/metrics':
+        self.send_error(404)
+        return
+      body = registry.render().encode('UTF-8')
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass # Don't log every scrape
+
+  server = http.server.ThreadingHTTPServer((address, port), Handler)
+  server.daemon_threads = True
+  threading.Thread(target = server.serve_forever, name = "metrics-http", daemon = True).start()
+  return server
+
+# Wraps a kubernetes API object (eg. CoreV1Api) so that every call is timed in `latency` and failures counted in
+# `errors`, both labeled with the verb (list, read, create, delete, patch, ...) taken from the method name.
+class InstrumentedApi:
+  def __init__(self, api, latency, errors):
+    self._api = api
+    self._latency = latency
+    self._errors = errors
+
+  def __getattr__(self, name):
+    attr = getattr(self._api, name)
+    if not callable(attr) or name.startswith('_'):
+      return attr
+    verb = name.split('_', 1)[0]
+    latency = self._latency
+    errors = self._errors
+
+    @functools.wraps(attr) # watch.Watch reads the wrapped method's docstring to find its return type
+    def call(*args, **kwargs):
+      start = time.perf_counter()
+      try:
+        return attr(*args, **kwargs)
+      except Exception:
+        errors.inc(verb = verb)
+        raise
+      finally:
+        latency.observe(time.perf_counter() - start, verb = verb)
+    return call
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+import sys
+import time
+import threading
+import traceback
+
+# A local, watch-backed cache ("informer") of user pods. Does one initial LIST, then keeps an in-memory index
+# up to date from a WATCH stream, resuming from the last seen resourceVersion and relisting when the server
+# reports it as expired (410 Gone). Readers never touch the API server, so polling it is free.
+class PodInformer:
+  def __init__(self, v1, namespace, name_prefix = "userpod", label_selector = "podtype", watch_timeout_seconds = 300):
+    self.v1 = v1
+    self.namespace = namespace
+    self.name_prefix = name_prefix
+    self.label_selector = label_selector
+    self.watch_timeout_seconds = watch_timeout_seconds
+    self.resource_version = None
+    self._lock = threading.Lock()
+    self._by_name = {}
+    self._by_ip = {}
+    self._synced = threading.Event()
+    self._stopped = threading.Event()
+    self._watcher = None
+    self._thread = None
+    self._listeners = []
+
+  # Registers fn(event_type, pod) to be called (from the informer thread) on every change.
+  # event_type is one of "ADDED", "MODIFIED" or "DELETED"; a relist reports every pod as "ADDED".
+  def add_listener(self, fn):
+    self._listeners.append(fn)
+
+  def start(self):
+    self._thread = threading.Thread(target = self._run, name = "pod-informer", daemon = True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._stopped.set()
+    if self._watcher is not None:
+      self._watcher.stop()
+
+  # Blocks until the initial LIST has been loaded, or the timeout expires. Returns whether it has synced.
+  def wait_for_sync(self, timeout = None):
+    return self._synced.wait(timeout)
+
+  def pods(self):
+    with self._lock:
+      return list(self._by_name.values())
+
+  def get(self, name):
+    with self._lock:
+      return self._by_name.get(name)
+
+  def get_by_ip(self, ip):
+    with self._lock:
+      return self._by_ip.get(ip)
+
+  def _notify(self, event_type, pod):
+    for fn in self._listeners:
+      try:
+        fn(event_type, pod)
+      except Exception as e:
+        traceback.print_tb(e.__traceback__)
+        print(f"{type(self).__name__} listener failed: {repr(e)}", file = sys.stderr)
+
+  def _wanted(self, pod):
+    return pod.metadata.name.startswith(self.name_prefix)
+
+  # The LIST call (and its arguments) that both the relist and the watch use
+  def _list_call(self):
+    return (self.v1.list_namespaced_pod, {"namespace": self.namespace, "label_selector": self.label_selector})
+
+  # Must be called with self._lock held
+  def _index(self, pod):
+    self._unindex(pod.metadata.name)
+    self._by_name[pod.metadata.name] = pod
+    if pod.status and pod.status.pod_ip:
+      self._by_ip[pod.status.pod_ip] = pod
+
+  # Must be called with self._lock held
+  def _unindex(self, name):
+    old = self._by_name.pop(name, None)
+    if old is not None and old.status and old.status.pod_ip and self._by_ip.get(old.status.pod_ip) is old:
+      self._by_ip.pop(old.status.pod_ip)
+    return old
+
+  def _relist(self):
+    list_func, list_args = self._list_call()
+    pod_list = list_func(**list_args)
+    pods = [pod for pod in pod_list.items if self._wanted(pod)]
+    names = {pod.metadata.name for pod in pods}
+    with self._lock:
+      removed = [pod for name, pod in self._by_name.items() if not name in names]
+      self._by_name = {}
+      self._by_ip = {}
+      for pod in pods:
+        self._index(pod)
+      self.resource_version = pod_list.metadata.resource_version
+    for pod in removed:
+      self._notify("DELETED", pod)
+    for pod in pods:
+      self._notify("ADDED", pod)
+    self._synced.set()
+
+  def _apply(self, event_type, pod):
+    if not self._wanted(pod):
+      return
+    with self._lock:
+      if event_type == "DELETED":
+        self._unindex(pod.metadata.name)
+      else:
+        self._index(pod)
+    self._notify(event_type, pod)
+
+  def _watch(self):
+    self._watcher = watch.Watch()
+    list_func, list_args = self._list_call()
+    stream = self._watcher.stream(list_func, **list_args, resource_version = self.resource_version,
+                                  timeout_seconds = self.watch_timeout_seconds, allow_watch_bookmarks = True)
+    for event in stream:
+      if self._stopped.is_set():
+        return
+      event_type = event['type']
+      obj = event['object']
+      if event_type == "ERROR":
+        # Older clients yield the Status object instead of raising
+        code = obj.get('code') if isinstance(obj, dict) else getattr(obj, 'code', None)
+        raise ApiException(status = code, reason = str(obj))
+      self.resource_version = obj.metadata.resource_version
+      if event_type == "BOOKMARK":
+        continue
+      self._apply(event_type, obj)
+
+  def _run(self):
+    while not self._stopped.is_set():
+      try:
+        if self.resource_version is None:
+          self._relist()
+        self._watch() # Returns when the server closes the stream after watch_timeout_seconds; resume from resource_version
+      except ApiException as e:
+        if e.status == 410: # Gone: our resourceVersion is too old to resume from
+          self.resource_version = None
+        else:
+          print(f"{type(self).__name__} watch failed: {str(e)}", file = sys.stderr)
+          time.sleep(1)
+      except Exception as e:
+        traceback.print_tb(e.__traceback__)
+        print(f"{type(self).__name__} watch failed: {repr(e)}", file = sys.stderr)
+        self.resource_version = None # Relist; the stream may have dropped events
+        time.sleep(1)
+
+# The same cache for the cluster's nodes (which are not namespaced), indexed by name only
+class NodeInformer(PodInformer):
+  def __init__(self, v1, watch_timeout_seconds = 300):
+    super().__init__(v1, None, name_prefix = "", label_selector = None, watch_timeout_seconds = watch_timeout_seconds)
+
+  def _list_call(self):
+    return (self.v1.list_node, {})
+
+  # Must be called with self._lock held
+  def _index(self, node):
+    self._by_name[node.metadata.name] = node
+
+  # Must be called with self._lock held
+  def _unindex(self, name):
+    return self._by_name.pop(name, None)
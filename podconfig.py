@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+import sys
+import time
+import yaml
+import threading
+import traceback
+
+# Parsed, validated view of the podondemand-config ConfigMap, and a watcher that keeps one up to date.
+#
+# Everything is parsed and checked once per ConfigMap version, when it is loaded: podChoices, storageChoices and
+# every manifest in podManifests. Each manifest is compiled into a PodTemplate that knows where its substitution
+# points are (pod name, labels, container args, the home volume mount and its claim), so spawning a pod is a cheap
+# copy-and-fill instead of re-parsing YAML and editing it in place. Problems are reported as a ConfigError at load
+# time, rather than when a user's pod is rejected by the API server.
+
+CONFIG_MAP_NAME = "podondemand-config"
+
+class ConfigError(ValueError):
+  pass
+
+def _expect(condition, path, message):
+  if not condition:
+    raise ConfigError(f"{CONFIG_MAP_NAME}: {path}: {message}")
+
+def _is_positive_number(value):
+  try:
+    return float(value) > 0
+  except (TypeError, ValueError):
+    return False
+
+def _load_yaml(data, key, required = True):
+  if not data.get(key):
+    _expect(not required, key, "is missing")
+    return {}
+  try:
+    value = yaml.safe_load(data[key])
+  except yaml.YAMLError as e:
+    raise ConfigError(f"{CONFIG_MAP_NAME}: {key}: invalid YAML: {str(e)}")
+  _expect(isinstance(value, dict), key, "expected a mapping of names to entries")
+  return value
+
+# A pod manifest with declared substitution points. Only the dicts and lists along the substituted paths are copied
+# when filling it in; everything else is shared with the template and must not be modified.
+class PodTemplate:
+  def __init__(self, podtype, manifest):
+    path = f"podManifests.{podtype}"
+    _expect(isinstance(manifest, dict), path, "expected a pod manifest")
+    _expect(isinstance(manifest.get("metadata"), dict), f"{path}.metadata", "is missing")
+    spec = manifest.get("spec")
+    _expect(isinstance(spec, dict), f"{path}.spec", "is missing")
+    containers = spec.get("containers")
+    _expect(isinstance(containers, list) and containers and isinstance(containers[0], dict), f"{path}.spec.containers", "expected a non-empty list")
+    _expect(containers[0].get("image"), f"{path}.spec.containers[0].image", "is missing")
+    mounts = containers[0].get("volumeMounts")
+    _expect(isinstance(mounts, list) and mounts and isinstance(mounts[0], dict), f"{path}.spec.containers[0].volumeMounts",
+            "expected a list whose first entry is the user's home directory mount")
+    volumes = spec.get("volumes")
+    _expect(isinstance(volumes, list) and volumes and isinstance(volumes[0], dict), f"{path}.spec.volumes",
+            "expected a list whose first entry is the user storage volume")
+    _expect(isinstance(volumes[0].get("persistentVolumeClaim"), dict), f"{path}.spec.volumes[0].persistentVolumeClaim", "is missing")
+    _expect(mounts[0].get("name") == volumes[0].get("name"), f"{path}.spec.containers[0].volumeMounts[0].name",
+            f"must mount the first volume, \"{volumes[0].get('name')}\"")
+    labels = manifest["metadata"].get("labels")
+    _expect(labels is None or isinstance(labels, dict), f"{path}.metadata.labels", "expected a mapping")
+    try:
+      client.V1Pod(**manifest) # Catches unknown top-level fields (and, with newer clients, invalid values)
+    except (TypeError, ValueError) as e:
+      raise ConfigError(f"{CONFIG_MAP_NAME}: {path}: {str(e)}")
+    self.podtype = podtype
+    self.manifest = manifest
+
+  # Returns a V1Pod for this template. mount_path and sub_path set the home volume mount (sub_path None removes it),
+  # and claim_name, if given, replaces the storage volume and claim name. images, if given, maps image references to
+  # use instead (eg. pinned to a digest that is already on the nodes, see imageprepull.py); those are then only
+  # pulled if not present.
+  def fill(self, name, labels, args, mount_path, sub_path = None, claim_name = None, images = None):
+    m = self.manifest
+    container = dict(m["spec"]["containers"][0])
+    mount = dict(container["volumeMounts"][0])
+    mount["mountPath"] = mount_path
+    if sub_path is None:
+      mount.pop("subPath", None)
+    else:
+      mount["subPath"] = sub_path
+    volumes = list(m["spec"]["volumes"])
+    if claim_name is not None:
+      mount["name"] = claim_name
+      volumes[0] = dict(volumes[0], name = claim_name, persistentVolumeClaim = dict(volumes[0]["persistentVolumeClaim"], claimName = claim_name))
+    container["volumeMounts"] = [mount] + container["volumeMounts"][1:]
+    container["args"] = args
+    spec = dict(m["spec"], containers = [container] + m["spec"]["containers"][1:], volumes = volumes)
+    if images:
+      for field in ("initContainers", "containers"):
+        if spec.get(field):
+          spec[field] = [dict(c, image = images[c["image"]], imagePullPolicy = "IfNotPresent") if c.get("image") in images else c for c in spec[field]]
+    metadata = dict(m["metadata"], name = name, labels = dict(m["metadata"].get("labels") or {}, **labels))
+    return client.V1Pod(**dict(m, metadata = metadata, spec = spec))
+
+# An immutable, validated snapshot of the ConfigMap. `data` is the raw ConfigMap data, so code written against a
+# V1ConfigMap (config_map.data["serviceName"]) works unchanged.
+class PodOnDemandConfig:
+  def __init__(self, config_map):
+    self.config_map = config_map
+    self.data = dict(config_map.data or {})
+    self.resource_version = config_map.metadata.resource_version if config_map.metadata else None
+    self.immutable = bool(getattr(config_map, 'immutable', False))
+
+    for key in ("inactivityTimeoutSecs", "inactivityPollFreq"):
+      _expect(str(self.data.get(key, '')).isdigit() and int(self.data[key]) > 0, key, "expected a positive whole number of seconds")
+    _expect(self.data.get("serviceName"), "serviceName", "is missing")
+    _expect(str(self.data.get("spawnQueueMaxPerUser", 2)).isdigit() and int(self.data.get("spawnQueueMaxPerUser", 2)) > 0,
+            "spawnQueueMaxPerUser", "expected a positive whole number")
+    _expect(_is_positive_number(self.data.get("reaperTimeScale", 1)), "reaperTimeScale", "expected a positive number")
+    _expect(str(self.data.get("imagePrePullRefreshSecs", 21600)).isdigit() and int(self.data.get("imagePrePullRefreshSecs", 21600)) > 0,
+            "imagePrePullRefreshSecs", "expected a positive whole number of seconds")
+
+    self.pod_choices = _load_yaml(self.data, "podChoices")
+    _expect(self.pod_choices, "podChoices", "no pod types are defined")
+    for name, choice in self.pod_choices.items():
+      _expect(isinstance(choice, dict), f"podChoices.{name}", "expected a mapping")
+      for field in ("displayName", "description"):
+        _expect(field in choice, f"podChoices.{name}.{field}", "is missing")
+      for field in ("activityMinBytes", "activityWindowSecs", "maxPerUser"):
+        _expect(str(choice.get(field, 0)).isdigit(), f"podChoices.{name}.{field}", "expected a whole number")
+      _expect(isinstance(choice.get("prePull", False), bool), f"podChoices.{name}.prePull", "expected true or false")
+      _expect(choice.get("reuse", "new") in ("attach", "new"), f"podChoices.{name}.reuse", "expected \"attach\" or \"new\"")
+
+    self.storage_choices = _load_yaml(self.data, "storageChoices", required = False)
+    for name, choice in self.storage_choices.items():
+      _expect(isinstance(choice, dict) and "description" in choice, f"storageChoices.{name}.description", "is missing")
+
+    manifests = _load_yaml(self.data, "podManifests")
+    for name in self.pod_choices:
+      _expect(name in manifests, f"podManifests.{name}", f"no manifest for pod type \"{name}\" listed in podChoices")
+    self.templates = {name: PodTemplate(name, manifest) for name, manifest in manifests.items()}
+
+# Keeps a current PodOnDemandConfig. Loads the ConfigMap once, then (unless it is immutable) watches it and re-parses
+# it on every new resourceVersion. An invalid update is logged and ignored, keeping the last good configuration, so a
+# bad edit never takes down running replicas. Pass a CoreV1Api that isn't shared with code that forks (eg. frontendd),
+# since the watch holds a connection of its own.
+class ConfigWatcher:
+  def __init__(self, v1, namespace, name = CONFIG_MAP_NAME, watch_timeout_seconds = 300):
+    self.v1 = v1
+    self.namespace = namespace
+    self.name = name
+    self.watch_timeout_seconds = watch_timeout_seconds
+    self._listeners = []
+    self._thread = None
+    self.current = PodOnDemandConfig(v1.read_namespaced_config_map(name, namespace)) # Raises ConfigError if invalid
+
+  # Registers fn(new_config) to be called (from the watcher thread) whenever a new valid configuration is loaded
+  def add_listener(self, fn):
+    self._listeners.append(fn)
+
+  def start(self):
+    if self.current.immutable:
+      return self # Cannot change; nothing to watch
+    self._thread = threading.Thread(target = self._run, name = "config-watcher", daemon = True)
+    self._thread.start()
+    return self
+
+  def _update(self, config_map):
+    if config_map.metadata.resource_version == self.current.resource_version:
+      return
+    try:
+      new = PodOnDemandConfig(config_map)
+    except ConfigError as e:
+      print(f"Ignoring invalid configuration update (resourceVersion {config_map.metadata.resource_version}), keeping the previous one: {str(e)}", file = sys.stderr)
+      return
+    self.current = new # A single reference swap; readers see either the old or the new snapshot
+    print(f"Loaded configuration resourceVersion {new.resource_version}", file = sys.stderr)
+    for fn in self._listeners:
+      try:
+        fn(new)
+      except Exception as e:
+        traceback.print_tb(e.__traceback__)
+        print(f"ConfigWatcher listener failed: {repr(e)}", file = sys.stderr)
+
+  def _run(self):
+    resource_version = self.current.resource_version
+    while True:
+      try:
+        w = watch.Watch()
+        for event in w.stream(self.v1.list_namespaced_config_map, namespace = self.namespace, field_selector = f"metadata.name={self.name}",
+                              resource_version = resource_version, timeout_seconds = self.watch_timeout_seconds):
+          if event['type'] == "ERROR":
+            obj = event['object']
+            raise ApiException(status = obj.get('code') if isinstance(obj, dict) else getattr(obj, 'code', None), reason = str(obj))
+          resource_version = event['object'].metadata.resource_version
+          if event['type'] in ("ADDED", "MODIFIED"):
+            self._update(event['object'])
+      except Exception as e:
+        if not (isinstance(e, ApiException) and e.status == 410):
+          print(f"ConfigWatcher watch failed: {repr(e)}", file = sys.stderr)
+          time.sleep(1)
+        # Start again from the current object
+        try:
+          config_map = self.v1.read_namespaced_config_map(self.name, self.namespace)
+          self._update(config_map)
+          resource_version = config_map.metadata.resource_version
+        except Exception as e:
+          print(f"ConfigWatcher could not re-read {self.name}: {repr(e)}", file = sys.stderr)
+          time.sleep(5)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+import logging
+import logging.handlers
+import queue
+import json
+import gzip
+import shutil
+import socket
+import datetime
+import argparse
+import atexit
+import time
+import sys
+import os
+import re
+
+# Structured logs for the daemons and sshd. Each record is one line of JSON:
+#   {"ts": ..., "level": ..., "component": ..., "replica": ..., "event": ..., "pod": ..., "user": ..., "duration": ..., "msg": ...}
+# where event, pod, user and duration are only present if given (log.info(msg, extra = {"event": ..., "pod": ...})).
+#
+# Logging calls only put the record on an in-memory queue; a single listener thread formats and writes them, so a
+# slow or stalled logs volume never holds up the reaper or the key importer. Every replica writes its own file,
+# logs/<component>/<replica>.jsonl (the logs volume is shared), which is rotated when it reaches
+# PODONDEMAND_LOG_MAX_BYTES or is PODONDEMAND_LOG_ROTATE_SECS old, keeping PODONDEMAND_LOG_BACKUPS gzipped old files.
+
+LOG_DIR = os.environ.get("PODONDEMAND_LOG_DIR", default = "/home/login/logs")
+MAX_BYTES = int(os.environ.get("PODONDEMAND_LOG_MAX_BYTES", default = 16 * 1024 * 1024))
+ROTATE_SECS = int(os.environ.get("PODONDEMAND_LOG_ROTATE_SECS", default = 86400))
+BACKUPS = int(os.environ.get("PODONDEMAND_LOG_BACKUPS", default = 7))
+REPLICA = socket.gethostname()
+FIELDS = ("event", "pod", "user", "duration")
+
+class JsonFormatter(logging.Formatter):
+  def __init__(self, component):
+    super().__init__()
+    self.component = component
+
+  def format(self, record):
+    entry = {"ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec = 'milliseconds'),
+             "level": record.levelname.lower(), "component": self.component, "replica": REPLICA}
+    for field in FIELDS:
+      value = getattr(record, field, None)
+      if value is not None:
+        entry[field] = round(value, 6) if field == "duration" else value
+    entry["msg"] = record.getMessage() # Includes the traceback, if any (added by the QueueHandler)
+    return json.dumps(entry)
+
+def _gzip_rotate(source, dest):
+  with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+    shutil.copyfileobj(src, dst)
+  os.remove(source)
+
+# Rotates by size or by age, whichever comes first, and compresses the rotated files (<file>.1.gz is the newest).
+# The age counts from when this process opened (or last rotated) the file.
+class RotatingJsonFileHandler(logging.handlers.RotatingFileHandler):
+  def __init__(self, path, max_bytes = MAX_BYTES, rotate_secs = ROTATE_SECS, backups = BACKUPS):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    super().__init__(path, maxBytes = max_bytes, backupCount = max(1, backups), encoding = 'UTF-8')
+    self.rotate_secs = rotate_secs
+    self.rollover_at = time.time() + rotate_secs
+    self.namer = lambda name: name + ".gz"
+    self.rotator = _gzip_rotate
+
+  def shouldRollover(self, record):
+    if self.rotate_secs and time.time() >= self.rollover_at:
+      return True
+    return super().shouldRollover(record)
+
+  def doRollover(self):
+    super().doRollover()
+    self.rollover_at = time.time() + self.rotate_secs
+
+  # sys.stderr may itself be captured into this log (see capture_stdio); never report a failure back into it
+  def handleError(self, record):
+    print(f"podlog: cannot write {self.baseFilename}: {repr(sys.exc_info()[1])}", file = sys.__stderr__)
+
+# Turns everything written to it into log records, one per line
+class LineLogger:
+  def __init__(self, logger, level, event):
+    self.logger = logger
+    self.level = level
+    self.event = event
+    self.buf = ''
+
+  def write(self, data):
+    self.buf += data
+    while '\n' in self.buf:
+      line, self.buf = self.buf.split('\n', 1)
+      if line.strip():
+        self.logger.log(self.level, line, extra = {"event": self.event})
+    return len(data)
+
+  def flush(self):
+    pass
+
+  def isatty(self):
+    return False
+
+# Sends all logging in this process to logs/<component>/<replica>.jsonl (or `path`) through a queue, and also to
+# `echo` (a stream, eg. sys.stdout for the container log) if given. Must be called after daemonize(): the listener
+# thread doesn't survive fork(). Returns the component's logger.
+def setup(component, path = None, echo = None):
+  handler = RotatingJsonFileHandler(path or os.path.join(LOG_DIR, component, REPLICA + ".jsonl"))
+  handlers = [handler]
+  if echo is not None:
+    handlers.append(logging.StreamHandler(echo))
+  for h in handlers:
+    h.setFormatter(JsonFormatter(component))
+  log_queue = queue.SimpleQueue() # Unbounded: logging never blocks
+  listener = logging.handlers.QueueListener(log_queue, *handlers)
+  listener.start()
+  atexit.register(listener.stop) # Writes out whatever is still queued
+  root = logging.getLogger()
+  root.handlers = [logging.handlers.QueueHandler(log_queue)]
+  root.setLevel(logging.INFO)
+  return logging.getLogger(component)
+
+# Makes print() (including from the shared modules, and tracebacks) go through the log as well, as "stdout" and
+# "stderr" events, instead of to files that are never rotated
+def capture_stdio(logger):
+  sys.stdout = LineLogger(logger, logging.INFO, "stdout")
+  sys.stderr = LineLogger(logger, logging.WARNING, "stderr")
+
+# sshd -e lines that are worth an event of their own
+SSHD_EVENTS = [
+  (re.compile(r'Accepted \S+ for (?P<user>\S+) from'), "login"),
+  (re.compile(r'Failed \S+ for (?:invalid user )?(?P<user>\S+) from'), "login_failed"),
+  (re.compile(r'Invalid user (?P<user>\S+) from'), "login_failed"),
+  (re.compile(r'Disconnected from user (?P<user>\S+)'), "logout"),
+]
+
+def classify_sshd_line(line):
+  for pattern, event in SSHD_EVENTS:
+    match = pattern.search(line)
+    if match:
+      return (event, match.group('user'))
+  return ("sshd", None)
+
+# Log collector for a process's output (used for sshd, see the Dockerfile): each line read from stdin becomes a
+# record. Reading never waits for the logs volume, so the writer is never blocked by a full pipe.
+def main(argv):
+  parser = argparse.ArgumentParser(description = "Writes lines read from stdin to a rotated JSON-lines log", prog = "podlog")
+  parser.add_argument('component', type = str, help = "Component name; also the log directory under logs/")
+  parser.add_argument('--file', type = str, default = None, help = "Log file (default: logs/<component>/<replica>.jsonl)")
+  parser.add_argument('--echo', action = 'store_true', help = "Also write the records to stdout (eg. for the container log)")
+  args = parser.parse_args(argv[1:])
+
+  log = setup(args.component, path = args.file, echo = sys.stdout if args.echo else None)
+  for line in sys.stdin:
+    line = line.rstrip('\n')
+    if not line:
+      continue
+    event, user = classify_sshd_line(line) if args.component == "sshd" else (args.component, None)
+    log.info(line, extra = {"event": event, "user": user})
+
+
+if __name__ == "__main__":
+  main(sys.argv)
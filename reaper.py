@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import heapq
+import itertools
+
+# Inactivity deadlines for the garbage collector, kept in a min-heap so that the next pod to expire is always known
+# without looking at any of the others. garbagecollectd sleeps until that deadline or its next activity scan,
+# whichever comes first, instead of re-checking every pod on every poll.
+#
+# A pod's deadline is (last activity) + (its timeout label). Activity moves the deadline forward, whichever replica
+# saw it (garbagecollectd applies what the others report through the ActivityLedger as it reads it back); a
+# `ledger` given to the Reaper is instead only looked at when a deadline comes due, and pushes it back if there was
+# any. Entries are never removed from the middle of the heap: a newer entry for the
+# same pod supersedes the old one, which is skipped when it reaches the top.
+#
+# After a restart, restore() seeds last activity from the checkpoint the previous reaper wrote, so pods keep the
+# time they had already been idle instead of starting a fresh timeout. A checkpoint entry only applies to the pod
+# with the same name AND uid (a pod recreated under the same name starts over), is never later than the time the
+# checkpoint was written, and is shifted forward by however long no reaper was writing checkpoints, so an outage
+# never counts as idle time. Anything seen since (local activity, the ledger) takes precedence when it is later.
+
+class DeadlineHeap:
+  def __init__(self):
+    self._heap = []
+    self._deadlines = {} # name -> current deadline; heap entries that don't match this are stale
+    self._counter = itertools.count() # Tie breaker, so names are never compared
+
+  def __len__(self):
+    return len(self._deadlines)
+
+  def __contains__(self, name):
+    return name in self._deadlines
+
+  def get(self, name):
+    return self._deadlines.get(name)
+
+  def set(self, name, deadline):
+    if self._deadlines.get(name) == deadline:
+      return
+    self._deadlines[name] = deadline
+    heapq.heappush(self._heap, (deadline, next(self._counter), name))
+    if len(self._heap) > 2 * len(self._deadlines) + 64:
+      self._compact()
+
+  def remove(self, name):
+    self._deadlines.pop(name, None)
+
+  # Returns (deadline, name) of the earliest deadline, or None if empty
+  def peek(self):
+    self._drop_stale()
+    return (self._heap[0][0], self._heap[0][2]) if self._heap else None
+
+  # Removes and returns the names of all entries whose deadline is at or before `now`, earliest first
+  def pop_due(self, now):
+    due = []
+    self._drop_stale()
+    while self._heap and self._heap[0][0] <= now:
+      deadline, _, name = heapq.heappop(self._heap)
+      del self._deadlines[name]
+      due.append(name)
+      self._drop_stale()
+    return due
+
+  def _drop_stale(self):
+    heap = self._heap
+    while heap and self._deadlines.get(heap[0][2]) != heap[0][0]:
+      heapq.heappop(heap)
+
+  def _compact(self):
+    self._heap = [(deadline, next(self._counter), name) for name, deadline in self._deadlines.items()]
+    heapq.heapify(self._heap)
+
+# Tracks user pods and decides which have been inactive for longer than their timeout. `ledger`, if given, has a
+# last_seen(name) with activity seen elsewhere, which is consulted before reaping.
+class Reaper:
+  def __init__(self, ledger = None):
+    self.ledger = ledger
+    self.heap = DeadlineHeap()
+    self.timeouts = {} # name -> timeout, in seconds
+    self.last_active = {} # name -> last activity recorded through activity() (or when the pod was first seen)
+    self.uids = {} # name -> uid of the pod being tracked under that name
+    self.restored = {} # name -> (uid, last activity) from a checkpoint, until the pod is first tracked
+
+  def __len__(self):
+    return len(self.timeouts)
+
+  def names(self):
+    return self.timeouts.keys()
+
+  # Starts tracking a pod (first seen at `now`, unless restored from a checkpoint), or updates its timeout if it is
+  # already tracked
+  def track(self, name, timeout, now, uid = None):
+    if not name in self.timeouts:
+      restored_uid, restored_time = self.restored.pop(name, (None, None))
+      self.last_active[name] = min(restored_time, now) if uid and restored_uid == uid else now
+    self.timeouts[name] = timeout
+    if uid:
+      self.uids[name] = uid
+    self.heap.set(name, self.last_active[name] + timeout)
+
+  def forget(self, name):
+    self.timeouts.pop(name, None)
+    self.last_active.pop(name, None)
+    self.uids.pop(name, None)
+    self.heap.remove(name)
+
+  # Loads checkpoint entries ({name: (uid, last activity)}, written at `updated`) to be applied when each pod is
+  # first tracked. Returns the number of entries loaded.
+  def restore(self, entries, updated, now):
+    gap = max(0, now - updated) # Time during which no reaper was writing checkpoints
+    self.restored = {name: (uid, min(timestamp, updated) + gap) for name, (uid, timestamp) in entries.items()}
+    return len(self.restored)
+
+  # Drops checkpoint entries that weren't claimed by any pod (the pods were deleted in the meantime)
+  def discard_restored(self):
+    self.restored = {}
+
+  # Records activity on a tracked pod
+  def activity(self, name, now):
+    if name in self.timeouts and self.last_active[name] < now:
+      self.last_active[name] = now
+      self.heap.set(name, now + self.timeouts[name])
+
+  # Last activity, including the ledger's
+  def last_seen(self, name):
+    remote = self.ledger.last_seen(name) if self.ledger is not None else None
+    return max(self.last_active[name], remote or 0)
+
+  def deadline(self, name):
+    return self.heap.get(name)
+
+  # The time of the earliest deadline, or None if no pods are tracked
+  def next_deadline(self):
+    top = self.heap.peek()
+    return top[0] if top is not None else None
+
+  # Returns (name, deadline) for each pod whose deadline has passed. Pods that turn out to have been used through
+  # another replica are rescheduled instead. The caller must then either forget() each returned pod (once it has
+  # been deleted) or postpone() it (to check it again later).
+  def due(self, now):
+    expired = []
+    for name in self.heap.pop_due(now):
+      deadline = self.last_seen(name) + self.timeouts[name]
+      if deadline > now:
+        self.heap.set(name, deadline)
+      else:
+        expired.append((name, deadline))
+    return expired
+
+  # Checks an expired pod again at `when`, unless there is new activity before then
+  def postpone(self, name, when):
+    if name in self.timeouts:
+      self.heap.set(name, when)
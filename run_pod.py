@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 from kubernetes import config, client, utils, watch
+from kubernetes.client.rest import ApiException
 import os
 import sys
 import random
@@ -7,14 +8,28 @@ import yaml
 import string
 import time
 import threading
-import psutil
 import traceback
 import base64
 import argparse
 import shlex
 import json
-import subprocess
 import datetime
+import hashlib
+import functools
+import socket
+import queue
+import concurrent.futures
+
+import connscan
+from spawntimeline import SpawnTimeline
+from podconfig import PodOnDemandConfig, ConfigError
+from activityledger import read_snapshot, ATTACH_ANNOTATION
+from capacity import CapacityCache
+from spawnqueue import SpawnQueue, QueueFull, estimate_turn
+from podcache import PodInformer
+from imageprepull import read_status as read_prepull_status, pinned_images, images_cached_on
+
+AUTHORIZED_KEYS_PATH = "/home/{username}/.ssh/authorized_keys" # The user's key, passed into their pod
 
 # Adapted from https://gist.github.com/Jd007/5573672
 # Forks the process and detaches ownership from the shell process to continue in background
@@ -54,86 +69,240 @@ def daemonize(stdout: str, stderr: str, stdin: str = None):
   with open(stderr, 'a+') as se:
     os.dup2(se.fileno(), sys.stderr.fileno())
 
+# In-process equivalent of "openssl passwd -1" (MD5-crypt), so no subprocess is needed to hash the pod password
+def md5_crypt(password, salt):
+  itoa64 = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+  pw = password.encode('UTF-8')
+  salt = salt.encode('ascii')[:8]
+  alternate = hashlib.md5(pw + salt + pw).digest()
+  ctx = pw + b'$1$' + salt
+  for i in range(len(pw), 0, -16):
+    ctx += alternate[:min(16, i)]
+  i = len(pw)
+  while i:
+    ctx += b'\x00' if i & 1 else pw[:1]
+    i >>= 1
+  final = hashlib.md5(ctx).digest()
+  for i in range(1000):
+    ctx = (pw if i & 1 else final) + (salt if i % 3 else b'') + (pw if i % 7 else b'') + (final if i & 1 else pw)
+    final = hashlib.md5(ctx).digest()
+
+  def to64(value, n):
+    out = ''
+    for _ in range(n):
+      out += itoa64[value & 0x3f]
+      value >>= 6
+    return out
+  encoded = ''.join(to64((final[a] << 16) | (final[b] << 8) | final[c], 4) for a, b, c in ((0, 6, 12), (1, 7, 13), (2, 8, 14), (3, 9, 15), (4, 10, 5)))
+  encoded += to64(final[11], 2)
+  return '$1$' + salt.decode('ascii') + '$' + encoded
+
+# Returns the hashed pod password: the precomputed "podPasswordHash" config value if there is one, otherwise a hash
+# computed once per process (frontendd computes it before forking, so logins inherit it).
+@functools.lru_cache(maxsize = None)
+def get_encrypted_password(precomputed = None, password = "knox"):
+  if precomputed:
+    return precomputed
+  salt = ''.join(random.SystemRandom().choices(string.ascii_letters + string.digits + './', k = 8))
+  return md5_crypt(password, salt)
+
 # https://stackoverflow.com/a/56398787
 def getRandomLabel(size):
   alphabet = string.ascii_lowercase + string.digits
   return ''.join(random.choices(alphabet, k=size))
 
-def watch_pod(v1, namespace, pod_name):
-  w = watch.Watch()
-  return (w, w.stream(v1.list_namespaced_pod, namespace=namespace, field_selector=f'metadata.name={pod_name}') )
-
-# Deletes the pod if it exists in the namespace
-def delete_pod(v1, namespace, pod_name):
-  pod_list = v1.list_namespaced_pod(namespace)
-  for pod in pod_list.items:
-    if pod.metadata.name == pod_name:
-      print("### Deleting pod " + pod_name, file = sys.stdout)
-      resp = v1.delete_namespaced_pod(name = pod_name, namespace=namespace)
-      # TODO: Check success of deletion?
-
-# Waits for a pod to enter the "Running" phase, and returns True and the last response,
-# or returns False and the last response if the timeout has been exceeded.
-      
-### TODO: Fix a bug where after timeout_seconds, it will still be blocked until the next kubernetes event
-def wait_for_pod(v1, watcher, stream, timeout_seconds = 300):
-
-  def stop_watching():
-    watcher.stop()
-
-  timer = threading.Timer(timeout_seconds, stop_watching)
-  timer.start()
-
-  lastEvent = None
-  for event in stream:
-    lastEvent = event['object']
-    if lastEvent.status.phase == "Running":
-      timer.cancel()  # Cancel the timer if the desired state is reached
-      return (True, lastEvent)
-  return (False, lastEvent)
-
-# Creates a Pod container object, retrieving and changing attributes as needed
-def define_pod(v1, pod_manifest_dict, new_name, username, encrypted_password, public_key, volume_id, timeoutsecs, podtype, volume_claim_name = None):
-  pod_manifest_dict["metadata"]["name"] = new_name # Update Pod name
-  #print(pod_manifest_dict)
-  pod_manifest_dict["spec"]["containers"][0]["volumeMounts"][0]["mountPath"] = "/home/" + username # Set home directory name mount
-  pod_manifest_dict["spec"]["containers"][0]["volumeMounts"][0]["subPath"] = volume_id # Set subdirectory for persistent volume
-  #pod_manifest_dict["spec"]["containers"][0]["volumeMounts"][0]["name"] = new_name
-  pod_manifest_dict["spec"]["containers"][0]["args"] = [username, encrypted_password, public_key]
-
-  # Apply labels
-  if not pod_manifest_dict["metadata"]["labels"]:
-    pod_manifest_dict["metadata"]["labels"] = {}
-  pod_manifest_dict["metadata"]["labels"]["user"] = username
-  pod_manifest_dict["metadata"]["labels"]["timeout"] = str(timeoutsecs)
-  pod_manifest_dict["metadata"]["labels"]["podtype"] = podtype
-
-  if volume_claim_name is not None:
-    pod_manifest_dict["spec"]["containers"][0]["volumeMounts"][0]["name"] = volume_claim_name
-    pod_manifest_dict["spec"]["volumes"][0]["name"] = volume_claim_name
-    pod_manifest_dict["spec"]["volumes"][0]["persistentVolumeClaim"]["claimName"] = volume_claim_name
-
-
-  pod_object = client.V1Pod(**pod_manifest_dict)
-
-  return pod_object
-
-# Returns True if there are currently any outgoing connections to the specified ip address
-def check_outgoing_connections(ip_address):
-  for conn in psutil.net_connections(kind='inet'):
-    if conn.status == 'ESTABLISHED' and conn.raddr and conn.raddr.ip == ip_address:
-      return True
+# Streams events for one pod into `events` as ("pod", pod) until `deadline`. The server ends each watch by itself
+# (timeout_seconds), so this thread never outlives the deadline by more than a second, even if no event ever arrives.
+def watch_pod(v1, namespace, pod_name, resource_version, deadline, events):
+  try:
+    while time.time() < deadline:
+      w = watch.Watch()
+      for event in w.stream(v1.list_namespaced_pod, namespace = namespace, field_selector = f'metadata.name={pod_name}',
+                            resource_version = resource_version, timeout_seconds = max(1, int(deadline - time.time()))):
+        if event['type'] == "ERROR": # eg. 410 Gone; start again from the pod's current state
+          resource_version = None
+          break
+        resource_version = event['object'].metadata.resource_version
+        events.put(("deleted" if event['type'] == "DELETED" else "pod", event['object']))
+  except Exception as e:
+    events.put(("error", e))
+
+# Returns True once something on ip:port answers with an SSH banner, retrying with backoff until `deadline` or until
+# `stop` is set. A TCP connect alone isn't enough: the port can accept before sshd is ready to serve a login.
+def probe_ssh(ip, port, deadline, stop = None, initial_delay = 0.1, max_delay = 2):
+  delay = initial_delay
+  while time.time() < deadline and not (stop is not None and stop.is_set()):
+    try:
+      with socket.create_connection((ip, port), timeout = max(0.1, min(2, deadline - time.time()))) as sock:
+        if sock.recv(64).startswith(b"SSH-"):
+          return True
+    except OSError:
+      pass
+    time.sleep(max(0, min(delay, deadline - time.time())))
+    delay = min(delay * 2, max_delay)
   return False
 
+# Deletes a pod this login created but could not hand over. The uid precondition makes sure it is still
+# that pod; one that is already gone is fine.
+def discard_pod(v1, namespace, pod):
+  try:
+    v1.delete_namespaced_pod(name = pod.metadata.name, namespace = namespace,
+                             body = client.V1DeleteOptions(preconditions = client.V1Preconditions(uid = pod.metadata.uid)))
+  except ApiException as e:
+    if e.status not in (404, 409):
+      raise e
 
-def pod_is_present_and_running(v1, namespace, name):
-  pod_list = v1.list_namespaced_pod(namespace)
-  for pod in pod_list.items:
-    if pod.metadata.name == name:
-      if pod.status.phase == "Running":
-        return True
-      return False
-  return False
+# Deletes the given pods of a user (or all of them), concurrently, and reports the result for each. Ownership is
+# checked against one label-selected list of the user's pods. With wait, also watches until the deleted pods are gone.
+# Returns the exit code: 0 if every pod was deleted, 1 if any was not found or could not be deleted.
+def delete_user_pods(v1, namespace, username, names, delete_all = False, wait = False, wait_timeout = 120):
+  owned = {pod.metadata.name: pod for pod in v1.list_namespaced_pod(namespace = namespace, label_selector = f'user={username}').items}
+  names = sorted(owned.keys()) if delete_all else list(dict.fromkeys(names)) # Keep the order given, without repeats
+  if not names:
+    print("### No pods to delete")
+    return 0
+
+  def delete(name):
+    # The uid precondition makes sure this is still the pod that was listed, not a new one with the same name
+    body = client.V1DeleteOptions(preconditions = client.V1Preconditions(uid = owned[name].metadata.uid))
+    try:
+      v1.delete_namespaced_pod(name = name, namespace = namespace, body = body)
+      return None
+    except ApiException as e:
+      if e.status in (404, 409):
+        return "already gone"
+      return f"{e.status} {e.reason}"
+
+  failed = False
+  deleted = []
+  to_delete = []
+  for name in names:
+    if not name in owned:
+      print(f'### {name}: error: you have no pod with that name')
+      failed = True
+    else:
+      to_delete.append(name)
+  with concurrent.futures.ThreadPoolExecutor(max_workers = min(16, max(1, len(to_delete)))) as executor:
+    for name, error in zip(to_delete, executor.map(delete, to_delete)):
+      if error is None or error == "already gone":
+        print(f"### {name}: deleted" + (" (already gone)" if error else ""))
+        deleted.append(name)
+      else:
+        print(f"### {name}: error: could not delete: {error}")
+        failed = True
+  sys.stdout.flush()
+
+  if wait and deleted:
+    remaining = set(deleted)
+    deadline = time.time() + wait_timeout
+    # Start from a fresh list so pods that finished terminating during the deletes aren't waited on forever
+    pod_list = v1.list_namespaced_pod(namespace = namespace, label_selector = f'user={username}')
+    remaining &= {pod.metadata.name for pod in pod_list.items}
+    resource_version = pod_list.metadata.resource_version
+    while remaining and time.time() < deadline:
+      w = watch.Watch()
+      for event in w.stream(v1.list_namespaced_pod, namespace = namespace, label_selector = f'user={username}',
+                            resource_version = resource_version, timeout_seconds = max(1, int(deadline - time.time()))):
+        if event['type'] == "ERROR":
+          break
+        resource_version = event['object'].metadata.resource_version
+        if event['type'] == "DELETED" and event['object'].metadata.name in remaining:
+          remaining.discard(event['object'].metadata.name)
+          print(f"### {event['object'].metadata.name}: gone")
+          if not remaining:
+            w.stop()
+      else:
+        continue
+      # The watch failed (eg. 410 Gone); list again
+      pod_list = v1.list_namespaced_pod(namespace = namespace, label_selector = f'user={username}')
+      remaining &= {pod.metadata.name for pod in pod_list.items}
+      resource_version = pod_list.metadata.resource_version
+    for name in sorted(remaining):
+      print(f"### {name}: still terminating after {wait_timeout} seconds")
+      failed = True
+  return int(failed)
+
+# Describes what a starting pod is waiting on, for progress messages; None if there is nothing new to say
+def describe_progress(pod):
+  status = pod.status
+  if status is None:
+    return None
+  if status.phase == "Running":
+    return "Starting sshd..."
+  for condition in status.conditions or []:
+    if condition.type == "PodScheduled":
+      if condition.status != "True":
+        return f"Waiting to be scheduled: {condition.message}" if condition.message else "Waiting to be scheduled..."
+  for container in status.container_statuses or []:
+    waiting = container.state.waiting if container.state else None
+    if waiting is not None:
+      if waiting.reason in ("ErrImagePull", "ImagePullBackOff"):
+        return f"Image pull problem ({waiting.reason}), retrying: {waiting.message}"
+      return "Pulling image and starting container..."
+  if pod.spec and pod.spec.node_name:
+    return f"Scheduled on {pod.spec.node_name}, pulling image..."
+  return None
+
+# Waits until the pod is Running and its sshd answers, for at most timeout_seconds in total. Returns (outcome, pod),
+# with the last state of the pod seen, where outcome is "ready" when the pod can be logged in to, or else why it
+# can't: "failed" (the pod failed or exited), "deleted", "unreachable" (sshd did not answer) or "timeout".
+# resource_version is that of the created pod, so no event after creation is missed.
+# on_event, if given, is called with each pod update (eg. SpawnTimeline.observe_pod), and on_ready once sshd answers.
+def wait_for_pod(v1, namespace, pod_name, resource_version, timeout_seconds = 300, on_event = None, on_ready = None):
+  deadline = time.time() + timeout_seconds
+  events = queue.Queue()
+  stop_probe = threading.Event()
+  threading.Thread(target = watch_pod, args = (v1, namespace, pod_name, resource_version, deadline, events), daemon = True).start()
+
+  def probe(ip):
+    events.put(("ready" if probe_ssh(ip, 22, deadline, stop_probe) else "unreachable", ip))
+
+  last_pod = None
+  last_progress = None
+  probing = False
+  try:
+    while True:
+      try:
+        kind, obj = events.get(timeout = max(0, deadline - time.time()))
+      except queue.Empty:
+        return ("timeout", last_pod)
+      if kind == "ready":
+        if on_ready is not None:
+          on_ready()
+        return ("ready", last_pod)
+      if kind == "unreachable":
+        return ("unreachable", last_pod)
+      if kind == "error":
+        raise obj
+      last_pod = obj
+      if kind == "deleted":
+        return ("deleted", last_pod)
+      if obj.status and obj.status.phase in ("Failed", "Succeeded"):
+        return ("failed", last_pod)
+      if on_event is not None:
+        on_event(obj)
+      progress = describe_progress(obj)
+      if progress is not None and progress != last_progress:
+        print(f"### {progress}", file = sys.stderr)
+        last_progress = progress
+      if obj.status and obj.status.phase == "Running" and obj.status.pod_ip and not probing:
+        probing = True # Keep watching while probing, so a pod that dies meanwhile is noticed straight away
+        threading.Thread(target = probe, args = (obj.status.pod_ip,), daemon = True).start()
+  finally:
+    stop_probe.set()
+
+# Creates a Pod container object from the pod type's compiled template (see podconfig.PodTemplate). images, if given,
+# replaces image references with digest-pinned ones that are pulled only if not present (see imageprepull.py).
+def define_pod(v1, pod_template, new_name, username, encrypted_password, public_key, volume_id, timeoutsecs, podtype, volume_claim_name = None, images = None):
+  labels = {"user": username, "timeout": str(timeoutsecs), "podtype": podtype}
+  if volume_claim_name:
+    labels["storage"] = volume_claim_name # So a later login can tell which storage the pod has (see find_reusable_pod)
+  return pod_template.fill(new_name, labels, args = [username, encrypted_password, public_key],
+                           mount_path = "/home/" + username, sub_path = volume_id, claim_name = volume_claim_name, images = images)
+
+# Returns True if there are currently any outgoing connections to the specified ip address
+def check_outgoing_connections(ip_address):
+  return ip_address in connscan.established_remote_ips()
 
 def print_available_types(pod_choices_dict):
   for name, data in pod_choices_dict.items():
@@ -149,9 +318,117 @@ def print_available_storage(storage_choices_dict):
     print()
 
 
+# The user's pods of one type that aren't being deleted, from a single label-selected LIST
+def user_pods_of_type(v1, namespace, username, pod_type):
+  pods = v1.list_namespaced_pod(namespace = namespace, label_selector = f"user={username},podtype={pod_type}").items
+  return [pod for pod in pods if not pod.metadata.deletion_timestamp]
+
+# Whether a pod can be handed to a login as it is: Running, with an address, and Ready
+def is_healthy(pod):
+  if not pod.status or pod.status.phase != "Running" or not pod.status.pod_ip:
+    return False
+  return any(c.type == "Ready" and c.status == "True" for c in (pod.status.conditions or []))
+
+# Returns the newest healthy pod among `pods` with the given storage (None for the default), or None
+def find_reusable_pod(pods, storage_name):
+  matching = [pod for pod in pods if (pod.metadata.labels or {}).get('storage') == storage_name and is_healthy(pod)]
+  return max(matching, key = lambda pod: pod.metadata.creation_timestamp, default = None)
+
+# Hands an existing pod to the login: marks it as used just now, so the reaper doesn't delete it before the user
+# connects (garbagecollectd treats the annotation as activity), and prints how to connect. Returns False if the
+# pod has gone away in the meantime.
+def attach_pod(v1, pod, namespace, username):
+  try:
+    v1.patch_namespaced_pod(pod.metadata.name, namespace, {"metadata": {"annotations": {ATTACH_ANNOTATION: str(time.time())}}})
+  except ApiException as e:
+    if e.status == 404:
+      return False
+    raise e
+  timeout = (pod.metadata.labels or {}).get('timeout')
+  print(f"### Reattaching to your running pod {pod.metadata.name} (start another one with --new)", file = sys.stderr)
+  print(f"\n### Use the following commands to connect to it via SSH or SFTP:\n(network inactivity timeout: {timeout} seconds)\n", file = sys.stderr)
+  print_ssh_connect_str(pod, username)
+  print()
+  return True
+
+# Fails fast, with the current availability of every type, if a pod of this type can't be scheduled anywhere right
+# now. Always passes without a capacity snapshot (eg. when run standalone rather than through frontendd).
+def check_capacity(capacity, pod_config, pod_type):
+  if capacity is None:
+    return True
+  try:
+    count, matching = capacity.availability(pod_config.templates[pod_type].manifest["spec"])
+    if count > 0:
+      return True
+    available = capacity.availability_by_type(pod_config.templates)
+  except Exception as e:
+    print(f"### Warning: could not check for free capacity, starting the pod anyway: {repr(e)}", file = sys.stderr)
+    return True
+  if matching == 0:
+    reason = "no node in the cluster can run this type"
+  else:
+    reason = f"{'the only node' if matching == 1 else f'all {matching} nodes'} that can run this type {'is' if matching == 1 else 'are'} full"
+  print(f"### Error: Cannot start a \"{pod_type}\" pod right now: {reason}. Please try again later.", file = sys.stderr)
+  print("### Pods that can currently be started, by type:", file = sys.stderr)
+  for podtype, n in available.items():
+    print(f"  {podtype}: {n}", file = sys.stderr)
+  print("### Add --queue to wait in line for one instead.", file = sys.stderr)
+  return False
+
+# Waits in the cluster-wide spawn queue (see spawnqueue.py) until it is this request's turn and a pod of the type
+# fits, printing the position and an estimated time whenever they change. Returns the queue entry, which the caller
+# must leave() once its pod has been scheduled (so the next in line sees it taking up capacity) or on failure.
+# Only the head of the queue checks the cluster's capacity, from a CapacityCache it starts on reaching the head: one
+# LIST of nodes and user pods, then watches, rather than listing them again on every poll.
+def wait_in_queue(v1, spawn_queue, pod_config, namespace, username, pod_type, poll_secs = 5):
+  try:
+    entry = spawn_queue.join(username, pod_type, int(pod_config.data.get("spawnQueueMaxPerUser", 2)))
+  except QueueFull as e:
+    print(f"### Error: Cannot queue for a \"{pod_type}\" pod: {str(e)}. See --list, or cancel your other waiting logins.", file = sys.stderr)
+    sys.exit(1)
+  spec = pod_config.templates[pod_type].manifest["spec"]
+  shown = None
+  renewed = time.time()
+  capacity_cache = None
+  try:
+    while True:
+      names = [lease.metadata.name for lease in spawn_queue.entries(pod_type)]
+      if entry not in names: # Dropped as abandoned (eg. heartbeats failed for a while); join again
+        entry = spawn_queue.join(username, pod_type, int(pod_config.data.get("spawnQueueMaxPerUser", 2)))
+        continue
+      position = names.index(entry)
+      if position == 0:
+        if capacity_cache is None:
+          capacity_cache = CapacityCache(v1, namespace).start()
+        capacity = capacity_cache.snapshot(timeout = 60)
+        if capacity is None:
+          raise TimeoutError("could not load the cluster's nodes and pods")
+        count, matching = capacity.availability(spec)
+        if matching == 0:
+          print(f"### Error: no node in the cluster can run a \"{pod_type}\" pod; waiting would never end.", file = sys.stderr)
+          sys.exit(1) # Leaves the queue below
+        if count > 0:
+          return entry
+      if shown != (position, len(names)):
+        shown = (position, len(names))
+        running = v1.list_namespaced_pod(namespace, label_selector = f"podtype={pod_type}").items
+        eta = estimate_turn(position, [pod for pod in running if pod.status and pod.status.phase == "Running"], read_snapshot())
+        eta_str = f"expected by {datetime.datetime.fromtimestamp(eta).strftime('%H:%M')} at the latest" if eta else "no estimate yet"
+        print(f"### Waiting in the queue for a \"{pod_type}\" pod: position {position + 1} of {len(names)}, {eta_str}", file = sys.stderr)
+      if time.time() - renewed >= spawn_queue.lease_duration / 4:
+        spawn_queue.renew(entry)
+        renewed = time.time()
+      time.sleep(poll_secs)
+  except BaseException as e:
+    spawn_queue.leave(entry) # Cancelled (or failed) while waiting
+    raise e
+  finally:
+    if capacity_cache is not None:
+      capacity_cache.stop()
+
 # Parses arguments and returns relevant data, or exits with an error code upon invalid data.
 # This is the "interactive" part.
-def parse_argdata(v1, argv, config_map, namespace, username):
+def parse_argdata(v1, argv, pod_config, namespace, username):
   parser = argparse.ArgumentParser(description="", prog="podondemand")
   # Why do all my arguments start with a t???
   parser.add_argument('-t', '--type', type = str, default = None, nargs = '?', const = 'True', 
@@ -159,33 +436,39 @@ def parse_argdata(v1, argv, config_map, namespace, username):
   parser.add_argument('-s', '--storage', type = str, default = None, nargs = '?', const = 'True', 
                       help = "Specify the storage configuration to attach, or list available options")
   parser.add_argument('-l', '--list', action = 'store_true', help = "Shows details of all your sessions that are currently running")
+  parser.add_argument('-o', '--output', type = str, default = 'text', choices = ['text', 'json', 'yaml'], help = "Output format for --list")
+  parser.add_argument('--watch', action = 'store_true', help = "With --list, keeps running and prints every change to your pods as a line of JSON, until interrupted")
   parser.add_argument('-w', '--timeout', type = int, default = None, help = "Sets the inactivity timeout for the pod, in seconds (after not recieving any connections for --timeout <n> seconds, the pod will be terminated")
-  parser.add_argument('-d', '--delete', type = str, default = None, nargs = '*', help = 'Deletes a running pod by name (listed between "===" in --list)')
+  parser.add_argument('-d', '--delete', type = str, default = None, nargs = '*', help = 'Deletes one or more of your pods by name (listed between "===" in --list)')
+  parser.add_argument('--delete-all', action = 'store_true', help = "Deletes all of your pods")
+  parser.add_argument('--wait', action = 'store_true', help = "With --delete or --delete-all, waits until the pods are gone")
+  parser.add_argument('-n', '--new', action = 'store_true', help = "Always start a new pod, even if this type is set to reattach you to your existing one")
+  parser.add_argument('-q', '--queue', action = 'store_true', help = "If there is no room for the pod right now, waits in line for one instead of failing")
   args = parser.parse_args(argv) #Parse arguments
   
 
-  if args.delete:
-    for delete_arg in args.delete:
-      pod_list = v1.list_namespaced_pod(namespace)
-      nameset = set(pod.metadata.name for pod in v1.list_namespaced_pod(namespace=namespace, label_selector=f'user={username}').items)
-      if not delete_arg in nameset:
-        print(f'### Error: no pod named "f{delete_arg}"')
-        sys.exit(1)
-      print("### Deleting pod " + delete_arg, file = sys.stdout)
-      resp = v1.delete_namespaced_pod(name = delete_arg, namespace=namespace)
-      sys.exit(0)
+  if args.delete or args.delete_all:
+    sys.exit(delete_user_pods(v1, namespace, username, args.delete or [], delete_all = args.delete_all, wait = args.wait))
   
+  if args.list and args.watch:
+    watch_pods(v1, namespace, username)
+    sys.exit(0)
+
+  if args.list:
+    list_pods(v1, pod_config, namespace, username, args.output)
+    sys.exit(0)
+
   storage_name = None
   warn_type = False
   storageChoices = None
-  if config_map.data['storageChoices']:
-    storageChoices = yaml.safe_load(config_map.data['storageChoices'])
+  if pod_config.storage_choices:
+    storageChoices = pod_config.storage_choices
     if args.storage == 'True':
       print_available_storage(storageChoices)
       exit(0)
     if args.storage:
       if not args.storage in storageChoices.keys():
-        print(f"Error: no storage type named \"{args.volume}\". Here is a list of available options:")
+        print(f"Error: no storage type named \"{args.storage}\". Here is a list of available options:")
         print_available_storage(storageChoices)
         exit(int(args.storage != 'True'))
       else:
@@ -194,110 +477,208 @@ def parse_argdata(v1, argv, config_map, namespace, username):
     if args.storage:
       print("Error: no storage options are defined.")
 
-  choices = yaml.safe_load(config_map.data['podChoices'])
+  choices = pod_config.pod_choices
   if args.type == 'True':
     print_available_types(choices)
     sys.exit(0)
 
-  manifests = yaml.safe_load(config_map.data['podManifests'])
-  pod_manifest_str = None
+  # Only reached when actually spawning a pod
+  templates = pod_config.templates
+  pod_template = None
   pod_type = None
   if not args.type:
     ch = next( (k for k in choices.keys()) ) # Default to first choice
     warn_type = True
     pod_type = ch
-    pod_manifest_str = manifests[ch] # Will throw an exception if there are not matching labels in the yaml definitions
+    pod_template = templates[ch] # Every podChoices entry has a manifest; checked when the config was loaded
   elif not args.type in choices.keys():
     print(f"Error: no pod type named \"{args.type}\". Here is a list of available types:")
     print_available_types(choices)
     sys.exit(1)
   else: # Normal - the user specified a valid type
     pod_type = args.type
-    pod_manifest_str = manifests[pod_type]
+    pod_template = templates[pod_type]
 
   ### Handle timeout
   timeout = None
   if args.timeout:
     timeout = args.timeout
   else:
-    timeout = config_map.data["inactivityTimeoutSecs"]
+    timeout = pod_config.data["inactivityTimeoutSecs"]
 
-  if args.list:
-    print("Your pods:")
-    for pod in v1.list_namespaced_pod(namespace=namespace, label_selector=f'user={username}').items:
-      print(f"=== {pod.metadata.name} ===")
-      deletion_timestamp = pod.metadata.deletion_timestamp
-      #deletion_grace_period_seconds = pod.metadata.deletion_grace_period_seconds
-      status = None
-      if deletion_timestamp: #datetime.datetime.now() - deletion_timestamp <= int(deletion_grace_period_seconds):
-        secs = int((datetime.datetime.now().replace(tzinfo=None) - deletion_timestamp.replace(tzinfo=None)).total_seconds())
-        grace = pod.metadata.deletion_grace_period_seconds
-        status = f"Terminating ({str(secs+grace)} / {str(grace)} seconds)"
-      else:
-        status = pod.status.phase
-      print(f"  status: {status}")
-      print(f"  user: {pod.metadata.labels['user']}")
-      print(f"  type: {pod.metadata.labels['podtype']}")
-      print(f"  timeout: {pod.metadata.labels['timeout']} seconds")
-      print(f"  node: {pod.spec.node_name}")
-      timestr = None
-      if pod.status:
-        timestr = datetime.datetime.now().replace(tzinfo=None) - pod.status.start_time.replace(tzinfo=None)
-      print(f"  run time: {timestr}")
-      print_ssh_connect_str(v1, config_map, pod, namespace, username)
-      print()
-    sys.exit(0)
   
-  return (args, pod_type, pod_manifest_str, timeout, storage_name, warn_type)
-
-def print_ssh_connect_str(v1, config_map, pod, namespace, username):
-  # Obtain specified service for this pod to obtain the connection address
-  service = v1.read_namespaced_service(name = config_map.data["serviceName"], namespace = namespace)
-  pod_ip = pod.status.pod_ip ###resp.status.pod_ip
-  #print(service.status)
+  return (args, pod_type, pod_template, timeout, storage_name, warn_type)
+
+# Returns the (ssh, sftp) commands to connect to a pod, or (None, None) if it doesn't have an address yet.
+# No API call: the jump host is this frontend, so the Service's address isn't needed (it used to be read here for
+# every pod, for a jump host line that is commented out below).
+def ssh_connect_commands(pod, username):
+  pod_ip = pod.status.pod_ip if pod.status else None ###resp.status.pod_ip
+  if not pod_ip:
+    return (None, None)
   # TODO: fully parameterize this?
-  pod_host_ip = pod.status.pod_ip ###resp.status.host_ip
-  if pod_host_ip == None or pod_host_ip == "":
-    pod_host_ip = random.choice(service.status.load_balancer.ingress).ip
   #print(f'ssh -J "jumper@math.knox.edu,{os.getenv("USER")}@{pod_host_ip}:30142" "{username}@{pod_ip}" -i ~/.ssh/YOUR_JUMPER_KEY.rsa') # TODO Further parametrize this?
   # "knox_jump,{os.getenv("USER")}@{pod_host_ip}:30142"
   #print("Note: considering adding -oStrictHostKeyChecking=no -oUserKnownHostsFile=/dev/null to disable host key checking against pod\n", file = sys.stderr)
+  return (f'ssh -J "{os.getenv("USER")}@podondemand" "{username}@{pod_ip}" -i ~/.ssh/yourpodkey_rsa', # TODO Further parametrize this?
+          f'sftp -i ~/.ssh/yourpodkey_rsa -J "{os.getenv("USER")}@podondemand" "{username}@{pod_ip}"')
+
+def print_ssh_connect_str(pod, username):
+  ssh_cmd, sftp_cmd = ssh_connect_commands(pod, username)
   print(" --- Connect using SSH, or use SFTP to browse and transfer files --- ")
-  print(f'ssh -J "{os.getenv("USER")}@podondemand" "{username}@{pod_ip}" -i ~/.ssh/yourpodkey_rsa') # TODO Further parametrize this?
-  print(f'sftp -i ~/.ssh/yourpodkey_rsa -J "{os.getenv("USER")}@podondemand" "{username}@{pod_ip}"')
+  if ssh_cmd is None:
+    print("(the pod has no address yet)")
+    return
+  print(ssh_cmd)
+  print(sftp_cmd)
   #print(f'\n --- To browse and transfer files ---:\n  sftp -i ~/.ssh/yourpodkey_rsa -J "{os.getenv("USER")}@podondemand" "{username}@{pod_ip}"')
 
-def main(argv):
-  config.load_incluster_config()
-  v1 = client.CoreV1Api()
+def format_time(dt):
+  return dt.isoformat() if dt is not None else None
+
+# The data model behind --list: one dict per pod, rendered as JSON, YAML or text. last_active is the garbage
+# collector's record of when the pod was last used (see activityledger.write_snapshot), or None if unknown.
+def pod_summary(pod, username, now, last_active):
+  labels = pod.metadata.labels or {}
+  status = pod.status.phase if pod.status else None
+  if pod.metadata.deletion_timestamp:
+    secs = int((now - pod.metadata.deletion_timestamp).total_seconds())
+    grace = pod.metadata.deletion_grace_period_seconds or 0
+    status = f"Terminating ({str(secs+grace)} / {str(grace)} seconds)"
+  start_time = pod.status.start_time if pod.status else None # None while Pending
+  timeout = int(labels['timeout']) if str(labels.get('timeout', '')).isdigit() else None
+  until_reap = None
+  if last_active is not None and timeout is not None:
+    until_reap = max(0, int(timeout - (now.timestamp() - last_active)))
+  ssh_cmd, sftp_cmd = ssh_connect_commands(pod, username)
+  return {
+    "name": pod.metadata.name,
+    "status": status,
+    "user": labels.get('user'),
+    "type": labels.get('podtype'),
+    "timeout_seconds": timeout,
+    "node": pod.spec.node_name if pod.spec else None,
+    "pod_ip": pod.status.pod_ip if pod.status else None,
+    "created": format_time(pod.metadata.creation_timestamp),
+    "started": format_time(start_time),
+    "run_time_seconds": int((now - start_time).total_seconds()) if start_time else None,
+    "last_activity": format_time(datetime.datetime.fromtimestamp(last_active, datetime.timezone.utc)) if last_active is not None else None,
+    "seconds_until_reap": until_reap,
+    "ssh_command": ssh_cmd,
+    "sftp_command": sftp_cmd,
+  }
+
+# --list: a single label-selected pod LIST is the only API call
+def list_pods(v1, pod_config, namespace, username, output = 'text'):
+  now = datetime.datetime.now(datetime.timezone.utc)
+  last_active = read_snapshot()
+  pods = v1.list_namespaced_pod(namespace = namespace, label_selector = f'user={username}').items
+  summaries = [pod_summary(pod, username, now, last_active.get(pod.metadata.name)) for pod in pods]
+  if output == 'json':
+    print(json.dumps({"pods": summaries}, indent = 2))
+    return
+  if output == 'yaml':
+    print(yaml.safe_dump({"pods": summaries}, sort_keys = False), end = '')
+    return
+  print("Your pods:")
+  for p in summaries:
+    print(f"=== {p['name']} ===")
+    print(f"  status: {p['status']}")
+    print(f"  user: {p['user']}")
+    print(f"  type: {p['type']}")
+    print(f"  timeout: {p['timeout_seconds']} seconds")
+    print(f"  node: {p['node']}")
+    print(f"  run time: {datetime.timedelta(seconds = p['run_time_seconds']) if p['run_time_seconds'] is not None else 'not started'}")
+    print(f"  last activity: {p['last_activity'] or 'unknown'}")
+    if p['seconds_until_reap'] is not None:
+      print(f"  deleted if inactive for: {p['seconds_until_reap']} more seconds")
+    print(" --- Connect using SSH, or use SFTP to browse and transfer files --- ")
+    print(p['ssh_command'] or "(the pod has no address yet)")
+    if p['sftp_command']:
+      print(p['sftp_command'])
+    print()
+
+# --list --watch: the same summaries as --list, streamed as they change, one JSON object per line:
+# {"type": "ADDED" | "MODIFIED" | "DELETED", "pod": {...}}. Every existing pod is first reported as "ADDED", then a
+# {"type": "SYNCED"} line marks that the list is complete. Lets scripts (eg. the end-user tests) wait for a pod to
+# start or disappear without polling --list. Runs until interrupted.
+def watch_pods(v1, namespace, username):
+  def emit(event_type, pod):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    summary = pod_summary(pod, username, now, read_snapshot().get(pod.metadata.name))
+    print(json.dumps({"type": event_type, "pod": summary}), flush = True)
+  informer = PodInformer(v1, namespace, name_prefix = "", label_selector = f"user={username}")
+  informer.add_listener(emit)
+  informer.start()
+  try:
+    informer.wait_for_sync()
+    print(json.dumps({"type": "SYNCED"}), flush = True) # The initial "ADDED" events are emitted before the sync
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    informer.stop()
+
+# v1 and pod_config may be passed in by a long-lived caller (see frontendd.py) that already holds a warm
+# API client and a loaded configuration; otherwise they are loaded here as a standalone login would. capacity, a
+# capacity.CapacitySnapshot, is only available from such a caller. username and argdata default to $USER and
+# $SSH_ORIGINAL_COMMAND (given explicitly, eg. by benchmarks/bench_load.py, several logins can run in threads).
+def main(argv, v1 = None, pod_config = None, capacity = None, username = None, argdata = None):
+  # Authenticate user, and add info
+  username = username or os.getenv('USER')
+  timeline = SpawnTimeline(username = username)
+  if v1 is None:
+    config.load_incluster_config()
+    v1 = client.CoreV1Api()
 
   # Read config
   namespace = os.environ.get("CONFIG_NAMESPACE", default = "kube-system")
-  config_map = v1.read_namespaced_config_map("podondemand-config", namespace)
+  if pod_config is None:
+    try:
+      pod_config = PodOnDemandConfig(v1.read_namespaced_config_map("podondemand-config", namespace))
+    except ConfigError as e:
+      print(f"### Error: PodOnDemand is misconfigured, please contact your administrator.\n{str(e)}", file = sys.stderr)
+      sys.exit(1)
   #pod_manifest = config_map.data["pod-manifest"]
   #pod_manifest_dict = yaml.safe_load(pod_manifest)
+  timeline.mark("config_load")
 
-  argdata = os.getenv('SSH_ORIGINAL_COMMAND')
+  if argdata is None:
+    argdata = os.getenv('SSH_ORIGINAL_COMMAND')
   if argdata == None:
     argdata = ''
   
-  
-  # Authenticate user, and add info
-  username = os.getenv('USER')
-  password = "knox"
-
-  # Encode password
-  password = "knox"
-  passgen = subprocess.run(['openssl', 'passwd', '-1', '-stdin'], input = password.encode('UTF-8'), check = True, capture_output = True)       
-  encrypted_password = passgen.stdout.decode('ascii')
-  encrypted_password = encrypted_password.replace('\n', '')
 
+  # Read-only commands (--list, --type, --storage, --delete) exit inside parse_argdata, before any of the spawn-only work below
   #args = pod_type = pod_manifest_dict = None
-  args, pod_type, pod_manifest_dict, timeout, storage_name, warn_type = parse_argdata(v1, shlex.split(argdata), config_map, namespace, username)
+  args, pod_type, pod_template, timeout, storage_name, warn_type = parse_argdata(v1, shlex.split(argdata), pod_config, namespace, username)
+
+  # Encode password
+  encrypted_password = get_encrypted_password(pod_config.data.get("podPasswordHash"))
+  timeline.mark("arg_parse")
+  timeline.set(podtype = pod_type, storage = storage_name)
+
+  # Reattach to the user's existing pod of this type and storage, if the type is set to, and/or enforce the
+  # per-user limit. Both come from the same lookup.
+  choice = pod_config.pod_choices[pod_type]
+  reuse = choice.get('reuse', 'new') == 'attach' and not args.new
+  max_per_user = int(choice.get('maxPerUser', 0))
+  if reuse or max_per_user:
+    existing = user_pods_of_type(v1, namespace, username, pod_type)
+    reusable = find_reusable_pod(existing, storage_name) if reuse else None
+    if reusable is not None and attach_pod(v1, reusable, namespace, username):
+      timeline.set(pod = reusable.metadata.name, node = reusable.spec.node_name, outcome = "attached")
+      timeline.write()
+      return
+    if max_per_user and len(existing) >= max_per_user:
+      print(f"### Error: you already have {len(existing)} \"{pod_type}\" pod(s), the most allowed: {', '.join(pod.metadata.name for pod in existing)}. " +
+            "Connect to one of them (see --list), or delete one with --delete <name>.", file = sys.stderr)
+      timeline.set(outcome = "too_many_pods")
+      timeline.write()
+      sys.exit(1)
 
   
   # Will raise an exception if not present
-  with open(os.path.expanduser(f'/home/{username}/.ssh/authorized_keys'), 'rb') as authorized_keys:
+  with open(os.path.expanduser(AUTHORIZED_KEYS_PATH.format(username = username)), 'rb') as authorized_keys:
     public_key = base64.b64encode(authorized_keys.read()).decode('ascii')
 
 
@@ -305,7 +686,10 @@ def main(argv):
     # {pod_manifest_dict['metadata']['name']}
   newName = f"userpod-{username}-{pod_type}-{getRandomLabel(16)}"
 
-  newPod = define_pod(v1, pod_manifest_dict = pod_manifest_dict, new_name = newName, username = username, encrypted_password = encrypted_password, public_key = public_key, volume_id = username, timeoutsecs = timeout, podtype = pod_type, volume_claim_name = storage_name)
+  # Images that every node has already pulled are pinned to that digest (no local file for types not pre-pulled)
+  prepull_status = read_prepull_status()
+  newPod = define_pod(v1, pod_template = pod_template, new_name = newName, username = username, encrypted_password = encrypted_password, public_key = public_key, volume_id = username, timeoutsecs = timeout, podtype = pod_type, volume_claim_name = storage_name,
+                      images = pinned_images(prepull_status, pod_type))
   #resp2 = v1.create_namespaced_pod(body=newPod, namespace=namespace) # Actually create a new pod
   
   #pv_manifest_dict = yaml.safe_load(config_map.data["pv-manifest"])
@@ -318,6 +702,28 @@ def main(argv):
   #pvc_manifest_dict["metadata"]["name"] = newName
   #pvc_object = client.V1PersistentVolumeClaim(**pvc_manifest_dict)
   
+  spawn_queue = SpawnQueue(client.CoordinationV1Api(v1.api_client), namespace) if args.queue else None
+  queue_entry = None
+  queue_left = threading.Event()
+  def leave_queue():
+    if queue_entry is not None and not queue_left.is_set():
+      queue_left.set()
+      spawn_queue.leave(queue_entry)
+  # Heartbeats for the queue entry once wait_in_queue() has returned, until leave_queue(): creating the pod and
+  # waiting for it to be scheduled can take longer than the entry's lease
+  def renew_queue_entry():
+    while not queue_left.wait(spawn_queue.lease_duration / 4):
+      try:
+        spawn_queue.renew(queue_entry)
+      except Exception as e:
+        print(f"SpawnQueue: could not renew {queue_entry}: {repr(e)}", file = sys.stderr)
+  # Holds our place until the scheduler has placed the pod, so the next in line counts it against capacity
+  def observe_pod(pod):
+    timeline.observe_pod(pod)
+    if pod.spec and pod.spec.node_name:
+      leave_queue()
+
+  created = None
   try:
     #print("### Creating PersistentVolume...", file = sys.stderr)
     #resp = v1.create_persistent_volume(body = pv_manifest_dict)
@@ -326,30 +732,61 @@ def main(argv):
     if warn_type:
       print(f"### Warning: No pod --type specified. Defaulting to first defined, \"{pod_type}\". Specify a custom type by passing the \"--type <name>\" argument into SSH, or retrieve a description of all types using \"--type\" alone. For more information, try --help. Note: you may need to shell-escape the dashes, unless you add the literal prefix \"--\" after your ssh command.\n", file = sys.stderr)
 
+    if args.queue:
+      queue_entry = wait_in_queue(v1, spawn_queue, pod_config, namespace, username, pod_type)
+      timeline.mark("queue_wait")
+      threading.Thread(target = renew_queue_entry, name = "queue-heartbeat", daemon = True).start()
+    elif not check_capacity(capacity, pod_config, pod_type):
+      timeline.set(outcome = "no_capacity")
+      timeline.write()
+      sys.exit(1)
+
     print("### Starting pod...", file = sys.stderr)
-    watcher, stream = watch_pod(v1, namespace = namespace, pod_name = newName) # Start watching for events
-    resp = v1.create_namespaced_pod(body=newPod, namespace=namespace) # Actually create a new pod
+    created = v1.create_namespaced_pod(body=newPod, namespace=namespace) # Actually create a new pod
+    timeline.mark("pod_create")
+    timeline.set(pod = newName)
 
     print("### Waiting for pod to come online...", file=sys.stderr)
-    status, resp = wait_for_pod(v1, watcher, stream)
-    if not status:
-      print("### Timeout starting pod. Pod is in state: " + str(resp.status.phase), file=sys.stderr)
-      resp = v1.delete_namespaced_pod(name = newName, namespace=namespace)
+    outcome, resp = wait_for_pod(v1, namespace, newName, created.metadata.resource_version, on_event = observe_pod,
+                                 on_ready = lambda: timeline.mark("ssh_connect"))
+    leave_queue()
+    # Whether the node the pod landed on had already pre-pulled its images, for telling cache misses apart in spawnreport
+    timeline.set(image_cached = images_cached_on(prepull_status, pod_type, timeline.info["node"]))
+    if outcome != "ready":
+      timeline.set(outcome = outcome)
+      timeline.write()
+      phase = resp.status.phase if resp is not None and resp.status else "Pending"
+      if outcome == "deleted":
+        print("### Pod was deleted before it came online", file=sys.stderr)
+      elif outcome == "failed":
+        print("### Pod failed to start. Pod is in state: " + str(phase) + (f" ({resp.status.reason})" if resp.status.reason else ""), file=sys.stderr)
+      elif phase == "Running":
+        print("### Timeout starting pod: sshd did not come up in the pod", file=sys.stderr)
+      else:
+        print("### Timeout starting pod. Pod is in state: " + str(phase), file=sys.stderr)
+      if outcome != "deleted":
+        discard_pod(v1, namespace, created)
       exit(1)
 
     print(f"\n### Pod created! Use the following commands to connect to it via SSH or SFTP:\n(network inactivity timeout: {timeout} seconds)\n", file = sys.stderr)
-    print_ssh_connect_str(v1, config_map, resp, namespace, username)
+    print_ssh_connect_str(resp, username)
     print()
-
+    timeline.set(outcome = "spawned")
+    timeline.write()
     
   except (KeyboardInterrupt, Exception) as e:
     #traceback.print_tb(e.__traceback__)
     #print(repr(e))
+    leave_queue()
     if isinstance(e, KeyboardInterrupt):
       print("### Spawn pod cancelled by user!")
+      timeline.set(outcome = "cancelled")
+      timeline.write()
     else:
       raise e
-    delete_pod(v1, namespace, newName)
+    if created is not None:
+      print("### Deleting pod " + newName)
+      discard_pod(v1, namespace, created)
 
 if __name__ == "__main__":
   main(sys.argv)
\ No newline at end of file
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+import sys
+import time
+import random
+import string
+import datetime
+
+QUEUE_LABEL = "podondemand-queue"
+
+class QueueFull(Exception):
+  pass
+
+# Cluster-wide queue of spawn requests waiting for capacity (run_pod --queue). Each waiting request is a
+# coordination.k8s.io Lease, labelled with its user and pod type: joining is a single create that never conflicts
+# with anyone else, and the queue lives in the API server, so it outlives any frontend replica. The waiting login
+# renews its Lease as a heartbeat; an entry whose heartbeat is older than lease_duration is considered abandoned, is
+# skipped, and is deleted by whoever sees it. A user who reconnects within that time (eg. after their replica
+# restarted) takes their existing entry, and place, back.
+#
+# Each type's line is first come, first served, and fair per user: a user has at most one entry per type (joining
+# again, eg. from a second login, takes the same place), and at most max_per_user entries in all.
+class SpawnQueue:
+  def __init__(self, coordination_api, namespace, lease_duration = 120):
+    self.api = coordination_api
+    self.namespace = namespace
+    self.lease_duration = lease_duration
+
+  def _now(self):
+    return datetime.datetime.now(datetime.timezone.utc)
+
+  def _alive(self, lease, now):
+    renewed = lease.spec.renew_time or lease.spec.acquire_time
+    return renewed is not None and (now - renewed).total_seconds() < (lease.spec.lease_duration_seconds or self.lease_duration)
+
+  # Returns every live entry, of one pod type if given, in the order they will be served. Abandoned ones are deleted.
+  def entries(self, podtype = None):
+    selector = f"app={QUEUE_LABEL}" + (f",podtype={podtype}" if podtype else "")
+    now = self._now()
+    live = []
+    for lease in self.api.list_namespaced_lease(self.namespace, label_selector = selector).items:
+      if self._alive(lease, now):
+        live.append(lease)
+      else:
+        self.leave(lease.metadata.name)
+    live.sort(key = lambda lease: (lease.spec.acquire_time, lease.metadata.name))
+    return live
+
+  # Adds a request, or takes back the user's existing one for the same type. Returns the entry's name.
+  # Raises QueueFull if the user already has max_per_user other requests queued.
+  def join(self, username, podtype, max_per_user):
+    mine = [lease for lease in self.entries() if lease.metadata.labels.get("user") == username]
+    for lease in mine:
+      if lease.metadata.labels.get("podtype") == podtype:
+        self.renew(lease.metadata.name)
+        return lease.metadata.name
+    if len(mine) >= max_per_user:
+      raise QueueFull(f"you already have {len(mine)} queued request(s), the most allowed")
+    name = f"{QUEUE_LABEL}-{username}-{podtype}-" + ''.join(random.choices(string.ascii_lowercase + string.digits, k = 8))
+    body = client.V1Lease(metadata = client.V1ObjectMeta(name = name, labels = {"app": QUEUE_LABEL, "user": username, "podtype": podtype}),
+                          spec = client.V1LeaseSpec(holder_identity = username, lease_duration_seconds = self.lease_duration,
+                                                    acquire_time = self._now(), renew_time = self._now()))
+    self.api.create_namespaced_lease(self.namespace, body)
+    return name
+
+  # Heartbeat. Returns False if the entry is gone (eg. deleted as abandoned after a long network hiccup).
+  def renew(self, name):
+    try:
+      self.api.patch_namespaced_lease(name, self.namespace, {"spec": {"renewTime": self._now().isoformat()}})
+      return True
+    except ApiException as e:
+      if e.status == 404:
+        return False
+      raise e
+
+  def leave(self, name):
+    try:
+      self.api.delete_namespaced_lease(name, self.namespace)
+    except ApiException as e:
+      if e.status != 404:
+        print(f"SpawnQueue: could not remove {name}: {str(e)}", file = sys.stderr)
+
+# Estimates when a queue position will be served, from when running pods of the type reach their inactivity
+# timeout (see the reaper's snapshot). Pods deleted by their users free up sooner, so this is a latest-case guess.
+# `pods` are the running pods of the type, `last_active` maps pod name -> timestamp. Returns a timestamp or None.
+def estimate_turn(position, pods, last_active, now = None):
+  now = time.time() if now is None else now
+  deadlines = []
+  for pod in pods:
+    timeout = (pod.metadata.labels or {}).get('timeout')
+    if not str(timeout).isdigit():
+      continue
+    started = pod.metadata.creation_timestamp.timestamp() if pod.metadata.creation_timestamp else now
+    deadlines.append(max(now, last_active.get(pod.metadata.name, started) + int(timeout)))
+  deadlines.sort()
+  return deadlines[position] if position < len(deadlines) else None
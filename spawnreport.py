@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import math
+import glob
+import pwd
+import argparse
+
+from spawntimeline import TIMELINE_DIR
+
+# Summarizes the spawn timelines written by run_pod.py (see spawntimeline.py): p50/p95/p99 of the time at which each
+# phase was reached, overall and per pod type, plus the time spent between consecutive phases so that eg. image
+# pulls (scheduled -> containers_ready) can be told apart from scheduling delays (pod_create -> scheduled).
+
+PHASES = ["config_load", "arg_parse", "queue_wait", "pod_create", "scheduled", "containers_ready", "running", "ssh_connect"]
+
+def percentile(values, p):
+  values = sorted(values)
+  if not values:
+    return None
+  k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1)) # Nearest rank
+  return values[k]
+
+# The user a timeline file belongs to, or None if it isn't owned by the user it is named after (<user>.jsonl). Every
+# user can create files in the timeline directory, so any other file may hold made-up records.
+def file_owner(path):
+  name = os.path.basename(path)[:-len(".jsonl")] if path.endswith(".jsonl") else None
+  try:
+    return name if name and os.stat(path).st_uid == pwd.getpwnam(name).pw_uid else None
+  except (OSError, KeyError):
+    return None
+
+# Reads the records of every file owned by the user it is named after, and only that user's records from it
+def load_records(paths):
+  records = []
+  for path in paths:
+    user = file_owner(path)
+    if user is None:
+      print(f"Ignoring {path}: not owned by the user it is named after", file = sys.stderr)
+      continue
+    with open(path, 'r') as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          continue # Partially written line
+        if isinstance(record, dict) and record.get('user') == user:
+          records.append(record)
+  return records
+
+def summarize(records, title):
+  print(f"=== {title} ({len(records)} spawns) ===")
+  print(f"  {'phase':<34}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}")
+  rows = []
+  for phase in PHASES:
+    rows.append((phase, [r['phases'][phase] for r in records if phase in r.get('phases', {})]))
+  for a, b in zip(PHASES, PHASES[1:]):
+    deltas = [r['phases'][b] - r['phases'][a] for r in records if a in r.get('phases', {}) and b in r.get('phases', {})]
+    rows.append((f"{a} -> {b}", deltas))
+  for name, values in rows:
+    if not values:
+      continue
+    print(f"  {name:<34}{len(values):>6}" + ''.join(f"{percentile(values, p):>8.2f}s" for p in (50, 95, 99)))
+  outcomes = {}
+  for r in records:
+    outcomes[r.get('outcome')] = outcomes.get(r.get('outcome'), 0) + 1
+  print("  outcomes: " + ', '.join(f"{k}: {v}" for k, v in sorted(outcomes.items(), key = lambda kv: str(kv[0]))))
+  print()
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Summarize PodOnDemand spawn timelines", prog="spawnreport")
+  parser.add_argument('paths', nargs = '*', help = f"Timeline files to read (default: {TIMELINE_DIR}/*.jsonl)")
+  parser.add_argument('-t', '--type', type = str, default = None, help = "Only include spawns of this pod type")
+  args = parser.parse_args(argv[1:])
+
+  records = load_records(args.paths or glob.glob(os.path.join(TIMELINE_DIR, "*.jsonl")))
+  if args.type:
+    records = [r for r in records if r.get('podtype') == args.type]
+  if not records:
+    print("No spawn timelines found")
+    sys.exit(1)
+
+  summarize(records, "All pod types")
+  for podtype in sorted({str(r.get('podtype')) for r in records}):
+    summarize([r for r in records if str(r.get('podtype')) == podtype], f"Pod type {podtype}")
+    # Pre-pulled types: image cache hits and misses separately, to see what a miss costs
+    for cached, title in ((True, "image pre-pulled on the node"), (False, "image NOT pre-pulled on the node")):
+      subset = [r for r in records if str(r.get('podtype')) == podtype and r.get('image_cached') is cached]
+      if subset:
+        summarize(subset, f"Pod type {podtype}, {title}")
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import datetime
+
+# Records when each phase of a pod spawn happened, as seconds since the login started, and appends the result as one
+# JSON line to TIMELINE_DIR/<user>.jsonl. See spawnreport.py for percentiles per phase and per pod type.
+# Phases, in the order they normally happen:
+#   config_load, arg_parse, pod_create, scheduled, containers_ready, running, ssh_connect (sshd answered)
+# With --queue, queue_wait (our turn came and there was room) comes right before pod_create.
+# For pod types with prePull, image_cached records whether the node had already pulled the type's images.
+
+TIMELINE_DIR = os.environ.get("PODONDEMAND_TIMELINE_DIR", default = "/home/login/logs/timeline")
+
+class SpawnTimeline:
+  def __init__(self, username = None):
+    self.start = time.time()
+    self.phases = {}
+    self.info = {"user": username, "podtype": None, "storage": None, "node": None, "pod": None, "outcome": None}
+
+  def mark(self, phase):
+    if not phase in self.phases: # Keep the first time a phase was reached
+      self.phases[phase] = round(time.time() - self.start, 3)
+
+  def set(self, **info):
+    self.info.update(info)
+
+  # Watch event callback for wait_for_pod(): marks scheduling, container readiness and Running as they are reported
+  def observe_pod(self, pod):
+    if pod.spec and pod.spec.node_name:
+      self.info["node"] = pod.spec.node_name
+    for condition in (pod.status.conditions or []) if pod.status else []:
+      if condition.status == "True":
+        if condition.type == "PodScheduled":
+          self.mark("scheduled")
+        elif condition.type == "ContainersReady":
+          self.mark("containers_ready") # Image pulled and container started
+    if pod.status and pod.status.phase == "Running":
+      self.mark("running")
+
+  # Appends the record. Never fails the login over it. The directory is writable by every user (this runs as the
+  # login user), so the file is only writable by its owner, and one that isn't ours (planted under our name, or a
+  # symlink) is left alone; spawnreport.py in turn only reads files owned by the user they are named after.
+  def write(self, directory = TIMELINE_DIR):
+    record = {"time": datetime.datetime.fromtimestamp(self.start, datetime.timezone.utc).isoformat(), **self.info, "phases": self.phases}
+    try:
+      fd = os.open(os.path.join(directory, f"{self.info['user'] or 'unknown'}.jsonl"), os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_NOFOLLOW, 0o644)
+      with os.fdopen(fd, 'a') as out:
+        if os.fstat(fd).st_uid != os.geteuid():
+          return
+        os.fchmod(fd, 0o644)
+        out.write(json.dumps(record) + '\n')
+    except OSError:
+      pass